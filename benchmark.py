@@ -0,0 +1,230 @@
+"""
+benchmarks of the vision code on the recorded checkpoints, without GUI and camera.
+
+    python benchmark.py [checkpoint directory] [--repeats N] [--allocations] [--corners]
+
+replays every checkpoint (`.json` and `.bin`) through the stages of `App.process_match_data`
+and reports latency percentiles per stage and the throughput in frames/s
+"""
+import argparse
+import glob
+import itertools
+import json
+import os
+import time
+import timeit
+import tracemalloc
+from typing import Callable, Dict, List, Tuple
+
+import numpy as np
+
+from checkpoint import load_match_data
+from vision import SIGNIFICANCE, region_arrays, initial_corners, find_overlaps, fit_matches, box_geometry
+
+DEFAULT_CHECKPOINT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "checkpoints")
+REPEATS: int = 200
+REPLAY_REPEATS: int = 50  # replays of every checkpoint, the percentiles are taken over all of them
+PERCENTILES = (50, 90, 99)
+STAGES = ('load', 'overlaps', 'fit', 'geometry')
+SCALES = (1, 4, 16)  # the regions are upsampled by these factors to emulate denser layers / higher resolutions
+
+
+def load_json_checkpoints(path: str) -> Dict[str, dict]:
+    """
+    loads all JSON checkpoints in the given directory
+    :param path: checkpoint directory
+    :return: match data by file name
+    """
+    checkpoints = {}
+    for filename in sorted(glob.glob(os.path.join(path, "*.json"))):
+        with open(filename, "r") as f:
+            match_data = json.load(f)
+        checkpoints[os.path.basename(filename)] = {int(i): match for i, match in match_data.items()}
+    return checkpoints
+
+
+def initial_corners_loop(region: dict) -> List[List[float]]:
+    """
+    reference implementation of `vision.initial_corners`: the former python loop over all segments
+    :param region: PALLOC region
+    :return: [left, right, top, bottom] corners
+    """
+    segments_y = region['segmentsY']
+    segments_x_start = region['segmentsXStart']
+    segments_x_stop = region['segmentsXStop']
+
+    max_y = segments_y[-1]
+    min_y = segments_y[0]
+    max_x = segments_x_stop[-1]
+    min_x = segments_x_start[-1]
+
+    coordinates = [[min_x, max_y],
+                   [(max_x + min_x) / 2, max_y],
+                   [max_x, max_y],
+                   [(segments_x_stop[0] + segments_x_start[0]) / 2, min_y]]
+    for start, stop, y in zip(segments_x_start, segments_x_stop, segments_y):
+        significance = stop - start
+        if start < coordinates[0][0] and significance > SIGNIFICANCE:
+            coordinates[0] = [start, y]
+        if stop > coordinates[1][0] and significance > SIGNIFICANCE:
+            coordinates[1] = [stop, y]
+    return coordinates
+
+
+def scale_region(region: dict, scale: int) -> dict:
+    """
+    upsamples a region by an integer factor, every segment becomes `scale` segments
+    :param region: PALLOC region
+    :param scale: upsampling factor
+    :return: the scaled region
+    """
+    scaled = {'segmentsY': [], 'segmentsXStart': [], 'segmentsXStop': []}
+    for y, start, stop in zip(region['segmentsY'], region['segmentsXStart'], region['segmentsXStop']):
+        for row in range(scale):
+            scaled['segmentsY'].append(y * scale + row)
+            scaled['segmentsXStart'].append(start * scale)
+            scaled['segmentsXStop'].append(stop * scale + scale - 1)
+    return scaled
+
+
+def benchmark_corners(checkpoints: Dict[str, dict]) -> None:
+    """
+    checks that the vectorised corner extraction matches the loop and compares their runtime
+    :param checkpoints: match data by file name
+    :return:
+    """
+    print(f"{'checkpoint':<32} {'scale':>5} {'segments':>8} {'loop [us]':>10} {'numpy [us]':>10} {'arrays [us]':>11}")
+    for (name, match_data), scale in itertools.product(checkpoints.items(), SCALES):
+        regions = [scale_region(match['bbox']['region'], scale) for match in match_data.values()]
+        for region in regions:
+            expected = initial_corners_loop(region)
+            actual = initial_corners(*region_arrays(region))
+            assert actual == expected, f"{name}: {actual} != {expected}"
+
+        segments = sum(len(region['segmentsY']) for region in regions)
+        loop = timeit.timeit(lambda: [initial_corners_loop(r) for r in regions], number=REPEATS)
+        vectorised = timeit.timeit(lambda: [initial_corners(*region_arrays(r)) for r in regions], number=REPEATS)
+        # the arrays are converted once per frame and shared by the later stages, so also time without conversion
+        arrays = [region_arrays(r) for r in regions]
+        reductions = timeit.timeit(lambda: [initial_corners(*a) for a in arrays], number=REPEATS)
+        print(f"{name:<32} {scale:>5} {segments:>8} {loop / REPEATS * 1e6:>10.1f} "
+              f"{vectorised / REPEATS * 1e6:>10.1f} {reductions / REPEATS * 1e6:>11.1f}")
+
+
+def checkpoint_files(path: str) -> List[str]:
+    """
+    all JSON and binary checkpoints in the given directory
+    :param path: checkpoint directory
+    :return: sorted filenames
+    """
+    return sorted(glob.glob(os.path.join(path, "*.json")) + glob.glob(os.path.join(path, "*-match.bin")))
+
+
+def replay_stages(filename: str, fit_region_pixels: bool = True) -> List[Tuple[str, Callable[[dict], None]]]:
+    """
+    the stages of `App.process_match_data` on one checkpoint, each stage reads its input from
+    and writes its output to a shared state dict
+    :param filename: the checkpoint
+    :param fit_region_pixels: passed on to `fit_matches`
+    :return: (name, stage) in the order they run
+    """
+    def load(state):
+        state['match_data'], _ = load_match_data(filename)
+
+    def overlaps(state):
+        state['overlaps'] = find_overlaps({i: match['bbox']['rectangle'] for i, match in state['match_data'].items()})
+
+    def fit(state):
+        state['fitted'] = fit_matches(state['match_data'], state['overlaps'], fit_region_pixels)
+
+    def geometry(state):
+        state['boxes'] = box_geometry([rectangle for _, rectangle in state['fitted'].values()])
+
+    return list(zip(STAGES, (load, overlaps, fit, geometry)))
+
+
+def replay(filename: str, repeats: int) -> Dict[str, np.ndarray]:
+    """
+    times every stage on every replay of the checkpoint
+    :param filename: the checkpoint
+    :param repeats: number of replays
+    :return: latencies in seconds (repeats,) by stage, 'frame' holds the sum of all stages
+    """
+    stages = replay_stages(filename)
+    latencies = np.empty((repeats, len(stages)))
+    for repeat in range(repeats):
+        state = {}
+        for k, (_, stage) in enumerate(stages):
+            start = time.perf_counter()
+            stage(state)
+            latencies[repeat, k] = time.perf_counter() - start
+    result = {name: latencies[:, k] for k, (name, _) in enumerate(stages)}
+    result['frame'] = latencies.sum(axis=1)
+    return result
+
+
+def replay_allocations(filename: str) -> Dict[str, Tuple[int, int]]:
+    """
+    traces the memory allocations of every stage in one replay. Tracing slows down python a lot,
+    so this runs separately from the timing
+    :param filename: the checkpoint
+    :return: (allocated blocks still alive after the stage, peak bytes during the stage) by stage
+    """
+    allocations = {}
+    state = {}
+    tracemalloc.start()
+    try:
+        for name, stage in replay_stages(filename):
+            before = tracemalloc.take_snapshot()
+            tracemalloc.reset_peak()
+            base, _ = tracemalloc.get_traced_memory()
+            stage(state)
+            _, peak = tracemalloc.get_traced_memory()
+            after = tracemalloc.take_snapshot()
+            blocks = sum(stat.count_diff for stat in after.compare_to(before, 'filename'))
+            allocations[name] = (blocks, peak - base)
+    finally:
+        tracemalloc.stop()
+    return allocations
+
+
+def benchmark_replay(filenames: List[str], repeats: int = REPLAY_REPEATS, allocations: bool = False) -> None:
+    """
+    replays the checkpoints and prints latency percentiles per stage and the throughput
+    :param filenames: checkpoints to replay
+    :param repeats: number of replays of every checkpoint
+    :param allocations: also trace the memory allocations of each stage
+    :return:
+    """
+    columns = ' '.join(f"{f'p{p} [us]':>10}" for p in PERCENTILES)
+    print(f"{'checkpoint':<40} {'boxes':>5} {'stage':<8} {columns}" + (f" {'blocks':>7} {'peak [KiB]':>10}" if allocations else ""))
+    totals = []
+    for filename in filenames:
+        name = os.path.basename(filename)
+        boxes = len(load_match_data(filename)[0])
+        latencies = replay(filename, repeats)
+        traced = replay_allocations(filename) if allocations else {}
+        totals.append(latencies['frame'])
+        for stage in STAGES + ('frame',):
+            values = ' '.join(f"{v * 1e6:>10.1f}" for v in np.percentile(latencies[stage], PERCENTILES))
+            line = f"{name:<40} {boxes:>5} {stage:<8} {values}"
+            if stage in traced:
+                blocks, peak = traced[stage]
+                line += f" {blocks:>7} {peak / 1024:>10.1f}"
+            print(line)
+    if totals:
+        frames = np.concatenate(totals)
+        print(f"{len(frames)} frames replayed in {frames.sum():.3f} s: {len(frames) / frames.sum():.1f} frames/s")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Replay the recorded checkpoints through the vision pipeline")
+    parser.add_argument("path", nargs="?", default=DEFAULT_CHECKPOINT_PATH, help="checkpoint directory")
+    parser.add_argument("--repeats", type=int, default=REPLAY_REPEATS, help="replays of every checkpoint")
+    parser.add_argument("--allocations", action="store_true", help="trace the memory allocations of each stage")
+    parser.add_argument("--corners", action="store_true", help="also compare the corner extraction with the loop")
+    args = parser.parse_args()
+
+    if args.corners:
+        benchmark_corners(load_json_checkpoints(args.path))
+    benchmark_replay(checkpoint_files(args.path), args.repeats, args.allocations)
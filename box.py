@@ -2,7 +2,8 @@
 file containing a class for defining a box alonsgside
 with it's dimensions
 """
-from typing import Tuple, List
+from concurrent.futures import Executor
+from typing import Tuple, List, Optional
 from enum import Enum
 
 from util import Vec2, Vec3
@@ -122,24 +123,62 @@ def determine_positions_easy(target_area: Tuple[Vec2, Vec2],
                 action = BoxAction.ROTATE_90
             else:
                 # we have to start a new column to fit package
-                current_x_border = 0
+                current_x_border = ta_origin.x
                 current_y_border = max_y_offset
                 max_y_offset = 0
                 action = BoxAction.PLACE
 
-
-        target_center_of_box = Vec2(current_x_border + MARGIN_INTER + box.width // 2,
-                                    current_y_border + MARGIN_INTER + box.height // 2)
+        # a rotated box covers its height along x
+        width, height = (box.height, box.width) if action == BoxAction.ROTATE_90 else (box.width, box.height)
+        target_center_of_box = Vec2(current_x_border + MARGIN_INTER + width / 2,
+                                    current_y_border + MARGIN_INTER + height / 2)
 
         target_coords.append((target_center_of_box, action))
 
-        current_x_border = target_center_of_box.x
-        max_y_offset = max(max_y_offset, target_center_of_box.y + box.height // 2)
+        current_x_border = current_x_border + MARGIN_INTER + width  # right edge of the box
+        max_y_offset = max(max_y_offset, current_y_border + MARGIN_INTER + height)
 
 
 
     return target_coords
 
+def determine_positions(target_area: Tuple[Vec2, Vec2],
+                        boxes: List[Box],
+                        strategy: str = 'maxrects') -> List[Optional[Tuple[Vec2, BoxAction]]]:
+    """
+    given a set of boxes, determine the positions to put the boxes to with the packing engine (see packing.py).
+    The boxes are placed by descending area, whether a box is rotated is decided by the score of both orientations
+
+    :param target_area: (x1, y1, x2, y2) of a rectangular area to put the boxes into
+    :param boxes: The boxes to place into the target area
+    :param strategy: 'maxrects' or 'skyline'
+    :return: List of (x,y, action) positions of the Boxes to be placed to, None for a box which does not fit
+    """
+    from packing import pack  # packing uses Box and BoxAction of this module
+
+    return pack(target_area, boxes, strategy).positions()
+
+def determine_positions_best(target_area: Tuple[Vec2, Vec2],
+                             boxes: List[Box],
+                             budget: Optional[float] = None,
+                             executor: Optional[Executor] = None) -> List[Optional[Tuple[Vec2, BoxAction]]]:
+    """
+    given a set of boxes, determine the positions to put the boxes to by trying several packers, orderings of
+    the boxes and rotation policies within a time budget (see planner.py). The plan covering the most of the
+    target area wins, on a tie the one with the shortest robot travel
+
+    :param target_area: (x1, y1, x2, y2) of a rectangular area to put the boxes into
+    :param boxes: The boxes to place into the target area
+    :param budget: wall-clock seconds for the search, e.g. the remaining time of the current robot move.
+        planner.PLAN_BUDGET if not given
+    :param executor: e.g. a ProcessPoolExecutor to evaluate the plans in parallel, serial if not given
+    :return: List of (x,y, action) positions of the Boxes to be placed to, None for a box which does not fit
+    """
+    from planner import PLAN_BUDGET, search_plans  # planner uses Box and BoxAction of this module
+
+    budget = PLAN_BUDGET if budget is None else budget
+    return search_plans(target_area, boxes, budget, executor).result.positions()
+
 if __name__ == '__main__':
     from tkinter import Toplevel, PhotoImage, Canvas
     import tkinter as tk
@@ -158,9 +197,12 @@ if __name__ == '__main__':
 
     boxes = sort_by_size([b1, b2, b3, b4, b5, b6], descending=True)
 
-    target = determine_positions_easy(target_area, boxes)
+    target = determine_positions(target_area, boxes)
 
     for i, box in enumerate(target):
+        if box is None:
+            print(f"Box {i+1}: does not fit")
+            continue
         print(f"Box {i+1}: X: {box[0].x}, Y:{box[0].y}, action: {box[1]}")
 
     root = tk.Tk()
@@ -172,7 +214,10 @@ if __name__ == '__main__':
     canvas.pack(fill=tk.BOTH, expand=True)
 
     for i, box in enumerate(target):
-        canvas.create_rectangle(box[0].x- boxes[i].width//2, box[0].y - boxes[i].height//2, box[0].x + boxes[i].width//2, box[0].y + boxes[i].height//2)
+        if box is None:
+            continue
+        width, height = (boxes[i].height, boxes[i].width) if box[1] == BoxAction.ROTATE_90 else (boxes[i].width, boxes[i].height)
+        canvas.create_rectangle(box[0].x - width/2, box[0].y - height/2, box[0].x + width/2, box[0].y + height/2)
 
     # Start the Tkinter event loop
     root.mainloop()
\ No newline at end of file
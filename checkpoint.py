@@ -0,0 +1,402 @@
+"""
+binary checkpoint format for recorded PALLOC frames.
+
+A checkpoint is a flat file `<timestamp>-match.bin` next to the colour image
+`<timestamp>-match.<png|jpg|bmp>` and the optional depth image `<timestamp>-depth.png`. The file starts with a small JSON index
+followed by typed arrays (64 byte aligned), so replay can memory-map the
+region segments instead of parsing them:
+
+    MAGIC | u64 length of the index | index (JSON) | padding | arrays...
+
+Arrays:
+    match_ids        (N,)      int32    match number of each box
+    rectangles       (N, 5)    float64  PALLOC rectangle: x, y, width, height, rotation
+    segment_offsets  (N + 1,)  int64    segments of box k are segments[:, offsets[k]:offsets[k + 1]]
+    segments         (3, M)    int32    rows segmentsY, segmentsXStart, segmentsXStop
+"""
+import datetime
+import json
+import os
+import struct
+import sys
+import time
+from collections import deque
+from threading import Condition, Lock, Thread
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+
+from frame import ColorFrame, DepthFrame, IMAGE_EXTENSIONS
+from metrics import METRICS
+
+MAGIC = b'PALLOCCK'
+VERSION: int = 1
+ALIGNMENT: int = 64  # arrays start at multiples of this, so views on the mapped file are aligned
+SUFFIX = "-match.bin"
+RECTANGLE_KEYS = ('x', 'y', 'width', 'height', 'rotation')
+BLOCK = 'block'  # CheckpointWriter policy: wait for the writer if the queue is full
+DROP_OLDEST = 'drop_oldest'  # CheckpointWriter policy: discard the oldest queued frame if the queue is full
+
+_name_lock = Lock()
+_last_stamp: int = 0  # nanoseconds of the last checkpoint name handed out
+
+
+def _aligned(offset: int) -> int:
+    return -(-offset // ALIGNMENT) * ALIGNMENT
+
+
+def unique_base_filename(path: str) -> str:
+    """
+    returns a new base filename (without suffix) in the given directory.
+    Names contain the time in microseconds and are strictly increasing within this process
+    :param path: checkpoint directory
+    :return:
+    """
+    global _last_stamp
+    with _name_lock:
+        stamp = max(time.time_ns(), _last_stamp + 1000)
+        _last_stamp = stamp
+    timestamp = datetime.datetime.fromtimestamp(stamp / 1e9)
+    return os.path.join(path, f"{timestamp:%Y-%m-%d_%H-%M-%S-%f}")
+
+
+def match_data_to_arrays(match_data: Dict[int, dict]) -> Tuple[Dict[str, np.ndarray], list]:
+    """
+    converts PALLOC match data into the columnar arrays of a checkpoint
+    :param match_data: match data by match number
+    :return: (arrays by name, remaining per match fields which are stored in the index)
+    """
+    ids = sorted(match_data)
+    regions = [match_data[i]['bbox']['region'] for i in ids]
+    offsets = np.cumsum([0] + [len(region['segmentsY']) for region in regions], dtype=np.int64)
+
+    segments = np.empty((3, int(offsets[-1])), dtype=np.int32)
+    rectangles = np.empty((len(ids), len(RECTANGLE_KEYS)), dtype=np.float64)
+    metadata = []
+    for k, (i, region) in enumerate(zip(ids, regions)):
+        segments[0, offsets[k]:offsets[k + 1]] = region['segmentsY']
+        segments[1, offsets[k]:offsets[k + 1]] = region['segmentsXStart']
+        segments[2, offsets[k]:offsets[k + 1]] = region['segmentsXStop']
+        rectangle = match_data[i]['bbox']['rectangle']
+        rectangles[k] = [rectangle.get(key, 0.0) for key in RECTANGLE_KEYS]
+
+        fields = {key: value for key, value in match_data[i].items() if key != 'bbox'}
+        fields['bbox'] = {key: value for key, value in match_data[i]['bbox'].items()
+                          if key not in ('rectangle', 'region')}
+        metadata.append(fields)
+
+    arrays = {'match_ids': np.asarray(ids, dtype=np.int32),
+              'rectangles': rectangles,
+              'segment_offsets': offsets,
+              'segments': segments}
+    return arrays, metadata
+
+
+def write_checkpoint_file(filename: str, arrays: Dict[str, np.ndarray], index: dict) -> None:
+    """
+    writes arrays and an index into a new checkpoint file, fails if the file exists
+    :param filename: path of the file
+    :param arrays: arrays by name
+    :param index: additional JSON serialisable entries of the index
+    :return:
+    """
+    layout = {}
+    offset = 0
+    for name, array in arrays.items():
+        layout[name] = {'dtype': array.dtype.str, 'shape': list(array.shape), 'offset': offset}
+        offset = _aligned(offset + array.nbytes)
+    header = json.dumps(dict(index, version=VERSION, arrays=layout)).encode()
+    data_start = _aligned(len(MAGIC) + 8 + len(header))
+
+    with open(filename, 'xb') as f:
+        f.write(MAGIC)
+        f.write(struct.pack('<Q', len(header)))
+        f.write(header)
+        for name, array in arrays.items():
+            f.seek(data_start + layout[name]['offset'])
+            f.write(np.ascontiguousarray(array).tobytes())
+        f.truncate(data_start + offset)
+
+
+def save_checkpoint(path: str,
+                    match_data: Dict[int, dict],
+                    color_frame: Optional[ColorFrame] = None,
+                    depth_frame: Optional[DepthFrame] = None) -> str:
+    """
+    stores the match data (and the images) of a frame under a new unique name
+    :param path: checkpoint directory, created if missing
+    :param match_data: match data by match number
+    :param color_frame: the colour image, stored as received
+    :param depth_frame: the depth image, stored as received
+    :return: filename of the binary checkpoint
+    """
+    os.makedirs(path, exist_ok=True)
+    arrays, metadata = match_data_to_arrays(match_data)
+    while True:
+        base_filename = unique_base_filename(path)
+        image_filename = f"{base_filename}-match.{color_frame.extension}" if color_frame is not None else None
+        depth_filename = f"{base_filename}-depth.{depth_frame.extension}" if depth_frame is not None else None
+        index = {'matches': metadata,
+                 'image': os.path.basename(image_filename) if image_filename else None,
+                 'depth_image': os.path.basename(depth_filename) if depth_filename else None,
+                 'depth_scale': depth_frame.scale if depth_frame is not None else None}
+        try:
+            write_checkpoint_file(base_filename + SUFFIX, arrays, index)
+            break
+        except FileExistsError:
+            continue  # written by another process in the same microsecond
+    if color_frame is not None:
+        color_frame.save(f"{base_filename}-match")
+    if depth_frame is not None:
+        depth_frame.save(f"{base_filename}-depth")
+    return base_filename + SUFFIX
+
+
+class Checkpoint:
+    """
+    recorded frame with its arrays memory-mapped from the checkpoint file,
+    nothing is parsed or copied until it is accessed
+    """
+    def __init__(self, filename: str) -> None:
+        """
+        :param filename: path of a `-match.bin` checkpoint
+        """
+        self.filename = filename
+        with open(filename, 'rb') as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f"{filename} is not a checkpoint file")
+            header_length, = struct.unpack('<Q', f.read(8))
+            self.index = json.loads(f.read(header_length))
+        data_start = _aligned(len(MAGIC) + 8 + header_length)
+
+        raw = np.memmap(filename, dtype=np.uint8, mode='r')
+        self.arrays = {}
+        for name, entry in self.index['arrays'].items():
+            dtype = np.dtype(entry['dtype'])
+            size = int(np.prod(entry['shape'])) * dtype.itemsize
+            start = data_start + entry['offset']
+            self.arrays[name] = raw[start:start + size].view(dtype).reshape(entry['shape'])
+
+    @property
+    def match_ids(self) -> np.ndarray:
+        return self.arrays['match_ids']
+
+    @property
+    def rectangles(self) -> np.ndarray:
+        return self.arrays['rectangles']
+
+    @property
+    def segments(self) -> np.ndarray:
+        return self.arrays['segments']
+
+    @property
+    def segment_offsets(self) -> np.ndarray:
+        return self.arrays['segment_offsets']
+
+    @property
+    def image_filename(self) -> Optional[str]:
+        image = self.index.get('image')
+        return os.path.join(os.path.dirname(self.filename), image) if image else None
+
+    def __len__(self) -> int:
+        return len(self.match_ids)
+
+    def region(self, k: int) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        segments of the k-th box as views on the mapped file
+        :param k: position of the box (not its match number)
+        :return: (segments_y, segments_x_start, segments_x_stop)
+        """
+        start, stop = self.segment_offsets[k], self.segment_offsets[k + 1]
+        return self.segments[0, start:stop], self.segments[1, start:stop], self.segments[2, start:stop]
+
+    def match_data(self) -> Dict[int, dict]:
+        """
+        rebuilds the match data dict as delivered by PALLOC, the segments are views on the mapped file
+        :return: match data by match number
+        """
+        match_data = {}
+        for k, i in enumerate(self.match_ids.tolist()):
+            fields = json.loads(json.dumps(self.index['matches'][k]))  # fresh copy, the result may be modified
+            segments_y, segments_x_start, segments_x_stop = self.region(k)
+            fields['bbox']['rectangle'] = dict(zip(RECTANGLE_KEYS, self.rectangles[k].tolist()))
+            fields['bbox']['region'] = {'segmentsY': segments_y,
+                                        'segmentsXStart': segments_x_start,
+                                        'segmentsXStop': segments_x_stop}
+            match_data[i] = fields
+        return match_data
+
+    def color_frame(self) -> Optional[ColorFrame]:
+        filename = self.image_filename
+        return ColorFrame.from_file(filename) if filename else None
+
+    def depth_frame(self) -> Optional[DepthFrame]:
+        image = self.index.get('depth_image')
+        if not image:
+            return None
+        return DepthFrame.from_file(os.path.join(os.path.dirname(self.filename), image), self.index['depth_scale'])
+
+
+class CheckpointWriter:
+    """
+    persists checkpoints in a background thread, so a slow disk does not delay the acquisition.
+    Frames are queued in a bounded queue, if it is full `submit` either waits (BLOCK)
+    or discards the oldest queued frame (DROP_OLDEST)
+    """
+    def __init__(self, path: str, max_queued: int = 4, policy: str = DROP_OLDEST) -> None:
+        """
+        :param path: checkpoint directory, created if missing
+        :param max_queued: maximum number of frames waiting to be written
+        :param policy: BLOCK or DROP_OLDEST
+        """
+        if policy not in (BLOCK, DROP_OLDEST):
+            raise ValueError(f"Unknown policy {policy}")
+        self.path = path
+        self.max_queued = max_queued
+        self.policy = policy
+
+        self._queue = deque()
+        self._condition = Condition()
+        self._writing = False
+        self._closed = False
+        self.submitted = 0
+        self.written = 0
+        self.dropped = 0
+        self.failed = 0
+        self.blocked_seconds = 0.0  # time submit waited for space in the queue
+        self.last_error: Optional[Exception] = None
+        self.last_filename: Optional[str] = None
+        self._thread = Thread(target=self._run, name="CheckpointWriter", daemon=True)
+        self._thread.start()
+
+    def submit(self, match_data: Dict[int, dict], color_frame: Optional[ColorFrame] = None,
+               depth_frame: Optional[DepthFrame] = None, timeout: Optional[float] = None) -> bool:
+        """
+        queues a frame to be written. The data is written as it is at that time, so it must not be modified afterwards
+        :param match_data: match data by match number
+        :param color_frame: the colour image
+        :param depth_frame: the depth image
+        :param timeout: BLOCK policy only, seconds to wait for space in the queue, None waits as long as needed
+        :return: False if the frame was discarded because the queue stayed full
+        """
+        with self._condition:
+            if self._closed:
+                raise RuntimeError("CheckpointWriter is closed")
+            self.submitted += 1
+            if len(self._queue) >= self.max_queued:
+                if self.policy == DROP_OLDEST:
+                    self._queue.popleft()
+                    self.dropped += 1
+                else:
+                    start = time.perf_counter()
+                    has_space = self._condition.wait_for(lambda: len(self._queue) < self.max_queued, timeout)
+                    self.blocked_seconds += time.perf_counter() - start
+                    if not has_space:
+                        self.dropped += 1
+                        return False
+            self._queue.append((match_data, color_frame, depth_frame))
+            self._condition.notify_all()
+        return True
+
+    def metrics(self) -> Dict[str, float]:
+        """
+        counters of the writer, `queued` frames are still waiting to be written
+        :return:
+        """
+        with self._condition:
+            return {'queued': len(self._queue),
+                    'submitted': self.submitted,
+                    'written': self.written,
+                    'dropped': self.dropped,
+                    'failed': self.failed,
+                    'blocked_seconds': self.blocked_seconds}
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """
+        waits until all queued frames are written
+        :param timeout: seconds to wait, None waits as long as needed
+        :return: False if frames were still pending after the timeout
+        """
+        with self._condition:
+            return self._condition.wait_for(lambda: not self._queue and not self._writing, timeout)
+
+    def close(self, timeout: Optional[float] = None) -> None:
+        """
+        writes the queued frames and stops the thread
+        :param timeout: seconds to wait for the queued frames
+        :return:
+        """
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        self._thread.join(timeout)
+
+    def __enter__(self) -> "CheckpointWriter":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def _run(self) -> None:
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: self._queue or self._closed)
+                if not self._queue:
+                    return
+                match_data, color_frame, depth_frame = self._queue.popleft()
+                self._writing = True
+                self._condition.notify_all()  # space for a blocked submit
+            filename = None
+            error = None
+            try:
+                with METRICS.time('save'):
+                    filename = save_checkpoint(self.path, match_data, color_frame, depth_frame)
+            except Exception as e:
+                # Any failure, also of a malformed frame, only costs this frame: the thread has to keep
+                # running, otherwise flush and a blocked submit would wait forever
+                error = e
+            finally:
+                with self._condition:
+                    if filename is not None:
+                        self.written += 1
+                        self.last_filename = filename
+                    else:
+                        self.failed += 1
+                        self.last_error = error
+                    self._writing = False
+                    self._condition.notify_all()
+
+
+def load_match_data(filename: str) -> Tuple[Dict[int, dict], Optional[ColorFrame]]:
+    """
+    loads a binary or a legacy JSON checkpoint
+    :param filename: path of the `.bin` or `.json` checkpoint
+    :return: (match data by match number, colour image if stored)
+    """
+    if filename.endswith('.bin'):
+        checkpoint = Checkpoint(filename)
+        return checkpoint.match_data(), checkpoint.color_frame()
+
+    with open(filename, 'r') as f:
+        match_data = {int(i): match for i, match in json.load(f).items()}
+    base_filename = os.path.splitext(filename)[0]
+    for extension in IMAGE_EXTENSIONS.values():
+        if os.path.isfile(f"{base_filename}.{extension}"):
+            return match_data, ColorFrame.from_file(f"{base_filename}.{extension}")
+    return match_data, None
+
+
+def load_depth_frame(filename: str) -> Optional[DepthFrame]:
+    """
+    loads the depth image stored with a binary checkpoint
+    :param filename: path of the `.bin` checkpoint, JSON checkpoints have no depth image
+    :return: the depth image if stored
+    """
+    return Checkpoint(filename).depth_frame() if filename.endswith('.bin') else None
+
+
+if __name__ == '__main__':
+    # Convert legacy JSON checkpoints: python checkpoint.py checkpoints/*.json
+    for json_filename in sys.argv[1:]:
+        match_data, color_frame = load_match_data(json_filename)
+        print(f"{json_filename} -> {save_checkpoint(os.path.dirname(json_filename), match_data, color_frame)}")
@@ -0,0 +1,135 @@
+"""
+images delivered by PALLOC, decoded once and shared by
+display, checkpointing and analysis
+"""
+import base64
+import io
+from threading import Lock
+from typing import Tuple
+
+import numpy as np
+from PIL import Image
+
+IMAGE_EXTENSIONS = {b'\x89PNG': 'png', b'\xff\xd8': 'jpg', b'BM': 'bmp'}  # magic bytes of the supported formats
+
+
+class ColorFrame:
+    """
+    colour image of one PALLOC run. Keeps the encoded file as received, the decoded
+    image is created on first use and then shared by everyone who needs it
+    """
+    def __init__(self, encoded: bytes) -> None:
+        """
+        :param encoded: the image file (e.g. PNG) as received from the camera
+        """
+        self.encoded = encoded
+        self._image = None
+        self._lock = Lock()  # the frame is shared between the acquisition and the GUI thread
+
+    @classmethod
+    def from_base64(cls, data) -> "ColorFrame":
+        """
+        creates a frame from the base64 string PALLOC sends
+        :param data: base64 encoded image file
+        :return:
+        """
+        return cls(base64.b64decode(data))
+
+    @classmethod
+    def from_file(cls, filename: str) -> "ColorFrame":
+        """
+        creates a frame from an image file, e.g. a checkpoint
+        :param filename: path of the image file
+        :return:
+        """
+        with open(filename, 'rb') as f:
+            return cls(f.read())
+
+    @property
+    def image(self) -> Image.Image:
+        """
+        the decoded image, decoded only once
+        :return:
+        """
+        with self._lock:
+            if self._image is None:
+                image = Image.open(io.BytesIO(self.encoded))
+                image.load()
+                self._image = image
+            return self._image
+
+    @property
+    def array(self) -> np.ndarray:
+        """
+        read-only view of the pixels as (height, width, channels) array
+        :return:
+        """
+        return np.asarray(self.image)
+
+    @property
+    def size(self) -> Tuple[int, int]:
+        return self.image.size
+
+    @property
+    def extension(self) -> str:
+        """
+        file extension of the encoded image, determined from its magic bytes
+        :return:
+        """
+        for magic, extension in IMAGE_EXTENSIONS.items():
+            if self.encoded.startswith(magic):
+                return extension
+        return 'png'
+
+    def save(self, base_filename: str) -> str:
+        """
+        writes the image as received, without encoding it again
+        :param base_filename: filename without extension
+        :return: the filename written to
+        """
+        filename = f"{base_filename}.{self.extension}"
+        with open(filename, 'wb') as f:
+            f.write(self.encoded)
+        return filename
+
+
+class DepthFrame(ColorFrame):
+    """
+    depth image of one PALLOC run (a single channel image, usually 16 bit PNG),
+    decoded once into a float array
+    """
+    def __init__(self, encoded: bytes, scale: float = 1.0) -> None:
+        """
+        :param encoded: the image file as received from the camera
+        :param scale: factor converting the pixel values into millimetres
+        """
+        super().__init__(encoded)
+        self.scale = scale
+        self._depth = None
+
+    @classmethod
+    def from_base64(cls, data, scale: float = 1.0) -> "DepthFrame":
+        return cls(base64.b64decode(data), scale)
+
+    @classmethod
+    def from_file(cls, filename: str, scale: float = 1.0) -> "DepthFrame":
+        with open(filename, 'rb') as f:
+            return cls(f.read(), scale)
+
+    @property
+    def array(self) -> np.ndarray:
+        """
+        read-only (height, width) array of the depth in millimetres, NaN where the camera measured nothing
+        :return:
+        """
+        image = self.image
+        with self._lock:
+            if self._depth is None:
+                raw = np.asarray(image)
+                if raw.ndim == 3:
+                    raw = raw[:, :, 0]
+                depth = raw.astype(np.float32) * np.float32(self.scale)
+                depth[raw <= 0] = np.nan
+                depth.flags.writeable = False
+                self._depth = depth
+            return self._depth
@@ -0,0 +1,293 @@
+"""
+timers, counters and logging of the cell. Everything is cheap enough for the acquisition loop:
+a stage timer costs two perf_counter calls and a locked update, disabled log levels are not formatted.
+
+    with METRICS.time('fit'):
+        result = pipeline.process(match_data)
+    METRICS.write('metrics.prom')  # or METRICS.serve(9108) for http://localhost:9108/metrics
+
+The export uses the Prometheus text format, so it can be scraped or read by the node exporter textfile collector
+"""
+import bisect
+import logging
+import os
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Event, Lock, Thread
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+PREFIX = "palloc"
+STAGES = ('connect', 'acquire', 'locate', 'fetch', 'fit', 'render', 'save')  # stages timed by the application
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)  # seconds
+EXPORT_INTERVAL: float = 10.0  # seconds between two writes of the export file
+LOG_INTERVAL: float = 5.0  # seconds in which a repeated log message is only written once
+MAX_LOG_KEYS: int = 1024  # messages remembered by the rate limit before the expired ones are dropped
+LOG_FORMAT = "%(asctime)s %(levelname)s %(name)s: %(message)s"
+
+
+class _Histogram:
+    def __init__(self) -> None:
+        self.buckets = [0] * (len(BUCKETS) + 1)  # the last bucket is +Inf
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        self.buckets[bisect.bisect_left(BUCKETS, value)] += 1
+        self.count += 1
+        self.sum += value
+
+
+class MetricsRegistry:
+    """
+    thread safe counters, gauges and stage timers, exported in the Prometheus text format
+    """
+    def __init__(self, prefix: str = PREFIX) -> None:
+        """
+        :param prefix: prepended to all metric names
+        """
+        self.prefix = prefix
+        self._lock = Lock()
+        self._counters: Dict[Tuple[str, Tuple[Tuple[str, str], ...]], float] = {}
+        self._gauges: Dict[Tuple[str, Tuple[Tuple[str, str], ...]], float] = {}
+        self._stages: Dict[str, _Histogram] = {}
+        self._collectors: List[Callable[[], Dict[str, float]]] = []
+        self._server: Optional[ThreadingHTTPServer] = None
+        self._stop = Event()
+
+    def inc(self, name: str, value: float = 1, **labels: str) -> None:
+        """
+        increases a counter
+        :param name: name of the counter, `_total` is appended in the export
+        :param value: increment
+        :param labels: label values of the counter
+        :return:
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def set(self, name: str, value: float, **labels: str) -> None:
+        """
+        sets a gauge
+        :param name: name of the gauge
+        :param value: current value
+        :param labels: label values of the gauge
+        :return:
+        """
+        with self._lock:
+            self._gauges[(name, tuple(sorted(labels.items())))] = value
+
+    def observe(self, stage: str, seconds: float) -> None:
+        """
+        records the duration of a stage
+        :param stage: name of the stage, e.g. 'fit'
+        :param seconds: duration
+        :return:
+        """
+        with self._lock:
+            histogram = self._stages.get(stage)
+            if histogram is None:
+                histogram = self._stages[stage] = _Histogram()
+            histogram.observe(seconds)
+
+    @contextmanager
+    def time(self, stage: str) -> Iterator[None]:
+        """
+        times the enclosed block as the given stage, also if it raises
+        :param stage: name of the stage
+        :return:
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start)
+
+    def add_collector(self, collector: Callable[[], Dict[str, float]]) -> None:
+        """
+        registers a function returning gauges (name: value) which is called on every export,
+        e.g. the metrics of the checkpoint writer
+        :param collector: the function
+        :return:
+        """
+        with self._lock:
+            self._collectors.append(collector)
+
+    def stage_summary(self) -> Dict[str, Tuple[int, float]]:
+        """
+        :return: (count, mean seconds) by stage
+        """
+        with self._lock:
+            return {stage: (h.count, h.sum / h.count if h.count else 0.0) for stage, h in self._stages.items()}
+
+    def export(self) -> str:
+        """
+        all metrics in the Prometheus text format
+        :return:
+        """
+        with self._lock:
+            counters = dict(self._counters)
+            gauges = dict(self._gauges)
+            stages = {stage: (list(h.buckets), h.count, h.sum) for stage, h in self._stages.items()}
+            collectors = list(self._collectors)
+        for collector in collectors:
+            for name, value in collector().items():
+                gauges[(name, ())] = value
+
+        lines = []
+        for kind, suffix, values in (('counter', '_total', counters), ('gauge', '', gauges)):
+            typed = set()
+            for (name, labels), value in sorted(values.items()):
+                if name not in typed:
+                    lines.append(f"# TYPE {self.prefix}_{name}{suffix} {kind}")
+                    typed.add(name)
+                lines.append(f"{self.prefix}_{name}{suffix}{_labels(labels)} {value}")
+        if stages:
+            name = f"{self.prefix}_stage_seconds"
+            lines.append(f"# TYPE {name} histogram")
+            for stage, (buckets, count, total) in sorted(stages.items()):
+                cumulative = 0
+                for bound, bucket in zip(BUCKETS + (float('inf'),), buckets):
+                    cumulative += bucket
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    lines.append(f'{name}_bucket{{stage="{stage}",le="{le}"}} {cumulative}')
+                lines.append(f'{name}_count{{stage="{stage}"}} {count}')
+                lines.append(f'{name}_sum{{stage="{stage}"}} {total}')
+        return "\n".join(lines) + "\n"
+
+    def write(self, filename: str) -> None:
+        """
+        writes the export to a file, replaced atomically so a reader never sees a partial file
+        :param filename: e.g. the textfile directory of the node exporter
+        :return:
+        """
+        temporary = f"{filename}.{os.getpid()}.tmp"
+        with open(temporary, 'w') as f:
+            f.write(self.export())
+        os.replace(temporary, filename)
+
+    def write_periodically(self, filename: str, interval: float = EXPORT_INTERVAL) -> None:
+        """
+        writes the export to a file every `interval` seconds in a background thread
+        :param filename: see `write`
+        :param interval: seconds between two writes
+        :return:
+        """
+        def run():
+            while True:
+                stopped = self._stop.wait(interval)  # the final state is written when stopped
+                try:
+                    self.write(filename)
+                except OSError as e:
+                    logging.getLogger(f"{PREFIX}.metrics").warning("Could not write %s: %s", filename, e)
+                if stopped:
+                    return
+
+        Thread(target=run, name="MetricsWriter", daemon=True).start()
+
+    def serve(self, port: int, host: str = "127.0.0.1") -> None:
+        """
+        serves the export on http://host:port/metrics in a background thread
+        :param port: TCP port
+        :param host: interface to listen on, only local by default
+        :return:
+        """
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] not in ('/', '/metrics'):
+                    self.send_error(404)
+                    return
+                body = registry.export().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass  # no line per scrape
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        Thread(target=self._server.serve_forever, name="MetricsServer", daemon=True).start()
+
+    def close(self) -> None:
+        """
+        stops the HTTP server and the periodic file export
+        :return:
+        """
+        self._stop.set()
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+
+def _labels(labels: Tuple[Tuple[str, str], ...]) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}"
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    lets a message (per logger, level and formatted text) pass once per interval, only identical
+    repeats are limited. The next message which passes tells how many were suppressed in between
+    """
+    def __init__(self, interval: float = LOG_INTERVAL) -> None:
+        """
+        :param interval: seconds in which a repeated message is only logged once
+        """
+        super().__init__()
+        self.interval = interval
+        self._lock = Lock()
+        self._last: Dict[Tuple[str, int, str], Tuple[float, int]] = {}  # (time of the last pass, suppressed)
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        try:
+            message = record.getMessage()
+        except Exception:
+            return True  # a broken format is reported by the handler
+        key = (record.name, record.levelno, message)
+        now = time.monotonic()
+        with self._lock:
+            last, suppressed = self._last.get(key, (-self.interval, 0))
+            if now - last < self.interval:
+                self._last[key] = (last, suppressed + 1)
+                return False
+            self._last[key] = (now, 0)
+            if len(self._last) > MAX_LOG_KEYS:
+                # Distinct messages (e.g. every request at debug level) would fill the table,
+                # the expired ones and if needed the oldest ones are forgotten
+                recent = sorted(((v, k) for k, v in self._last.items() if now - v[0] < self.interval), reverse=True)
+                self._last = {k: v for v, k in recent[:MAX_LOG_KEYS // 2]}
+        if suppressed:
+            # Through the arguments, the message may contain a literal %
+            record.msg = "%s (%d identical messages suppressed)"
+            record.args = (message, suppressed)
+        return True
+
+
+def configure_logging(level: int = logging.INFO, interval: float = LOG_INTERVAL,
+                      handler: Optional[logging.Handler] = None) -> logging.Handler:
+    """
+    sets up the `palloc` loggers with a rate limited handler
+    :param level: minimal level which is logged, e.g. logging.DEBUG
+    :param interval: seconds in which a repeated message is only logged once, 0 disables the limit
+    :param handler: where the records go, by default stderr
+    :return: the handler
+    """
+    handler = handler if handler is not None else logging.StreamHandler()
+    if not handler.formatter:
+        handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    if interval > 0:
+        handler.addFilter(RateLimitFilter(interval))
+    logger = logging.getLogger(PREFIX)
+    logger.setLevel(level)
+    logger.addHandler(handler)
+    return handler
+
+
+METRICS = MetricsRegistry()  # shared by all modules of the application
@@ -0,0 +1,580 @@
+"""
+2D packing of boxes into the target area. The strategies keep the free space as lists of rectangles:
+
+- MaxRectsPacker: all maximal free rectangles. A placed box splits every free rectangle it overlaps,
+  free rectangles contained in others are pruned
+- SkylinePacker: the contour of the placed boxes, the space cut off below the contour is kept in a
+  MaxRects waste map which is tried as well
+
+Both score the two orientations of a box, a rotated placement is returned as BoxAction.ROTATE_90.
+
+    result = pack((Vec2(0, 0), Vec2(1200, 800)), boxes, strategy='skyline')
+    print(result.fill_ratio, result.positions())
+
+The bins have their origin in the top left corner like the target area, y points downwards
+"""
+from abc import ABC, abstractmethod
+from dataclasses import dataclass
+from typing import Dict, List, NamedTuple, Optional, Sequence, Tuple, Type
+
+import numpy as np
+
+from box import Box, BoxAction
+from util import Vec2
+
+MARGIN: float = 10  # distance of the boxes to each other and to the border of the area
+EPS: float = 1e-9  # tolerance of the comparisons of coordinates
+
+# Scoring of the free rectangles by MaxRectsPacker, the smallest score wins
+BEST_SHORT_SIDE_FIT = 'short_side'  # smallest leftover of the shorter side of the free rectangle
+BEST_AREA_FIT = 'area'  # smallest free rectangle
+TOP_LEFT = 'top_left'  # lowest bottom edge, then leftmost
+
+# Scoring of the positions on the skyline by SkylinePacker
+MIN_HEIGHT = 'min_height'  # lowest bottom edge, then narrowest segment
+MIN_WASTE = 'min_waste'  # least area cut off below the box, then lowest bottom edge
+
+
+class Candidate(NamedTuple):
+    """
+    position found for a box, not yet placed
+    """
+    x: float  # left edge in the bin
+    y: float  # top edge in the bin
+    width: float  # width after the rotation
+    height: float  # height after the rotation
+    rotated: bool  # whether the box is rotated by 90 degrees
+    score: Tuple[float, float]  # smaller is better, only comparable within one packer
+
+
+class Packer(ABC):
+    """
+    free space of a rectangular bin. `find` scores a box without changing the bin, `place` occupies the space
+    """
+    def __init__(self, width: float, height: float) -> None:
+        """
+        :param width: size of the bin along x
+        :param height: size of the bin along y
+        """
+        self.width = width
+        self.height = height
+        self.used_area = 0.0
+
+    @abstractmethod
+    def find(self, width: float, height: float, allow_rotation: bool = True) -> Optional[Candidate]:
+        """
+        best position of a box in both orientations
+        :param width: size of the box along x
+        :param height: size of the box along y
+        :param allow_rotation: whether the box may be rotated by 90 degrees
+        :return: None if the box does not fit
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def place(self, candidate: Candidate) -> None:
+        """
+        occupies the space of a candidate returned by `find`
+        :param candidate: the candidate
+        :return:
+        """
+        raise NotImplementedError
+
+    def insert(self, width: float, height: float, allow_rotation: bool = True) -> Optional[Candidate]:
+        """
+        finds and places a box
+        :param width: size of the box along x
+        :param height: size of the box along y
+        :param allow_rotation: whether the box may be rotated by 90 degrees
+        :return: the placement, None if the box does not fit
+        """
+        candidate = self.find(width, height, allow_rotation)
+        if candidate is not None:
+            self.place(candidate)
+        return candidate
+
+    def discard_smaller(self, side: float) -> None:
+        """
+        forgets free space no box can use any more
+        :param side: shorter side of the smallest box which is still to be placed
+        :return:
+        """
+        pass
+
+    @property
+    def occupancy(self) -> float:
+        """
+        occupied part of the bin
+        :return:
+        """
+        area = self.width * self.height
+        return self.used_area / area if area > 0 else 0.0
+
+
+def _orientations(width: float, height: float, allow_rotation: bool) -> List[Tuple[float, float, bool]]:
+    if allow_rotation and abs(width - height) > EPS:
+        return [(width, height, False), (height, width, True)]
+    return [(width, height, False)]
+
+
+def _contained(inner: np.ndarray, outer: np.ndarray) -> np.ndarray:
+    """
+    :param inner: (N, 4) x, y, width, height
+    :param outer: (M, 4) x, y, width, height
+    :return: (N, M) whether rectangle n lies within rectangle m
+    """
+    i = inner[:, np.newaxis, :]
+    o = outer[np.newaxis, :, :]
+    return ((o[..., 0] <= i[..., 0] + EPS) & (o[..., 1] <= i[..., 1] + EPS)
+            & (o[..., 0] + o[..., 2] >= i[..., 0] + i[..., 2] - EPS)
+            & (o[..., 1] + o[..., 3] >= i[..., 1] + i[..., 3] - EPS))
+
+
+class MaxRectsPacker(Packer):
+    """
+    maximal rectangles: the free space is the list of all free rectangles which are not contained in another one
+    """
+    def __init__(self, width: float, height: float, heuristic: str = BEST_SHORT_SIDE_FIT, empty: bool = False) -> None:
+        """
+        :param width: size of the bin along x
+        :param height: size of the bin along y
+        :param heuristic: BEST_SHORT_SIDE_FIT, BEST_AREA_FIT or TOP_LEFT
+        :param empty: start without free space, it is added with `add_free` (waste map of the skyline)
+        """
+        super().__init__(width, height)
+        if heuristic not in (BEST_SHORT_SIDE_FIT, BEST_AREA_FIT, TOP_LEFT):
+            raise ValueError(f"Unknown heuristic {heuristic}")
+        self.heuristic = heuristic
+        self.free = np.empty((0, 4)) if empty else np.array([[0.0, 0.0, width, height]])  # x, y, width, height
+
+    def find(self, width: float, height: float, allow_rotation: bool = True) -> Optional[Candidate]:
+        best = None
+        free = self.free
+        for w, h, rotated in _orientations(width, height, allow_rotation):
+            fits = np.flatnonzero((free[:, 2] >= w - EPS) & (free[:, 3] >= h - EPS))
+            if not len(fits):
+                continue
+            leftover_x = free[fits, 2] - w
+            leftover_y = free[fits, 3] - h
+            if self.heuristic == BEST_SHORT_SIDE_FIT:
+                primary = np.minimum(leftover_x, leftover_y)
+                secondary = np.maximum(leftover_x, leftover_y)
+            elif self.heuristic == BEST_AREA_FIT:
+                primary = free[fits, 2] * free[fits, 3] - w * h
+                secondary = np.minimum(leftover_x, leftover_y)
+            else:
+                primary = free[fits, 1] + h
+                secondary = free[fits, 0]
+            ties = np.flatnonzero(primary <= primary.min() + EPS)
+            k = ties[np.argmin(secondary[ties])]
+            score = (float(primary[k]), float(secondary[k]))
+            if best is None or score < best.score:
+                x, y = free[fits[k], :2].tolist()
+                best = Candidate(x, y, w, h, rotated, score)
+        return best
+
+    def place(self, candidate: Candidate) -> None:
+        x, y, w, h = candidate.x, candidate.y, candidate.width, candidate.height
+        right, bottom = x + w, y + h
+        free = self.free
+        hit = ((free[:, 0] < right - EPS) & (free[:, 0] + free[:, 2] > x + EPS)
+               & (free[:, 1] < bottom - EPS) & (free[:, 1] + free[:, 3] > y + EPS))
+
+        # Every overlapped free rectangle leaves up to four maximal rectangles around the box
+        split = []
+        for fx, fy, fw, fh in free[hit].tolist():
+            if x > fx + EPS:
+                split.append((fx, fy, x - fx, fh))
+            if right < fx + fw - EPS:
+                split.append((right, fy, fx + fw - right, fh))
+            if y > fy + EPS:
+                split.append((fx, fy, fw, y - fy))
+            if bottom < fy + fh - EPS:
+                split.append((fx, bottom, fw, fy + fh - bottom))
+        self.used_area += w * h
+        # The untouched rectangles cannot lie within the pieces of the split ones, which were maximal before
+        self.free = self._prune(free[~hit], np.array(split).reshape(-1, 4))
+
+    def add_free(self, rectangles: np.ndarray) -> None:
+        """
+        adds free rectangles, those contained in another free rectangle are pruned
+        :param rectangles: (N, 4) x, y, width, height
+        :return:
+        """
+        free = self.free
+        if len(free) and len(rectangles):
+            free = free[~_contained(free, rectangles).any(axis=1)]
+        self.free = self._prune(free, rectangles)
+
+    def discard_smaller(self, side: float) -> None:
+        free = self.free
+        self.free = free[(free[:, 2] >= side - EPS) & (free[:, 3] >= side - EPS)]
+
+    @staticmethod
+    def _prune(free: np.ndarray, rectangles: np.ndarray) -> np.ndarray:
+        """
+        :param free: (N, 4) maximal free rectangles
+        :param rectangles: (M, 4) new free rectangles
+        :return: the free rectangles and the new ones which are not contained in another one
+        """
+        if not len(rectangles):
+            return free
+        # Of identical new rectangles the first one is kept
+        inside = _contained(rectangles, np.concatenate([rectangles, free]))
+        new = inside[:, :len(rectangles)]  # a view, the corrections apply to `inside`
+        new &= ~new.T | np.tri(len(rectangles), k=-1, dtype=bool)
+        np.fill_diagonal(new, False)
+        return np.concatenate([free, rectangles[~inside.any(axis=1)]])
+
+
+class SkylinePacker(Packer):
+    """
+    skyline: boxes are placed on the contour of the already placed ones, the space cut off below a box
+    goes to a waste map (MaxRectsPacker) so it can still be used by smaller boxes
+    """
+    def __init__(self, width: float, height: float, heuristic: str = MIN_HEIGHT, waste_map: bool = True) -> None:
+        """
+        :param width: size of the bin along x
+        :param height: size of the bin along y
+        :param heuristic: MIN_HEIGHT or MIN_WASTE
+        :param waste_map: whether the space below the skyline is reused
+        """
+        super().__init__(width, height)
+        if heuristic not in (MIN_HEIGHT, MIN_WASTE):
+            raise ValueError(f"Unknown heuristic {heuristic}")
+        self.heuristic = heuristic
+        self.skyline: List[Tuple[float, float, float]] = [(0.0, 0.0, width)]  # x, top of the free space, width
+        self._segments = np.array(self.skyline)
+        self.waste = MaxRectsPacker(width, height, TOP_LEFT, empty=True) if waste_map else None
+
+    def _fits(self, width: float, height: float) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        positions of a box with its left edge at each segment of the skyline
+        :return: (mask of the segments where the box fits, top edge of the box, area cut off below the box)
+        """
+        x, y, w = self._segments.T
+        # covered[i, k]: segment k lies below the box whose left edge is at segment i
+        covered = (np.arange(len(x))[np.newaxis, :] >= np.arange(len(x))[:, np.newaxis]) & \
+            (x[np.newaxis, :] < x[:, np.newaxis] + width - EPS)
+        top = np.where(covered, y[np.newaxis, :], 0.0).max(axis=1)
+        overlap = np.minimum(x + w, (x + width)[:, np.newaxis]) - x[np.newaxis, :]
+        waste = np.where(covered, (top[:, np.newaxis] - y[np.newaxis, :]) * overlap, 0.0).sum(axis=1)
+        fits = (x + width <= self.width + EPS) & (top + height <= self.height + EPS)
+        return fits, top, waste
+
+    def find(self, width: float, height: float, allow_rotation: bool = True) -> Optional[Candidate]:
+        best = None
+        for w, h, rotated in _orientations(width, height, allow_rotation):
+            fits, top, waste = self._fits(w, h)
+            if not fits.any():
+                continue
+            if self.heuristic == MIN_HEIGHT:
+                primary, secondary = top + h, self._segments[:, 2]
+            else:
+                primary, secondary = waste, top + h
+            candidates = np.flatnonzero(fits)
+            ties = candidates[primary[candidates] <= primary[candidates].min() + EPS]
+            i = ties[np.argmin(secondary[ties])]
+            score = (float(primary[i]), float(secondary[i]))
+            if best is None or score < best.score:
+                best = Candidate(float(self._segments[i, 0]), float(top[i]), w, h, rotated, score)
+        if self.waste is not None:
+            # Space below the skyline: scored by its bottom edge, which is usually above the skyline
+            candidate = self.waste.find(width, height, allow_rotation)
+            if candidate is not None:
+                score = (candidate.y + candidate.height, 0.0) if self.heuristic == MIN_HEIGHT else (0.0, candidate.y + candidate.height)
+                if best is None or score <= best.score:
+                    best = candidate._replace(score=score)
+        return best
+
+    def discard_smaller(self, side: float) -> None:
+        if self.waste is not None:
+            self.waste.discard_smaller(side)
+
+    def place(self, candidate: Candidate) -> None:
+        x, y, w, h = candidate.x, candidate.y, candidate.width, candidate.height
+        self.used_area += w * h
+        if self.waste is not None and len(self.waste.free) and \
+                _contained(np.array([[x, y, w, h]]), self.waste.free).any():
+            self.waste.place(candidate)
+            return
+
+        right = x + w
+        skyline = []
+        waste = []
+        for sx, sy, sw in self.skyline:
+            if sx + sw <= x + EPS or sx >= right - EPS:
+                skyline.append((sx, sy, sw))
+                continue
+            if sx < x - EPS:
+                skyline.append((sx, sy, x - sx))
+            if not skyline or skyline[-1][0] != x:
+                skyline.append((x, y + h, w))
+            if sx + sw > right + EPS:
+                skyline.append((right, sy, sx + sw - right))
+            if y > sy + EPS:
+                start = max(sx, x)
+                waste.append((start, sy, min(sx + sw, right) - start, y - sy))
+
+        # Neighbouring segments of the same height are merged
+        merged = [skyline[0]]
+        for sx, sy, sw in skyline[1:]:
+            px, py, pw = merged[-1]
+            if abs(py - sy) <= EPS:
+                merged[-1] = (px, py, pw + sw)
+            else:
+                merged.append((sx, sy, sw))
+        self.skyline = merged
+        self._segments = np.array(merged)
+        if self.waste is not None and waste:
+            self.waste.add_free(np.array(waste))
+
+
+PACKERS: Dict[str, Type[Packer]] = {'maxrects': MaxRectsPacker, 'skyline': SkylinePacker}
+
+
+@dataclass(frozen=True)
+class Placement:
+    """
+    where a box goes in the target area
+    """
+    index: int  # position of the box in the list given to `pack`
+    x: float  # left edge in the target area
+    y: float  # top edge in the target area
+    width: float  # size along x after the rotation
+    height: float  # size along y after the rotation
+    action: BoxAction
+
+    @property
+    def center(self) -> Vec2:
+        return Vec2(self.x + self.width / 2, self.y + self.height / 2)
+
+
+@dataclass(frozen=True)
+class PackingResult:
+    """
+    result of `pack`, `placements` is ordered like the given boxes
+    """
+    target_area: Tuple[Vec2, Vec2]
+    placements: Tuple[Optional[Placement], ...]  # None for a box which did not fit
+    order: Tuple[int, ...]  # indices of the boxes in the order they were placed
+
+    @property
+    def placed(self) -> int:
+        return sum(p is not None for p in self.placements)
+
+    @property
+    def unplaced(self) -> List[int]:
+        """
+        indices of the boxes which did not fit and need another trip
+        :return:
+        """
+        return [i for i, p in enumerate(self.placements) if p is None]
+
+    @property
+    def used_area(self) -> float:
+        return sum(p.width * p.height for p in self.placements if p is not None)
+
+    @property
+    def fill_ratio(self) -> float:
+        """
+        covered part of the target area
+        :return:
+        """
+        origin, end = self.target_area
+        area = (end.x - origin.x) * (end.y - origin.y)
+        return self.used_area / area if area > 0 else 0.0
+
+    def positions(self) -> List[Optional[Tuple[Vec2, BoxAction]]]:
+        """
+        the placements in the format of `box.determine_positions_easy`
+        :return: (centre, action) of every box, None if it did not fit
+        """
+        return [(p.center, p.action) if p is not None else None for p in self.placements]
+
+
+def pack(target_area: Tuple[Vec2, Vec2],
+         boxes: Sequence[Box],
+         strategy: str = 'maxrects',
+         margin: float = MARGIN,
+         order: Optional[Sequence[int]] = None,
+         allow_rotation: bool = True,
+         **options) -> PackingResult:
+    """
+    places the boxes in the target area
+    :param target_area: (top left, bottom right) corners of the area
+    :param boxes: the boxes to place
+    :param strategy: name of the packer in PACKERS
+    :param margin: distance of the boxes to each other and to the border of the area
+    :param order: indices of the boxes in the order they are placed, by default by descending area
+    :param allow_rotation: whether boxes may be rotated by 90 degrees
+    :param options: passed to the packer, e.g. heuristic=BEST_AREA_FIT
+    :return: the placements
+    """
+    origin, end = target_area
+    # Every box claims its margin on the right and bottom side, the bin leaves it on the left and top side
+    packer = PACKERS[strategy](end.x - origin.x - margin, end.y - origin.y - margin, **options)
+    if order is None:
+        order = sorted(range(len(boxes)), key=lambda i: boxes[i].get_area(), reverse=True)
+
+    # Shorter side of the smallest box still to come, free space below it is dropped
+    smallest = [min(boxes[i].width, boxes[i].height) + margin for i in order]
+    for k in range(len(smallest) - 2, -1, -1):
+        smallest[k] = min(smallest[k], smallest[k + 1])
+
+    placements: List[Optional[Placement]] = [None] * len(boxes)
+    for k, i in enumerate(order):
+        box = boxes[i]
+        if k == 0 or smallest[k] > smallest[k - 1]:
+            packer.discard_smaller(smallest[k])
+        candidate = packer.insert(box.width + margin, box.height + margin, allow_rotation)
+        if candidate is not None:
+            placements[i] = _placement(i, candidate, origin, margin)
+    return PackingResult(target_area, tuple(placements), tuple(order))
+
+
+def _placement(index: int, candidate: Candidate, origin: Vec2, margin: float) -> Placement:
+    # The bin starts one margin inside the area and every box claims one margin on its right and bottom side
+    return Placement(index, origin.x + margin + candidate.x, origin.y + margin + candidate.y,
+                     candidate.width - margin, candidate.height - margin,
+                     BoxAction.ROTATE_90 if candidate.rotated else BoxAction.PLACE)
+
+
+class OnlinePlanner:
+    """
+    places boxes as they are revealed by the camera, without knowing the boxes to come. The free space of
+    the target area is kept between the calls, so the cost of a placement does not grow with the pallet.
+
+    With a lookahead buffer of k boxes, up to k revealed boxes are held back and the largest one which
+    fits is placed first, which comes close to placing all boxes sorted by size:
+
+        planner = OnlinePlanner(target_area, lookahead=3)
+        for box in revealed_boxes:
+            for placed in planner.push(box):
+                ...
+        for placed in planner.flush():
+            ...
+    """
+    def __init__(self,
+                 target_area: Tuple[Vec2, Vec2],
+                 strategy: str = 'maxrects',
+                 margin: float = MARGIN,
+                 lookahead: int = 0,
+                 allow_rotation: bool = True,
+                 **options) -> None:
+        """
+        :param target_area: (top left, bottom right) corners of the area
+        :param strategy: name of the packer in PACKERS
+        :param margin: distance of the boxes to each other and to the border of the area
+        :param lookahead: number of boxes which may be held back by `push`
+        :param allow_rotation: whether boxes may be rotated by 90 degrees
+        :param options: passed to the packer, e.g. heuristic=BEST_AREA_FIT
+        """
+        origin, end = target_area
+        self.target_area = target_area
+        self.margin = margin
+        self.lookahead = lookahead
+        self.allow_rotation = allow_rotation
+        self.packer = PACKERS[strategy](end.x - origin.x - margin, end.y - origin.y - margin, **options)
+        self.buffer: List[Tuple[int, Box]] = []  # (number of the box in arrival order, box) held back
+        self.placements: List[Placement] = []
+        self.rejected: List[int] = []  # numbers of the boxes which did not fit
+        self._arrived = 0
+
+    def _find(self, box: Box) -> Optional[Candidate]:
+        return self.packer.find(box.width + self.margin, box.height + self.margin, self.allow_rotation)
+
+    def _place(self, number: int, candidate: Candidate) -> Placement:
+        self.packer.place(candidate)
+        placement = _placement(number, candidate, self.target_area[0], self.margin)
+        self.placements.append(placement)
+        return placement
+
+    def place(self, box: Box) -> Optional[Tuple[Vec2, BoxAction]]:
+        """
+        places a box right away, bypassing the lookahead buffer
+        :param box: the box
+        :return: (centre, action), None if the box does not fit any more
+        """
+        number = self._arrived
+        self._arrived += 1
+        candidate = self._find(box)
+        if candidate is None:
+            self.rejected.append(number)
+            return None
+        placement = self._place(number, candidate)
+        return placement.center, placement.action
+
+    def push(self, box: Box) -> List[Tuple[Box, Placement]]:
+        """
+        adds a revealed box to the lookahead buffer, boxes are placed as soon as the buffer is over full
+        :param box: the box
+        :return: (box, placement) of the boxes placed by this call, usually one or none
+        """
+        self.buffer.append((self._arrived, box))
+        self._arrived += 1
+        placed = []
+        while len(self.buffer) > self.lookahead:
+            released = self._release()
+            if released is not None:
+                placed.append(released)
+        return placed
+
+    def flush(self) -> List[Tuple[Box, Placement]]:
+        """
+        places the boxes left in the buffer, e.g. at the end of a layer
+        :return: (box, placement) of the boxes placed
+        """
+        placed = []
+        while self.buffer:
+            released = self._release()
+            if released is not None:
+                placed.append(released)
+        return placed
+
+    def _release(self) -> Optional[Tuple[Box, Placement]]:
+        """
+        places the largest buffered box which fits (by its score on ties). The free space only shrinks,
+        so boxes which do not fit now never will and are rejected
+        :return: the placed box, None if no box of the buffer fits
+        """
+        best = None
+        fitting = []
+        for number, box in self.buffer:
+            candidate = self._find(box)
+            if candidate is None:
+                self.rejected.append(number)
+                continue
+            fitting.append((number, box))
+            key = (-box.get_area(), candidate.score)
+            if best is None or key < best[0]:
+                best = (key, len(fitting) - 1, candidate)
+        self.buffer = fitting
+        if best is None:
+            return None
+        number, box = self.buffer.pop(best[1])
+        return box, self._place(number, best[2])
+
+    @property
+    def fill_ratio(self) -> float:
+        """
+        covered part of the target area
+        :return:
+        """
+        origin, end = self.target_area
+        area = (end.x - origin.x) * (end.y - origin.y)
+        return sum(p.width * p.height for p in self.placements) / area if area > 0 else 0.0
+
+
+if __name__ == '__main__':
+    import random
+    import time
+
+    random.seed(1)
+    area = (Vec2(0, 0), Vec2(1200, 800))
+    sample = [Box(Vec2(0, 0), Vec2(random.randint(20, 80), random.randint(20, 80)), 20, 0) for _ in range(300)]
+    for name in PACKERS:
+        start = time.perf_counter()
+        result = pack(area, sample, name, margin=2)
+        elapsed = time.perf_counter() - start
+        print(f"{name}: {result.placed}/{len(sample)} boxes, fill ratio {result.fill_ratio:.3f}, {elapsed * 1000:.1f} ms")
@@ -0,0 +1,346 @@
+"""
+3D planning of a pallet over several layers. The pallet is a height map (highest surface per cell),
+boxes are put down at "extreme points": corners next to and on top of the placed boxes. The points
+are kept in a list sorted by (height, y, x), new points are inserted with bisect and points which were
+covered by a box are moved up lazily when they are reached. Points where not even the smallest remaining
+box fits any more (too close to the border or to a higher surface, or too high) are dropped, and every
+point remembers the box sizes which did not fit there until a box is put down within reach of it, so a
+search skips most points instead of checking each of them again.
+
+A position is only taken if the box rests on enough of its footprint (`min_support`), its centre lies
+over the supported part and it keeps `margin` to the sides of all higher boxes and to the border.
+
+    plan = plan_pallet((Vec2(0, 0), Vec2(1200, 800)), boxes, max_height=500)
+    print(plan.fill_ratio, plan.positions())
+
+Box.z_height is used as the height of a box, its surface height over ground in the pickup layer. A box
+without a height (z_height <= 0, e.g. measured without depth) still occupies its footprint, but as its
+top is unknown nothing is stacked on it
+"""
+import bisect
+import math
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Sequence, Set, Tuple
+
+import numpy as np
+
+from box import Box, BoxAction
+from util import Vec2, Vec3
+
+MARGIN: float = 10  # distance of the boxes to each other and to the border of the area
+MAX_HEIGHT: float = 500  # mm, highest surface of the stack, leaves room below SAFETY_HEIGHT of the robot
+MIN_SUPPORT: float = 0.8  # part of the footprint of a box which has to rest on the layer below
+RESOLUTION: float = 5  # mm per cell of the height map
+HEIGHT_TOLERANCE: float = 2  # mm, surfaces differing less than this count as one level
+
+
+@dataclass(frozen=True)
+class Placement3D:
+    """
+    where a box goes on the pallet
+    """
+    index: int  # position of the box in the list given to `plan_pallet`
+    x: float  # left edge in the target area
+    y: float  # top edge in the target area
+    z: float  # height of the surface the box is put on
+    width: float  # size along x after the rotation
+    height: float  # size along y after the rotation
+    z_height: float  # height of the box
+    support: float  # part of the footprint resting on the surface below
+    action: BoxAction
+
+    @property
+    def center(self) -> Vec2:
+        return Vec2(self.x + self.width / 2, self.y + self.height / 2)
+
+    @property
+    def top_center(self) -> Vec3:
+        """
+        centre of the top surface, where the gripper releases the box
+        :return:
+        """
+        return Vec3(self.x + self.width / 2, self.y + self.height / 2, self.z + self.z_height)
+
+
+class PalletPlanner3D:
+    """
+    places boxes one after another on the height map of the pallet
+    """
+    def __init__(self,
+                 target_area: Tuple[Vec2, Vec2],
+                 max_height: float = MAX_HEIGHT,
+                 margin: float = MARGIN,
+                 min_support: float = MIN_SUPPORT,
+                 resolution: float = RESOLUTION) -> None:
+        """
+        :param target_area: (top left, bottom right) corners of the pallet
+        :param max_height: highest allowed surface of the stack
+        :param margin: distance of the boxes to each other and to the border of the area
+        :param min_support: part of the footprint of a box which has to rest on the surface below
+        :param resolution: mm per cell of the height map, box sizes are rounded up to full cells
+        """
+        self.target_area = target_area
+        self.max_height = max_height
+        self.margin = margin
+        self.min_support = min_support
+        self.resolution = resolution
+
+        origin, end = target_area
+        self._margin_cells = math.ceil(margin / resolution - 1e-9)
+        # Highest surface per cell, infinite under boxes without a height
+        self.height_map = np.zeros((int((end.y - origin.y) // resolution), int((end.x - origin.x) // resolution)))
+        self.placements: List[Placement3D] = []
+        self.used_volume = 0.0
+        # Extreme points as (surface height, row, column), sorted, and the (row, column) of the contained points
+        self._points: List[Tuple[float, int, int]] = []
+        self._positions: Set[Tuple[int, int]] = set()
+        # (rows, columns, box height) which did not fit at a point, valid until the height map changes nearby
+        self._failed: Dict[Tuple[int, int], Set[Tuple[int, int, float]]] = {}
+        self._largest = 0  # longest side in cells of all checked footprints
+        self._smallest = 1  # shorter side in cells of the smallest box still to come, see discard_smaller
+        self._lowest = 0.0  # height of the lowest box still to come
+        self._add_point(self._margin_cells, self._margin_cells)
+
+    def _cells(self, size: float) -> int:
+        return math.ceil(size / self.resolution - 1e-9)
+
+    def _add_point(self, row: int, col: int) -> None:
+        rows, cols = self.height_map.shape
+        if row >= rows - self._margin_cells or col >= cols - self._margin_cells or (row, col) in self._positions:
+            return
+        z = float(self.height_map[row, col])
+        if z < self.max_height and not self._dead(z, row, col):
+            bisect.insort(self._points, (z, row, col))
+            self._positions.add((row, col))
+
+    def _remove(self, k: int) -> None:
+        _, row, col = self._points.pop(k)
+        self._positions.discard((row, col))
+        self._failed.pop((row, col), None)
+
+    def _dead(self, z: float, row: int, col: int) -> bool:
+        """
+        whether no box still to come can be put down at the point, ever: boxes only make the surfaces higher
+        :return:
+        """
+        m = self._margin_cells
+        side = self._smallest
+        map_rows, map_cols = self.height_map.shape
+        if z + self._lowest > self.max_height + 1e-9 or row + side > map_rows - m or col + side > map_cols - m:
+            return True
+        # A box rests on the point, so a higher surface within the margin of its first row or column blocks it
+        level = z + 2 * HEIGHT_TOLERANCE
+        return (self.height_map[max(row - m, 0):row + m + 1, col:col + side + m].max() > level or
+                self.height_map[row:row + side + m, max(col - m, 0):col + m + 1].max() > level)
+
+    def discard_smaller(self, side: float, z_height: float) -> None:
+        """
+        forgets the points no box can use any more
+        :param side: shorter side of the smallest box which is still to be placed
+        :param z_height: height of the lowest box which is still to be placed
+        :return:
+        """
+        self._smallest = max(self._cells(side), 1)
+        self._lowest = z_height
+        for k in range(len(self._points) - 1, -1, -1):
+            z, row, col = self._points[k]
+            if float(self.height_map[row, col]) == z and self._dead(z, row, col):
+                self._remove(k)
+
+    def _check(self, row: int, col: int, rows: int, cols: int, z_height: float) -> Optional[Tuple[float, float]]:
+        """
+        whether a box with its top left corner at the cell can be put down there
+        :return: (height of the surface, supported part of the footprint), None if it can not
+        """
+        m = self._margin_cells
+        map_rows, map_cols = self.height_map.shape
+        if row + rows > map_rows - m or col + cols > map_cols - m:
+            return None
+        footprint = self.height_map[row:row + rows, col:col + cols]
+        z = float(footprint.max())
+        # The corner at the point has to rest on the surface
+        if z + z_height > self.max_height + 1e-9 or footprint[0, 0] < z - HEIGHT_TOLERANCE:
+            return None
+        # No higher box within the margin around the footprint
+        if self.height_map[max(row - m, 0):row + rows + m, max(col - m, 0):col + cols + m].max() > z + HEIGHT_TOLERANCE:
+            return None
+        supported = footprint >= z - HEIGHT_TOLERANCE
+        support = float(supported.mean())
+        if support < self.min_support:
+            return None
+        # The centre of the box has to lie over the supported part (its bounding box)
+        supported_rows = np.flatnonzero(supported.any(axis=1))
+        supported_cols = np.flatnonzero(supported.any(axis=0))
+        if not (supported_rows[0] <= rows / 2 <= supported_rows[-1] + 1 and
+                supported_cols[0] <= cols / 2 <= supported_cols[-1] + 1):
+            return None
+        return z, support
+
+    def find(self, box: Box, allow_rotation: bool = True) -> Optional[Tuple[int, int, int, int, float, float, bool]]:
+        """
+        first extreme point (lowest, then top left) where the box can be put down
+        :param box: the box
+        :param allow_rotation: whether the box may be rotated by 90 degrees
+        :return: (row, column, rows, columns, surface height, support, rotated), None if the box does not fit
+        """
+        orientations = [(self._cells(box.height), self._cells(box.width), False)]
+        if allow_rotation and orientations[0][0] != orientations[0][1]:
+            orientations.append((orientations[0][1], orientations[0][0], True))
+        self._largest = max(self._largest, *orientations[0][:2])
+
+        k = 0
+        while k < len(self._points):
+            z, row, col = self._points[k]
+            current = float(self.height_map[row, col])
+            if current != z:
+                # Covered by a box since it was added, the point moves up to the new surface
+                self._remove(k)
+                self._add_point(row, col)
+                continue
+            failed = self._failed.setdefault((row, col), set())
+            checked = False
+            best = None
+            for rows, cols, rotated in orientations:
+                if (rows, cols, box.z_height) in failed:
+                    continue
+                checked = True
+                fit = self._check(row, col, rows, cols, box.z_height)
+                if fit is None:
+                    failed.add((rows, cols, box.z_height))
+                elif best is None or (fit[0], -fit[1]) < (best[4], -best[5]):
+                    best = (row, col, rows, cols, fit[0], fit[1], rotated)
+            if best is not None:
+                return best
+            if checked and self._dead(z, row, col):
+                self._remove(k)
+                continue
+            k += 1
+        return None
+
+    def place(self, box: Box, index: int = -1, allow_rotation: bool = True) -> Optional[Placement3D]:
+        """
+        puts the box down at the first position where it can be placed
+        :param box: the box
+        :param index: stored in the placement, e.g. the position of the box in a list
+        :param allow_rotation: whether the box may be rotated by 90 degrees
+        :return: the placement, None if the box does not fit on the pallet
+        """
+        found = self.find(box, allow_rotation)
+        if found is None:
+            return None
+        row, col, rows, cols, z, support, rotated = found
+        self.height_map[row:row + rows, col:col + cols] = z + box.z_height if box.z_height > 0 else math.inf
+
+        # Sizes which did not fit at a point may fit now if the box lies within their footprint or margin
+        m = self._margin_cells
+        reach = self._largest + m
+        for (r, c), failed in self._failed.items():
+            if failed and row - reach < r < row + rows + m and col - reach < c < col + cols + m:
+                failed -= {size for size in failed if r > row - size[0] - m and c > col - size[1] - m}
+
+        # New extreme points: on top of the box and next to it along x and y, behind the margin
+        self._add_point(row, col)
+        self._add_point(row, col + cols + self._margin_cells)
+        self._add_point(row + rows + self._margin_cells, col)
+
+        origin = self.target_area[0]
+        width, height = (box.height, box.width) if rotated else (box.width, box.height)
+        placement = Placement3D(index, origin.x + col * self.resolution, origin.y + row * self.resolution, z,
+                                width, height, box.z_height, support,
+                                BoxAction.ROTATE_90 if rotated else BoxAction.PLACE)
+        self.placements.append(placement)
+        self.used_volume += box.get_volume()
+        return placement
+
+    @property
+    def layers(self) -> int:
+        """
+        number of different surface heights boxes were put on
+        :return:
+        """
+        return len({round(p.z / HEIGHT_TOLERANCE) for p in self.placements})
+
+    @property
+    def fill_ratio(self) -> float:
+        """
+        occupied part of the volume of the pallet up to `max_height`
+        :return:
+        """
+        origin, end = self.target_area
+        volume = (end.x - origin.x) * (end.y - origin.y) * self.max_height
+        return self.used_volume / volume if volume > 0 else 0.0
+
+
+@dataclass(frozen=True)
+class PalletPlan:
+    """
+    result of `plan_pallet`, `placements` is ordered like the given boxes
+    """
+    placements: Tuple[Optional[Placement3D], ...]  # None for a box which did not fit
+    order: Tuple[int, ...]  # indices of the boxes in the order they are put down
+    fill_ratio: float  # occupied part of the volume of the pallet
+    layers: int
+
+    @property
+    def unplaced(self) -> List[int]:
+        return [i for i, p in enumerate(self.placements) if p is None]
+
+    def positions(self) -> List[Optional[Tuple[Vec3, BoxAction]]]:
+        """
+        :return: (centre of the top surface, action) of every box, None if it did not fit
+        """
+        return [(p.top_center, p.action) if p is not None else None for p in self.placements]
+
+
+def plan_pallet(target_area: Tuple[Vec2, Vec2],
+                boxes: Sequence[Box],
+                max_height: float = MAX_HEIGHT,
+                order: Optional[Sequence[int]] = None,
+                allow_rotation: bool = True,
+                **options) -> PalletPlan:
+    """
+    places the boxes on the pallet over several layers
+    :param target_area: (top left, bottom right) corners of the pallet
+    :param boxes: the boxes to place
+    :param max_height: highest allowed surface of the stack
+    :param order: indices of the boxes in the order they are put down, by default by descending footprint,
+        then by descending height
+    :param allow_rotation: whether boxes may be rotated by 90 degrees
+    :param options: passed to PalletPlanner3D, e.g. min_support=0.9
+    :return: the plan
+    """
+    planner = PalletPlanner3D(target_area, max_height, **options)
+    if order is None:
+        order = sorted(range(len(boxes)), key=lambda i: (boxes[i].get_area(), boxes[i].z_height), reverse=True)
+    # Shorter side and height of the smallest box still to come, points below them are dropped
+    smallest = [(min(boxes[i].width, boxes[i].height), boxes[i].z_height) for i in order]
+    for k in range(len(smallest) - 2, -1, -1):
+        smallest[k] = (min(smallest[k][0], smallest[k + 1][0]), min(smallest[k][1], smallest[k + 1][1]))
+
+    placements: List[Optional[Placement3D]] = [None] * len(boxes)
+    for k, i in enumerate(order):
+        if k == 0 or smallest[k] != smallest[k - 1]:
+            planner.discard_smaller(*smallest[k])
+        placements[i] = planner.place(boxes[i], i, allow_rotation)
+    return PalletPlan(tuple(placements), tuple(order), planner.fill_ratio, planner.layers)
+
+
+if __name__ == '__main__':
+    import random
+    import time
+
+    random.seed(1)
+    area = (Vec2(0, 0), Vec2(1200, 800))
+    sample = [Box(Vec2(0, 0), Vec2(random.choice([200, 300, 400]), random.choice([200, 300])),
+                  random.choice([100, 150]), 0) for _ in range(60)]
+    start = time.perf_counter()
+    plan = plan_pallet(area, sample)
+    elapsed = time.perf_counter() - start
+    print(f"{len(sample) - len(plan.unplaced)}/{len(sample)} boxes on {plan.layers} layers, "
+          f"fill ratio {plan.fill_ratio:.3f}, {elapsed * 1000:.1f} ms")
+
+    # Boxes without a height (no depth measurement) must not be put on the same spot
+    flat = plan_pallet(area, [Box(Vec2(0, 0), Vec2(300, 200), 0, 0) for _ in range(5)])
+    corners = [(p.x, p.y) for p in flat.placements if p is not None]
+    assert len(set(corners)) == len(corners) == 5 and all(p.z == 0 for p in flat.placements), flat.placements
+    print(f"boxes without height: {corners}")
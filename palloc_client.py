@@ -0,0 +1,269 @@
+"""
+asyncio client for PALLOC, independent of the Tk application.
+Can be used by a headless cell to run the camera loop and to overlap
+image acquisition with robot motion, e.g.
+
+    async with PallocClient("172.16.1.142") as client:
+        await client.setup()
+        acquisition = asyncio.create_task(client.acquire())
+        ...  # move the robot
+        await acquisition
+        match_data, color_image = await client.locate_all()
+"""
+import asyncio
+import json
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, Iterable, List, Optional, Tuple
+
+from palloc_socket import JsonFrameDecoder, DEFAULT_BUFFER_SIZE
+from palloc_protocol import (PORT, ADJUST_EXPOSURE_MESSAGE, LOCATE_FIRST_MESSAGE, LOCATE_NEXT_MESSAGE,
+                             SETUP_MESSAGES, GET_MATCH_DATA_MESSAGE, GET_COLOR_IMAGE_MESSAGE, LOCATE_ERROR,
+                             JobPropertyCache, run_property_get_message)
+
+CONNECT_TIME_OUT: float = 5  # seconds to establish the connection
+REQUEST_TIME_OUT: float = 10  # seconds until a reply has to be received
+PIPELINE_DEPTH: int = 8  # requests in flight during locate_all
+READ_SIZE: int = 256 * 1024  # bytes read from the stream at once
+
+
+class PallocError(Exception):
+    """
+    raised if PALLOC answered with something unexpected
+    """
+
+
+class PallocClient:
+    def __init__(self,
+                 host: str,
+                 port: int = PORT,
+                 connect_timeout: float = CONNECT_TIME_OUT,
+                 request_timeout: float = REQUEST_TIME_OUT,
+                 pipeline_depth: int = PIPELINE_DEPTH) -> None:
+        """
+        creates a client, the connection is established on the first request and reused afterwards
+        :param host: IP address of the camera
+        :param port: PALLOC port
+        :param connect_timeout: seconds to establish the connection
+        :param request_timeout: default seconds to wait for a reply
+        :param pipeline_depth: maximum number of requests sent ahead of their replies
+        """
+        self.host = host
+        self.port = port
+        self.connect_timeout = connect_timeout
+        self.request_timeout = request_timeout
+        self.pipeline_depth = pipeline_depth
+
+        self._reader: Optional[asyncio.StreamReader] = None
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._decoder: Optional[JsonFrameDecoder] = None
+        self._lock = asyncio.Lock()  # one exchange at a time, replies are matched by order
+        self.generation = 0  # incremented with every established connection
+        self.job_properties = JobPropertyCache()
+
+    async def __aenter__(self) -> "PallocClient":
+        await self.connect()
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        await self.close()
+
+    @property
+    def connected(self) -> bool:
+        return self._writer is not None and not self._writer.is_closing()
+
+    async def connect(self) -> None:
+        """
+        establishes the connection if there is none
+        :return:
+        """
+        if self.connected:
+            return
+        self._reader, self._writer = await asyncio.wait_for(
+            asyncio.open_connection(self.host, self.port), self.connect_timeout)
+        self._decoder = JsonFrameDecoder(DEFAULT_BUFFER_SIZE)
+        self.generation += 1
+
+    async def close(self) -> None:
+        """
+        closes the connection, the next request connects again
+        :return:
+        """
+        writer = self._writer
+        self._reader = self._writer = self._decoder = None
+        if writer is not None:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except (ConnectionError, OSError):
+                pass
+
+    @asynccontextmanager
+    async def _exchanging(self) -> AsyncIterator[None]:
+        """
+        holds the connection for one exchange of requests and replies. If the exchange fails or its task is
+        cancelled midway, unread replies are left on the stream and could not be matched to the requests
+        anymore, so the connection is closed and the next request starts over with a new one
+        """
+        async with self._lock:
+            await self.connect()
+            try:
+                yield
+            except BaseException:
+                await self.close()
+                raise
+
+    async def request(self, message: str, timeout: Optional[float] = None) -> dict:
+        """
+        sends one message and waits for its reply
+        :param message: the JSON message
+        :param timeout: seconds to wait for the reply, defaults to `request_timeout`
+        :return: the decoded reply
+        """
+        replies = await self.request_many([message], timeout)
+        return replies[0]
+
+    async def request_many(self, messages: Iterable[str], timeout: Optional[float] = None) -> List[dict]:
+        """
+        sends the messages pipelined and returns the replies in the same order
+        :param messages: the JSON messages
+        :param timeout: seconds to wait for each reply, defaults to `request_timeout`
+        :return: the decoded replies
+        """
+        async with self._exchanging():
+            return await self._exchange(list(messages), timeout)
+
+    async def setup(self, messages: Iterable[str] = SETUP_MESSAGES) -> None:
+        """
+        configures the job, by default disables the checks which prevent mixed layers from being located
+        :param messages: the Job.Property.Set messages to send
+        :return:
+        """
+        await self.request_many(messages)
+
+    async def configure(self, timeout: Optional[float] = None) -> int:
+        """
+        makes sure the job is configured as `job_properties` desires. The configuration is read once
+        per connection and only the differing properties are written and read back. Raises PallocError
+        if PALLOC did not take a property, the next call tries again
+        :param timeout: seconds to wait for each reply
+        :return: number of properties written
+        """
+        async with self._exchanging():
+            if not self.job_properties.needs_sync(self.generation):
+                return 0
+            replies = await self._exchange(self.job_properties.read_messages(), timeout)
+            changes = self.job_properties.changes(replies)
+            if changes:
+                await self._exchange(self.job_properties.write_messages(changes), timeout)
+                # A rejected write leaves the old value, the configuration is verified again on the next call
+                replies = await self._exchange(self.job_properties.read_messages(changes), timeout)
+                rejected = self.job_properties.changes(replies, changes)
+                if rejected:
+                    raise PallocError(f"PALLOC did not accept the job properties {', '.join(rejected)}")
+            self.job_properties.mark_synced(self.generation, changes)
+            return len(changes)
+
+    async def acquire(self, timeout: Optional[float] = None) -> dict:
+        """
+        acquires a new image (and adjusts the exposure)
+        :param timeout: seconds to wait for the reply
+        :return: the reply of PALLOC
+        """
+        return await self.request(ADJUST_EXPOSURE_MESSAGE, timeout)
+
+    async def get_property(self, key: str, timeout: Optional[float] = None):
+        """
+        reads a property of the last run
+        :param key: name of the property, e.g. "depth_image"
+        :param timeout: seconds to wait for the reply
+        :return: the value of the property
+        """
+        reply = await self.request(run_property_get_message(key), timeout)
+        return reply.get("value", None)
+
+    async def locate_all(self, timeout: Optional[float] = None) -> Tuple[Dict[int, dict], Optional[str]]:
+        """
+        locates all objects in the last acquired image and fetches their match data
+        :param timeout: seconds to wait for each reply
+        :return: (match data by match number, base64 encoded colour image),
+                 an empty dict and None if nothing was located
+        """
+        async with self._exchanging():
+            return await self._locate_all(timeout)
+
+    async def _locate_all(self, timeout: Optional[float]) -> Tuple[Dict[int, dict], Optional[str]]:
+        locate_response, = await self._exchange([LOCATE_FIRST_MESSAGE], timeout)
+        if locate_response["name"] == LOCATE_ERROR:
+            return {}, None
+
+        match = locate_response["match"]
+        matches = locate_response["matches"]
+        messages = [GET_COLOR_IMAGE_MESSAGE, GET_MATCH_DATA_MESSAGE]
+        messages += [LOCATE_NEXT_MESSAGE, GET_MATCH_DATA_MESSAGE] * (matches - match)
+        replies = await self._exchange(messages, timeout)
+
+        color_image = replies[0].get("value", None)
+        if not color_image:
+            raise PallocError("Failed to fetch color image from PALLOC")
+
+        match_data = {}
+        for message, reply in zip(messages[1:], replies[1:]):
+            if message == LOCATE_NEXT_MESSAGE:
+                if reply["name"] == LOCATE_ERROR:
+                    raise PallocError(f"Located {match} of {matches} announced matches")
+                match = reply["match"]
+            else:
+                match_data[match] = reply.get("value", None)
+        return match_data, color_image
+
+    async def _exchange(self, messages: List[str], timeout: Optional[float]) -> List[dict]:
+        timeout = self.request_timeout if timeout is None else timeout
+        pending = deque(messages)
+        in_flight = 0
+        replies = []
+        while pending or in_flight:
+            batch = []
+            while pending and in_flight + len(batch) < self.pipeline_depth:
+                batch.append(pending.popleft())
+            if batch:
+                self._writer.write(''.join(batch).encode())
+                await self._writer.drain()
+                in_flight += len(batch)
+            frame = await asyncio.wait_for(self._read_frame(), timeout)
+            in_flight -= 1
+            replies.append(json.loads(frame))
+        return replies
+
+    async def _read_frame(self) -> bytes:
+        frame = self._decoder.next_frame()
+        while frame is None:
+            data = await self._reader.read(READ_SIZE)
+            if not data:
+                raise ConnectionError("Connection closed by PALLOC")
+            self._decoder.feed(data)
+            frame = self._decoder.next_frame()
+        return frame
+
+
+async def main(host: str, cycles: int, setup: bool) -> None:
+    # Headless camera loop: acquire and locate until stopped
+    async with PallocClient(host) as client:
+        for cycle in range(cycles):
+            if setup:
+                await client.configure()  # only talks to PALLOC after a reconnect
+            await client.acquire()
+            match_data, _ = await client.locate_all()
+            print(f"Cycle {cycle + 1}: located {len(match_data)} boxes")
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Run the PALLOC camera loop without GUI")
+    parser.add_argument("host", help="IP address of the camera")
+    parser.add_argument("--cycles", type=int, default=1, help="number of acquire/locate cycles")
+    parser.add_argument("--setup", action="store_true", help="verify the job configuration on every connection")
+    args = parser.parse_args()
+
+    asyncio.run(main(args.host, args.cycles, args.setup))
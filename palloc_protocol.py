@@ -0,0 +1,133 @@
+"""
+messages of the PALLOC network protocol,
+shared by the Tk application and the headless client
+"""
+import json
+from typing import Dict, Iterable, List, Optional
+
+PORT = 14158  # Port
+JOB = 1  # Job number
+ADJUST_EXPOSURE_MESSAGE = f'{{"name": "Job.Image.Acquire", "job": {JOB}}}'
+LOCATE_FIRST_MESSAGE = f'{{"name": "Run.Locate", "job": {JOB}}}'
+LOCATE_NEXT_MESSAGE = f'{{"name": "Run.Locate", "job": {JOB}, "match": "next"}}'
+
+# Job configuration which allows mixed layers to be located
+JOB_PROPERTIES = {f"locators[{JOB}].check_within_top_layer": 0,
+                  f"locators[{JOB}].allow_mixed_box_dimensions": 1,
+                  f"locators[{JOB}].check_overlap": 0,
+                  f"locators[{JOB}].top_layer_rotation_mode": 0}
+
+SETUP_MESSAGES = [json.dumps({"name": "Job.Property.Set", "key": key, "value": value})
+                  for key, value in JOB_PROPERTIES.items()]
+
+GET_MATCH_DATA_MESSAGE = f'{{"name": "Run.Property.Get", "key": "current_match"}}'
+GET_COLOR_IMAGE_MESSAGE = f'{{"name": "Run.Property.Get", "key": "color_image"}}'
+GET_DEPTH_IMAGE_MESSAGE = f'{{"name": "Run.Property.Get", "key": "depth_image"}}'
+
+LOCATE_ERROR = "Run.Locate.Error"  # name of the reply if no (more) objects were located
+
+
+def run_property_get_message(key: str) -> str:
+    """
+    builds a message reading a property of the last run
+    :param key: name of the property, e.g. "current_match"
+    :return:
+    """
+    return json.dumps({"name": "Run.Property.Get", "key": key})
+
+
+def job_property_get_message(key: str) -> str:
+    """
+    builds a message reading a property of the job
+    :param key: name of the property, e.g. "locators[1].check_overlap"
+    :return:
+    """
+    return json.dumps({"name": "Job.Property.Get", "key": key})
+
+
+def job_property_set_message(key: str, value) -> str:
+    """
+    builds a message changing a property of the job
+    :param key: name of the property, e.g. "locators[1].check_overlap"
+    :param value: new value of the property
+    :return:
+    """
+    return json.dumps({"name": "Job.Property.Set", "key": key, "value": value})
+
+
+def _same_value(actual, desired) -> bool:
+    # PALLOC may answer numbers as strings or booleans
+    if isinstance(actual, (bool, int, float, str)) and isinstance(desired, (bool, int, float)):
+        try:
+            return float(actual) == float(desired)
+        except ValueError:
+            return False
+    return actual == desired
+
+
+class JobPropertyCache:
+    """
+    desired job configuration and the connection it was last verified on.
+    The properties are lost when the camera restarts, so they are read back once per
+    connection (pipelined) and only the ones which differ are written. The written ones are
+    read again, the connection only counts as verified once the camera took all of them
+    """
+    def __init__(self, desired: Optional[Dict[str, object]] = None) -> None:
+        """
+        :param desired: property values by key, by default JOB_PROPERTIES
+        """
+        self.desired = dict(JOB_PROPERTIES if desired is None else desired)
+        self.verified_generation: Optional[int] = None  # connection generation of the last verification
+        self.written = 0  # properties written since the cache was created
+
+    def needs_sync(self, generation: int) -> bool:
+        """
+        whether the configuration has to be verified on this connection
+        :param generation: generation of the connection, changes with every new connection
+        :return:
+        """
+        return self.verified_generation != generation
+
+    def invalidate(self) -> None:
+        """
+        verify the configuration again on the next sync, e.g. after the job was changed by hand
+        :return:
+        """
+        self.verified_generation = None
+
+    def read_messages(self, keys: Optional[Iterable[str]] = None) -> List[str]:
+        """
+        messages reading the desired properties, to be sent pipelined
+        :param keys: only read these properties, by default all
+        :return:
+        """
+        return [job_property_get_message(key) for key in (self.desired if keys is None else keys)]
+
+    def changes(self, replies: List[dict], keys: Optional[Iterable[str]] = None) -> Dict[str, object]:
+        """
+        compares the replies of `read_messages` with the desired configuration
+        :param replies: the decoded replies in the order of `read_messages`
+        :param keys: the properties which were read, by default all
+        :return: the properties which have to be written, by key
+        """
+        keys = self.desired if keys is None else keys
+        return {key: self.desired[key] for key, reply in zip(keys, replies)
+                if "value" not in reply or not _same_value(reply["value"], self.desired[key])}
+
+    def write_messages(self, changes: Dict[str, object]) -> List[str]:
+        """
+        messages writing the changed properties, to be sent pipelined
+        :param changes: see `changes`
+        :return:
+        """
+        return [job_property_set_message(key, value) for key, value in changes.items()]
+
+    def mark_synced(self, generation: int, changes: Dict[str, object]) -> None:
+        """
+        records that the configuration is set on this connection, only once the written properties were read back
+        :param generation: generation of the connection
+        :param changes: the properties which were written
+        :return:
+        """
+        self.verified_generation = generation
+        self.written += len(changes)
@@ -0,0 +1,426 @@
+"""
+socket helpers for talking to PALLOC.
+PALLOC answers every request with exactly one JSON document and does not
+send any length prefix, so the end of a message is found by tracking the
+nesting depth of the document while the bytes come in.
+"""
+import re
+import socket
+import sys
+import time
+from threading import Condition, Thread
+from typing import Callable, Dict, Optional
+
+from metrics import METRICS
+
+DEFAULT_BUFFER_SIZE: int = 2 * 1024 * 1024  # large enough for a base64 colour image without growing
+MIN_RECEIVE_SIZE: int = 64 * 1024  # minimal free space handed to recv_into
+CONNECT_TIME_OUT: float = 3  # seconds to establish a connection
+READ_TIME_OUT: float = 10  # seconds until a reply has to be received
+KEEPALIVE_IDLE: int = 2  # seconds without traffic before the first keepalive probe
+KEEPALIVE_INTERVAL: int = 1  # seconds between keepalive probes
+KEEPALIVE_COUNT: int = 3  # unanswered probes until the connection is considered dead
+BACKOFF_INITIAL: float = 0.25  # seconds before the first reconnect attempt
+BACKOFF_MAX: float = 8  # maximal seconds between reconnect attempts
+
+# PallocConnection states
+DISCONNECTED = 'disconnected'  # not started yet
+CONNECTING = 'connecting'
+CONNECTED = 'connected'
+BACKOFF = 'backoff'  # the last attempt failed, waiting before the next one
+CLOSED = 'closed'
+
+_QUOTE = ord('"')
+_BACKSLASH = ord('\\')
+_OPENING = (ord('{'), ord('['))
+_STRUCTURAL = re.compile(rb'["{}\[\]]')  # characters relevant outside of strings
+_STRING_SPECIAL = re.compile(rb'["\\]')  # characters relevant inside of strings
+
+
+class JsonFrameDecoder:
+    """
+    incrementally splits a byte stream into complete JSON documents.
+
+    Received bytes are accumulated in a preallocated bytearray, every byte is scanned exactly once
+    and the scanning itself is done by the regex engine, so a long base64 string is skipped with a
+    single search instead of a python loop.
+    """
+    def __init__(self, buffer_size: int = DEFAULT_BUFFER_SIZE) -> None:
+        """
+        :param buffer_size: initial size of the receive buffer in bytes, it grows if a message does not fit
+        """
+        self._buffer = bytearray(buffer_size)
+        self._view = memoryview(self._buffer)
+        self._start = 0  # first byte of the document currently being received
+        self._end = 0  # end of the valid data in the buffer
+        self._scan = 0  # everything before this position was already scanned
+        self._depth = 0
+        self._in_string = False
+        self._escaped = False  # a backslash was the last byte of the previous chunk
+        self._frames = []  # (start, stop) of documents found but not yet taken
+
+    def writable(self, min_size: int = MIN_RECEIVE_SIZE) -> memoryview:
+        """
+        returns a view on the free part of the buffer with at least `min_size` bytes,
+        fill it (e.g. with socket.recv_into) and call `commit` afterwards
+        :param min_size: minimal number of free bytes
+        :return:
+        """
+        if len(self._buffer) - self._end < min_size:
+            self._make_room(min_size)
+        return self._view[self._end:]
+
+    def commit(self, size: int) -> None:
+        """
+        marks `size` bytes written to the view returned by `writable` as received
+        :param size: number of bytes written
+        :return:
+        """
+        self._end += size
+        self._find_frames()
+
+    def feed(self, data: bytes) -> None:
+        """
+        copies the given bytes into the buffer
+        :param data: received bytes
+        :return:
+        """
+        size = len(data)
+        self.writable(size)[:size] = data
+        self.commit(size)
+
+    def next_frame(self) -> Optional[bytes]:
+        """
+        returns the next complete JSON document or None if there is none yet
+        :return:
+        """
+        if not self._frames:
+            return None
+        start, stop = self._frames.pop(0)
+        frame = bytes(self._view[start:stop])
+        if not self._frames and self._depth == 0 and self._scan == self._end:
+            # nothing pending, restart at the beginning of the buffer
+            self._start = self._end = self._scan = 0
+        return frame
+
+    @property
+    def pending(self) -> int:
+        """
+        number of complete documents which can be taken with `next_frame`
+        :return:
+        """
+        return len(self._frames)
+
+    def _make_room(self, min_size: int) -> None:
+        # keep the documents not taken yet and the partial one
+        keep_from = self._frames[0][0] if self._frames else self._start
+        used = self._end - keep_from
+        if len(self._buffer) - used >= min_size and keep_from > 0:
+            # move the data to the front, a slice assignment of equal length is allowed with exports
+            self._buffer[:used] = self._buffer[keep_from:self._end]
+        else:
+            size = len(self._buffer)
+            while size - used < min_size:
+                size *= 2
+            buffer = bytearray(size)
+            buffer[:used] = self._view[keep_from:self._end]
+            self._view.release()
+            self._buffer = buffer
+            self._view = memoryview(buffer)
+        self._frames = [(start - keep_from, stop - keep_from) for start, stop in self._frames]
+        self._start -= keep_from
+        self._scan -= keep_from
+        self._end = used
+
+    def _find_frames(self) -> None:
+        buffer = self._buffer
+        pos = self._scan
+        end = self._end
+        if self._escaped and pos < end:
+            pos += 1
+            self._escaped = False
+
+        while pos < end:
+            if self._in_string:
+                match = _STRING_SPECIAL.search(buffer, pos, end)
+                if match is None:
+                    pos = end
+                    break
+                pos = match.start() + 1
+                if buffer[pos - 1] == _BACKSLASH:
+                    if pos == end:
+                        self._escaped = True
+                    else:
+                        pos += 1  # skip the escaped character
+                else:
+                    self._in_string = False
+            else:
+                match = _STRUCTURAL.search(buffer, pos, end)
+                if match is None:
+                    pos = end
+                    break
+                char = buffer[match.start()]
+                if self._depth == 0:
+                    self._start = match.start()  # skip whitespace between documents
+                pos = match.start() + 1
+                if char == _QUOTE:
+                    self._in_string = True
+                elif char in _OPENING:
+                    self._depth += 1
+                else:
+                    self._depth -= 1
+                    if self._depth == 0:
+                        self._frames.append((self._start, pos))
+                        self._start = pos
+        self._scan = min(pos, end)
+
+
+class JsonSocketReader:
+    """
+    reads complete JSON documents from a blocking socket,
+    returns as soon as the last byte of a document arrived
+    """
+    def __init__(self, sock: socket.socket, buffer_size: int = DEFAULT_BUFFER_SIZE) -> None:
+        """
+        :param sock: connected socket, its timeout applies to every read
+        :param buffer_size: initial size of the receive buffer
+        """
+        self.socket = sock
+        self.decoder = JsonFrameDecoder(buffer_size)
+
+    def read_message(self) -> bytes:
+        """
+        blocks until a complete JSON document was received
+        :return: the raw bytes of the document
+        """
+        frame = self.decoder.next_frame()
+        while frame is None:
+            received = self.socket.recv_into(self.decoder.writable())
+            if not received:
+                raise ConnectionError("Connection closed by PALLOC")
+            self.decoder.commit(received)
+            frame = self.decoder.next_frame()
+        return frame
+
+
+def enable_keepalive(sock: socket.socket,
+                     idle: int = KEEPALIVE_IDLE,
+                     interval: int = KEEPALIVE_INTERVAL,
+                     count: int = KEEPALIVE_COUNT) -> None:
+    """
+    lets the OS probe an idle connection, so a dead camera link is noticed after
+    about idle + interval * count seconds instead of the next read timing out
+    :param sock: the socket
+    :param idle: seconds without traffic before the first probe
+    :param interval: seconds between probes
+    :param count: unanswered probes until the connection is dropped
+    :return:
+    """
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    if sys.platform == 'win32':
+        sock.ioctl(socket.SIO_KEEPALIVE_VALS, (1, idle * 1000, interval * 1000))
+        return
+    for option, value in (('TCP_KEEPIDLE', idle), ('TCP_KEEPALIVE', idle),  # TCP_KEEPALIVE on macOS
+                          ('TCP_KEEPINTVL', interval), ('TCP_KEEPCNT', count)):
+        if hasattr(socket, option):
+            sock.setsockopt(socket.IPPROTO_TCP, getattr(socket, option), value)
+
+
+class PallocConnection:
+    """
+    connection to PALLOC which is kept open and re-established in a background thread.
+    Failed attempts are retried with exponential backoff, the current `state` can be
+    queried at any time without blocking, e.g. by the robot loop
+    """
+    def __init__(self,
+                 host: str,
+                 port: int,
+                 connect_timeout: float = CONNECT_TIME_OUT,
+                 read_timeout: float = READ_TIME_OUT,
+                 backoff_initial: float = BACKOFF_INITIAL,
+                 backoff_max: float = BACKOFF_MAX,
+                 buffer_size: int = DEFAULT_BUFFER_SIZE,
+                 listener: Optional[Callable[[str, Optional[Exception]], None]] = None) -> None:
+        """
+        :param host: IP address of the camera
+        :param port: PALLOC port
+        :param connect_timeout: seconds to establish a connection
+        :param read_timeout: seconds every read may block, the deadline for a reply
+        :param backoff_initial: seconds before the first reconnect attempt, doubled after every failure
+        :param backoff_max: maximal seconds between reconnect attempts
+        :param buffer_size: initial size of the receive buffer
+        :param listener: called with the new state and the error (if any) whenever the state changes,
+                         from the thread causing the change
+        """
+        self.host = host
+        self.port = port
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.backoff_initial = backoff_initial
+        self.backoff_max = backoff_max
+        self.buffer_size = buffer_size
+        self.listener = listener
+
+        self.state = DISCONNECTED
+        self.generation = 0  # incremented with every established connection
+        self.failures = 0  # failed attempts since the last established connection
+        self.last_error: Optional[Exception] = None
+        self.connected_since: Optional[float] = None
+        self.retry_at: Optional[float] = None  # time.monotonic() of the next attempt while in BACKOFF
+        self._socket: Optional['socket.socket'] = None
+        self._reader: Optional[JsonSocketReader] = None
+        self._condition = Condition()
+        self._thread: Optional[Thread] = None
+
+    @property
+    def connected(self) -> bool:
+        return self.state == CONNECTED
+
+    @property
+    def socket(self) -> Optional[socket.socket]:
+        """
+        the connected socket, None while there is no connection
+        :return:
+        """
+        with self._condition:
+            return self._socket
+
+    @property
+    def reader(self) -> Optional[JsonSocketReader]:
+        """
+        reader of the connected socket, None while there is no connection
+        :return:
+        """
+        with self._condition:
+            return self._reader
+
+    def health(self) -> Dict[str, object]:
+        """
+        snapshot of the connection state, never blocks on the network
+        :return: dict with state, generation, failures, last_error, connected_for and retry_in (seconds)
+        """
+        with self._condition:
+            now = time.monotonic()
+            return {'state': self.state,
+                    'generation': self.generation,
+                    'failures': self.failures,
+                    'last_error': repr(self.last_error) if self.last_error else None,
+                    'connected_for': now - self.connected_since if self.connected_since is not None else None,
+                    'retry_in': max(0.0, self.retry_at - now) if self.retry_at is not None else None}
+
+    def start(self) -> "PallocConnection":
+        """
+        starts connecting in the background
+        :return: self
+        """
+        with self._condition:
+            if self.state == CLOSED:
+                raise RuntimeError("PallocConnection is closed")
+            if self._thread is None:
+                self._thread = Thread(target=self._run, name="PallocConnection", daemon=True)
+                self._thread.start()
+        return self
+
+    def wait_connected(self, timeout: Optional[float] = None) -> bool:
+        """
+        waits until a connection is established
+        :param timeout: seconds to wait, 0 only checks, None waits as long as needed
+        :return: whether the connection is established, False once it is closed
+        """
+        with self._condition:
+            if self.state != CLOSED:
+                self.start()
+            return self._condition.wait_for(lambda: self.state in (CONNECTED, CLOSED), timeout) \
+                and self.state == CONNECTED
+
+    def reconnect(self, error: Optional[Exception] = None, sock: Optional['socket.socket'] = None) -> None:
+        """
+        drops the connection after a failed exchange, a new one is established in the background
+        :param error: the reason, kept as `last_error`
+        :param sock: the socket the exchange failed on, nothing happens if it was already replaced
+        :return:
+        """
+        with self._condition:
+            if self._socket is None or (sock is not None and sock is not self._socket):
+                return
+            self._close_socket()
+            self.last_error = error
+            METRICS.inc('reconnects')
+            self._set_state(CONNECTING, error)
+
+    def close(self) -> None:
+        """
+        closes the connection and stops reconnecting
+        :return:
+        """
+        with self._condition:
+            self._close_socket()
+            self._set_state(CLOSED, None)
+        if self._thread is not None:
+            self._thread.join(self.connect_timeout)
+
+    def _close_socket(self) -> None:
+        if self._socket is not None:
+            try:
+                self._socket.close()
+            except OSError:
+                pass
+        self._socket = None
+        self._reader = None
+        self.connected_since = None
+
+    def _set_state(self, state: str, error: Optional[Exception]) -> None:
+        # Called with the condition held
+        if state == self.state:
+            return
+        self.state = state
+        self._condition.notify_all()
+        if self.listener is not None:
+            self.listener(state, error)
+
+    def _connect(self) -> 'socket.socket':
+        sock = socket.create_connection((self.host, self.port), self.connect_timeout)
+        try:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)  # Do not hold back pipelined requests
+            enable_keepalive(sock)
+            sock.settimeout(self.read_timeout)
+        except OSError:
+            sock.close()
+            raise
+        return sock
+
+    def _run(self) -> None:
+        backoff = self.backoff_initial
+        while True:
+            with self._condition:
+                # Wait until the connection has to be (re-)established
+                self._condition.wait_for(lambda: self.state != CONNECTED)
+                if self.state == CLOSED:
+                    return
+                self._set_state(CONNECTING, None)
+            try:
+                with METRICS.time('connect'):
+                    sock = self._connect()
+            except OSError as e:
+                with self._condition:
+                    if self.state == CLOSED:
+                        return
+                    self.failures += 1
+                    self.last_error = e
+                    self.retry_at = time.monotonic() + backoff
+                    self._set_state(BACKOFF, e)
+                    self._condition.wait_for(lambda: self.state == CLOSED, backoff)
+                    self.retry_at = None
+                backoff = min(backoff * 2, self.backoff_max)
+                continue
+            with self._condition:
+                if self.state == CLOSED:
+                    sock.close()
+                    return
+                self._socket = sock
+                self._reader = JsonSocketReader(sock, self.buffer_size)
+                self.generation += 1
+                self.failures = 0
+                self.connected_since = time.monotonic()
+                self._set_state(CONNECTED, None)
+            backoff = self.backoff_initial
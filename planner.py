@@ -0,0 +1,201 @@
+"""
+search for the best placement plan within a time budget. No packing heuristic wins on every mix of boxes,
+so the packers of packing.py are run with several orderings of the boxes (volume, area, longest side,
+random restarts) and rotation policies, optionally in a process pool. The plan covering the largest part
+of the area wins, on a tie the one with the shorter robot travel (see sequencing.py).
+
+    with ProcessPoolExecutor() as executor:
+        found = search_plans(target_area, boxes, budget=0.5, executor=executor)
+    found.result.positions()
+
+The budget is wall-clock time, e.g. what is left of the current robot move
+"""
+import itertools
+import random
+import time
+from concurrent.futures import FIRST_COMPLETED, Executor, wait
+from dataclasses import dataclass
+from typing import Iterator, List, Optional, Sequence, Tuple
+
+from box import Box
+from packing import (BEST_AREA_FIT, BEST_SHORT_SIDE_FIT, MARGIN, MIN_HEIGHT, MIN_WASTE, TOP_LEFT,
+                     PackingResult, pack)
+from sequencing import PickSequencer, pickup_precedence
+from util import Vec2
+
+PLAN_BUDGET: float = 1.0  # s of wall-clock time for the search
+IN_FLIGHT: int = 8  # plans submitted to the executor at the same time
+ORDERINGS = ('volume', 'area', 'longest_side')  # deterministic orderings, 'random' is used for the restarts
+PACKERS = (('maxrects', BEST_SHORT_SIDE_FIT), ('maxrects', BEST_AREA_FIT), ('maxrects', TOP_LEFT),
+           ('skyline', MIN_HEIGHT), ('skyline', MIN_WASTE))  # (strategy, heuristic)
+
+
+@dataclass(frozen=True)
+class PlanConfig:
+    """
+    one variant of the search
+    """
+    strategy: str  # name of the packer, see packing.PACKERS
+    heuristic: str  # scoring of the packer
+    ordering: str  # one of ORDERINGS or 'random'
+    allow_rotation: bool = True
+    seed: int = 0  # of the random ordering
+
+
+def box_order(boxes: Sequence[Box], ordering: str, seed: int = 0) -> List[int]:
+    """
+    order in which the boxes are placed
+    :param boxes: the boxes
+    :param ordering: 'volume', 'area', 'longest_side' (all descending) or 'random'
+    :param seed: of the random ordering
+    :return: indices of the boxes
+    """
+    indices = list(range(len(boxes)))
+    if ordering == 'volume':
+        return sorted(indices, key=lambda i: boxes[i].get_volume(), reverse=True)
+    if ordering == 'area':
+        return sorted(indices, key=lambda i: boxes[i].get_area(), reverse=True)
+    if ordering == 'longest_side':
+        return sorted(indices, key=lambda i: (max(boxes[i].width, boxes[i].height), boxes[i].get_area()), reverse=True)
+    if ordering == 'random':
+        random.Random(seed).shuffle(indices)
+        return indices
+    raise ValueError(f"Unknown ordering {ordering}")
+
+
+def configs(restarts: bool = True) -> Iterator[PlanConfig]:
+    """
+    the variants in the order they are tried: all deterministic ones, then random restarts without end
+    :param restarts: whether random orderings follow
+    :return:
+    """
+    for ordering in ORDERINGS:
+        for allow_rotation in (True, False):
+            for strategy, heuristic in PACKERS:
+                yield PlanConfig(strategy, heuristic, ordering, allow_rotation)
+    if restarts:
+        for seed in itertools.count():
+            strategy, heuristic = PACKERS[seed % len(PACKERS)]
+            yield PlanConfig(strategy, heuristic, 'random', True, seed)
+
+
+def travel_time(boxes: Sequence[Box], result: PackingResult) -> float:
+    """
+    expected robot travel between the drop-offs and the next pickups, of the nearest neighbour order
+    :param boxes: the boxes
+    :param result: their placements
+    :return: s
+    """
+    placed = [i for i, p in enumerate(result.placements) if p is not None]
+    sequencer = PickSequencer([boxes[i] for i in placed], [result.placements[i].center for i in placed])
+    sequencer.add_precedence(pickup_precedence([boxes[i] for i in placed]))
+    return sequencer.travel(sequencer.nearest_neighbour())
+
+
+def evaluate(target_area: Tuple[Vec2, Vec2],
+             boxes: Sequence[Box],
+             config: PlanConfig,
+             margin: float = MARGIN) -> Tuple[PlanConfig, PackingResult, float]:
+    """
+    packs the boxes with one variant, runs in the worker processes
+    :param target_area: (top left, bottom right) corners of the area
+    :param boxes: the boxes to place
+    :param config: the variant
+    :param margin: distance of the boxes to each other and to the border of the area
+    :return: (config, placements, travel time)
+    """
+    result = pack(target_area, boxes, config.strategy, margin, box_order(boxes, config.ordering, config.seed),
+                  config.allow_rotation, heuristic=config.heuristic)
+    return config, result, travel_time(boxes, result)
+
+
+@dataclass(frozen=True)
+class SearchResult:
+    """
+    best plan of `search_plans`
+    """
+    config: PlanConfig
+    result: PackingResult
+    travel_time: float  # s, see travel_time
+    evaluated: int  # number of plans compared
+
+    @property
+    def fill_ratio(self) -> float:
+        return self.result.fill_ratio
+
+
+def _key(fill_ratio: float, travel: float) -> Tuple[float, float]:
+    return -round(fill_ratio, 9), travel
+
+
+def search_plans(target_area: Tuple[Vec2, Vec2],
+                 boxes: Sequence[Box],
+                 budget: float = PLAN_BUDGET,
+                 executor: Optional[Executor] = None,
+                 restarts: bool = True,
+                 margin: float = MARGIN,
+                 in_flight: int = IN_FLIGHT) -> SearchResult:
+    """
+    tries the variants until the budget is used up and returns the best plan. At least one plan is
+    evaluated, so a very small budget is exceeded by the time of one plan
+    :param target_area: (top left, bottom right) corners of the area
+    :param boxes: the boxes to place
+    :param budget: s of wall-clock time
+    :param executor: e.g. a ProcessPoolExecutor, the plans are evaluated one after another in this process if not given
+    :param restarts: whether random orderings are tried after the deterministic ones
+    :param margin: distance of the boxes to each other and to the border of the area
+    :param in_flight: plans submitted to the executor at the same time
+    :return: the best plan
+    """
+    deadline = time.monotonic() + budget
+    variants = configs(restarts)
+    best = None
+    evaluated = 0
+
+    def consider(config: PlanConfig, result: PackingResult, travel: float) -> None:
+        nonlocal best, evaluated
+        evaluated += 1
+        if best is None or _key(result.fill_ratio, travel) < _key(best[1].fill_ratio, best[2]):
+            best = (config, result, travel)
+
+    if executor is None:
+        for config in variants:
+            consider(*evaluate(target_area, boxes, config, margin))
+            if time.monotonic() >= deadline:
+                break
+    else:
+        pending = set()
+        for config in itertools.islice(variants, in_flight):
+            pending.add(executor.submit(evaluate, target_area, boxes, config, margin))
+        while pending:
+            timeout = None if best is None else max(deadline - time.monotonic(), 0)
+            done, pending = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+            for future in done:
+                consider(*future.result())
+            if time.monotonic() >= deadline:
+                # Plans already running in the workers finish, but are not waited for
+                for future in pending:
+                    future.cancel()
+                break
+            for config in itertools.islice(variants, len(done)):
+                pending.add(executor.submit(evaluate, target_area, boxes, config, margin))
+
+    config, result, travel = best
+    return SearchResult(config, result, travel, evaluated)
+
+
+if __name__ == '__main__':
+    from concurrent.futures import ProcessPoolExecutor
+
+    random.seed(1)
+    area = (Vec2(0, 0), Vec2(1200, 800))
+    sample = [Box(Vec2(random.uniform(200, 600), random.uniform(-300, 300)),
+                  Vec2(random.randint(80, 300), random.randint(80, 300)), random.choice([100, 150]), 0)
+              for _ in range(30)]
+    found = search_plans(area, sample, budget=0.5)
+    print(f"serial: {found.evaluated} plans, fill ratio {found.fill_ratio:.3f}, travel {found.travel_time:.1f} s, "
+          f"{found.config}")
+    with ProcessPoolExecutor() as pool:
+        found = search_plans(area, sample, budget=1.0, executor=pool)
+    print(f"pool: {found.evaluated} plans, fill ratio {found.fill_ratio:.3f}, travel {found.travel_time:.1f} s, "
+          f"{found.config}")
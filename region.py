@@ -0,0 +1,133 @@
+"""
+run-length encoded PALLOC regions. The runs are kept as delivered, a (packed) bitmask
+cropped to the bounding box of the region is only created if it is needed.
+Area, intersection and IoU are calculated from the runs, without any mask
+"""
+from typing import Optional, Tuple
+
+import numpy as np
+
+
+class RleRegion:
+    """
+    pixels of one region as horizontal runs: row y, first column x_start and last column x_stop (inclusive)
+    """
+    def __init__(self, segments_y, segments_x_start, segments_x_stop) -> None:
+        """
+        :param segments_y: y coordinate of each run
+        :param segments_x_start: first x coordinate of each run
+        :param segments_x_stop: last x coordinate of each run
+        """
+        y = np.asarray(segments_y)
+        x_start = np.asarray(segments_x_start)
+        x_stop = np.asarray(segments_x_stop)
+        if y.size > 1 and (np.any(y[1:] < y[:-1]) or np.any((y[1:] == y[:-1]) & (x_start[1:] < x_start[:-1]))):
+            order = np.lexsort((x_start, y))
+            y, x_start, x_stop = y[order], x_start[order], x_stop[order]
+        self.y = y
+        self.x_start = x_start
+        self.x_stop = x_stop
+        self._area: Optional[int] = None
+        self._mask: Optional[np.ndarray] = None
+
+    @classmethod
+    def from_region(cls, region: dict) -> "RleRegion":
+        """
+        :param region: PALLOC region, dict with segmentsY, segmentsXStart and segmentsXStop
+        :return:
+        """
+        return cls(region['segmentsY'], region['segmentsXStart'], region['segmentsXStop'])
+
+    def __len__(self) -> int:
+        return len(self.y)
+
+    @property
+    def lengths(self) -> np.ndarray:
+        return self.x_stop - self.x_start + 1
+
+    @property
+    def area(self) -> int:
+        """
+        number of pixels
+        :return:
+        """
+        if self._area is None:
+            self._area = int(self.lengths.sum()) if len(self) else 0
+        return self._area
+
+    @property
+    def bbox(self) -> Tuple[int, int, int, int]:
+        """
+        bounding box of the pixels
+        :return: (x_min, y_min, x_max, y_max), all inclusive
+        """
+        if not len(self):
+            return 0, 0, -1, -1
+        return (self.x_start.min().item(), self.y[0].item(), self.x_stop.max().item(), self.y[-1].item())
+
+    @property
+    def mask(self) -> np.ndarray:
+        """
+        the region as bitmask cropped to its bounding box, 8 pixels per byte along x (see np.packbits),
+        created on first use
+        :return: (height, ceil(width / 8)) uint8
+        """
+        if self._mask is None:
+            x_min, y_min, x_max, y_max = self.bbox
+            width = x_max - x_min + 1
+            # +1 / -1 at the start / behind the end of each run, the running sum is the mask
+            edges = np.zeros((y_max - y_min + 1, width + 1), dtype=np.int8)
+            np.add.at(edges, (self.y - y_min, self.x_start - x_min), 1)
+            np.add.at(edges, (self.y - y_min, self.x_stop - x_min + 1), -1)
+            mask = np.packbits(np.cumsum(edges[:, :width], axis=1, dtype=np.int16) > 0, axis=1)
+            mask.flags.writeable = False
+            self._mask = mask
+        return self._mask
+
+    def to_mask(self) -> np.ndarray:
+        """
+        the unpacked mask cropped to the bounding box
+        :return: (height, width) bool
+        """
+        x_min, _, x_max, _ = self.bbox
+        return np.unpackbits(self.mask, axis=1, count=x_max - x_min + 1).astype(bool)
+
+    def bbox_overlaps(self, other: "RleRegion") -> bool:
+        """
+        whether the bounding boxes of the regions overlap
+        :param other: the other region
+        :return:
+        """
+        a = self.bbox
+        b = other.bbox
+        return a[0] <= b[2] and b[0] <= a[2] and a[1] <= b[3] and b[1] <= a[3]
+
+    def intersection_area(self, other: "RleRegion") -> int:
+        """
+        number of pixels in both regions, calculated from the overlap of the runs in the same rows
+        :param other: the other region
+        :return:
+        """
+        if not len(self) or not len(other) or not self.bbox_overlaps(other):
+            return 0
+        # Runs of the other region in the same row as each run of this region
+        first = np.searchsorted(other.y, self.y, side='left')
+        last = np.searchsorted(other.y, self.y, side='right')
+        counts = last - first
+        if not counts.any():
+            return 0
+        mine = np.repeat(np.arange(len(self)), counts)
+        theirs = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts) + np.repeat(first, counts)
+        overlap = (np.minimum(self.x_stop[mine], other.x_stop[theirs])
+                   - np.maximum(self.x_start[mine], other.x_start[theirs]) + 1)
+        return int(np.clip(overlap, 0, None).sum())
+
+    def iou(self, other: "RleRegion") -> float:
+        """
+        intersection over union of the pixels of the regions
+        :param other: the other region
+        :return: 0 for two empty regions
+        """
+        intersection = self.intersection_area(other)
+        union = self.area + other.area - intersection
+        return intersection / union if union else 0.0
@@ -2,93 +2,62 @@
 #              It serves as a template for users to implement their own processing code.
 #              The script is designed to minimize dependencies.
 import tkinter as tk
-from tkinter import Toplevel, PhotoImage, Canvas
-import base64
-import datetime
+from tkinter import Toplevel, Canvas
+import math
 import os
 import socket
 import time
-import math
-import select
 import json
-from threading import Thread, current_thread
-from PIL import Image, ImageDraw, ImageTk, ImageColor # If the Pillow library is not installed, run the following command: "pip install pillow"
+import logging
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from threading import Lock, Thread, current_thread
+from PIL import Image, ImageDraw, ImageTk # If the Pillow library is not installed, run the following command: "pip install pillow"
 from box import Box
+from frame import ColorFrame, DepthFrame
+from checkpoint import CheckpointWriter, load_match_data, load_depth_frame
 from util import Vec2
+from palloc_socket import JsonSocketReader, PallocConnection, BACKOFF, CONNECTING, CONNECTED, CLOSED
+from vision import FramePipeline, FrameResult, rectangle_corners
+from tracking import LayerTracker
+from metrics import METRICS, configure_logging
+from palloc_protocol import (PORT, ADJUST_EXPOSURE_MESSAGE, LOCATE_FIRST_MESSAGE, LOCATE_NEXT_MESSAGE,
+                             GET_MATCH_DATA_MESSAGE, GET_COLOR_IMAGE_MESSAGE, GET_DEPTH_IMAGE_MESSAGE, LOCATE_ERROR,
+                             JobPropertyCache)
 
 # Configuration
 DEFAULT_IP_ADDRESS = '172.16.1.142'  # IP address
 DEFAULT_FILE_PATH = "/path/to/checkpoints"
-PORT = 14158  # Port
-JOB = 1  # Job number
-ADJUST_EXPOSURE_MESSAGE = f'{{"name": "Job.Image.Acquire", "job": {JOB}}}'
 ADJUST_EXPOSURE_ON = True  # Call AdjustExposure before Locate call
-LOCATE_FIRST_MESSAGE = f'{{"name": "Run.Locate", "job": {JOB}}}'
-LOCATE_NEXT_MESSAGE = f'{{"name": "Run.Locate", "job": {JOB}, "match": "next"}}'
-
-DISABLE_CHECK_WITHIN_TOP_LAYER_MESSAGE = f'{{"name": "Job.Property.Set", "key": "locators[{JOB}].check_within_top_layer", "value": 0}}'
-DISABLE_CHECK_COMMON_BOX_DIMENSIONS_MESSAGE = f'{{"name": "Job.Property.Set", "key": "locators[{JOB}].allow_mixed_box_dimensions", "value": 1}}'
-DISABLE_CHECK_OVERLAP_MESSAGE = f'{{"name": "Job.Property.Set", "key": "locators[{JOB}].check_overlap", "value": 0}}'
-DISABLE_GENERAL_ROTATION_MESSAGE = f'{{"name": "Job.Property.Set", "key": "locators[{JOB}].top_layer_rotation_mode", "value": 0}}'
-
-GET_MATCH_DATA_MESSAGE = f'{{"name": "Run.Property.Get", "key": "current_match"}}'
-GET_COLOR_IMAGE_MESSAGE = f'{{"name": "Run.Property.Get", "key": "color_image"}}'
-GET_DEPTH_IMAGE_MESSAGE = f'{{"name": "Run.Property.Get", "key": "depth_image"}}'
-TIME_OUT = 60  # Timeout in seconds
+CONNECT_TIME_OUT = 3  # Seconds to establish the connection, failed attempts are retried with backoff
+READ_TIME_OUT = 10  # Seconds until a reply has to be received
 DELAY = 100  # Delay in milliseconds between each Locate call
-BUFFER_SIZE = 1024  # Buffer size for socket communication
-
-def rotate_point(point, angle, origin=(0, 0)):
-    ox, oy = origin
-    px, py = point
-
-    qx = ox + math.cos(angle) * (px - ox) - math.sin(angle) * (py - oy)
-    qy = oy + math.sin(angle) * (px - ox) + math.cos(angle) * (py - oy)
-    return qx, qy
-
-def calculate_true_dimensions(coordinates):
-    # Calculate the centroid of the rectangle
-    centroid = calculate_centroid(coordinates)
-
-    # Calculate the rotation angle of the rectangle
-    dx = coordinates[1][0] - coordinates[0][0]
-    dy = coordinates[1][1] - coordinates[0][1]
-    rotation_angle = math.atan2(dy, dx)
-
-    # Rotate all points back to align with the coordinate axes
-    rotated_points = [rotate_point(p, -rotation_angle, centroid) for p in coordinates]
-
-    # Calculate the width and height from the rotated points
-    min_x = min(p[0] for p in rotated_points)
-    max_x = max(p[0] for p in rotated_points)
-    min_y = min(p[1] for p in rotated_points)
-    max_y = max(p[1] for p in rotated_points)
+PIPELINE_DEPTH = 8  # Requests in flight while fetching the matches, 1 disables pipelining
+RECEIVE_BUFFER_SIZE = 2 * 1024 * 1024  # Preallocated receive buffer, fits a colour image
+FIT_REGION_PIXELS = True  # Fit the rectangle around all region pixels of boxes without overlaps
+FIT_WORKERS = 0  # Fit the boxes of large layers in this many processes, 0 fits them in the processing thread
+FETCH_DEPTH = False  # Fetch the depth image of every frame and measure the height of the boxes
+DEPTH_SCALE = 1.0  # Millimetres per depth image unit
+GROUND_DEPTH = None  # Depth of the empty pallet in mm, the box heights are measured from it. None keeps the depth
+DEFAULT_BOX_Z = 0.0  # Height used for boxes without depth measurement
+TRACK_LAYER = True  # Reuse the fits of boxes which did not change since the last frame
+SKIP_UNCHANGED_LOCATE = False  # Do not locate again until a box is reported as moved (LayerTracker.invalidate)
+LOG_LEVEL = logging.INFO  # logging.DEBUG logs every message sent to and received from PALLOC
+METRICS_FILE = None  # Write the timers and counters (Prometheus text format) to this file every 10 s
+METRICS_PORT = None  # Serve the timers and counters on http://localhost:<port>/metrics
+TEXT_BOX_INTERVAL = 100  # Milliseconds between two updates of the text box
+CHECKPOINT_QUEUE_SIZE = 4  # Frames waiting to be written to disk
+CHECKPOINT_POLICY = 'drop_oldest'  # 'drop_oldest' never delays the acquisition, 'block' waits for the disk
+
+logger = logging.getLogger("palloc.app")
+
+
+class MalformedReply(Exception):
+    """
+    a reply of PALLOC could not be parsed or misses expected fields, the socket is out of sync
+    """
 
-    true_width = max_x - min_x
-    true_height = max_y - min_y
-
-    return true_width, true_height, rotation_angle
-
-def calculate_centroid(points):
-    x_coords = [p[0] for p in points]
-    y_coords = [p[1] for p in points]
-    centroid_x = sum(x_coords) / len(points)
-    centroid_y = sum(y_coords) / len(points)
-    return (centroid_x, centroid_y)
-
-def angle_from_centroid(point, centroid):
-    return math.atan2(point[1] - centroid[1], point[0] - centroid[0])
-
-def minimum_bounding_rectangle(points):
-    centroid = calculate_centroid(points)
-    points.sort(key=lambda p: angle_from_centroid(p, centroid))
-
-    min_x = min(p[0] for p in points)
-    max_x = max(p[0] for p in points)
-    min_y = min(p[1] for p in points)
-    max_y = max(p[1] for p in points)
-
-    return [(min_x, min_y), (max_x, min_y), (max_x, max_y), (min_x, max_y)]
 
 # Actual Program
 class App:
@@ -97,7 +66,9 @@ class App:
         self.master = master
         self.image_window = None
         self.image_label = None
-        self.first_run = True
+        self.photo = None  # PhotoImage of the colour image, reused for every frame
+        self.overlay_photo = None  # PhotoImage of the drawn matches, reused for every frame
+        self.job_properties = JobPropertyCache()  # verified once per connection
         self.master.title("Run PALLOC")
 
         self.run = tk.BooleanVar()
@@ -129,18 +100,29 @@ class App:
 
         self.text_box = tk.Text(self.frame)
         self.text_box.pack(fill=tk.BOTH, expand=True, side=tk.TOP)
+        self.text_queue = deque()  # lines written by the worker threads, shown by the Tk thread
+        self.master.after(TEXT_BOX_INTERVAL, self.update_text_box)
         self.loading = False # set to True later when loading from a file
+        self.reader = None  # JsonSocketReader of the current connection
+        self.connection = None  # PallocConnection, kept open and reconnected in the background
+        self.exchange_lock = Lock()  # held by the run_loop thread exchanging messages on the connection
 
-        self.bbox_overlaps = {}
-        self.pre_processed_corners = {}
-        self.calculated_boxes = {}
+        self.pipeline = None  # FramePipeline, created on first use
+        self.fit_executor = None  # created on first use if FIT_WORKERS is set
+        self.result = None  # FrameResult of the last processed frame
+        self.tracker = None  # LayerTracker of the live frames, created with the pipeline
+        self.checkpoint_writer = None  # created on the first checkpoint
+        METRICS.add_collector(self.collect_metrics)
 
     def get_boxes(self):
         boxes = []
-        for _, box in self.calculated_boxes:
+        if self.result is None:
+            return boxes
+        for box in self.result.boxes().values():
             center = Vec2(box['x'], box['y'])
             dimensions = Vec2(box['width'], box['height'])
-            boxes.append(Box(center, dimensions, box['z'], box['rotation']))
+            z = box['z'] if box['z'] is not None and not math.isnan(box['z']) else DEFAULT_BOX_Z
+            boxes.append(Box(center, dimensions, z, math.degrees(box['rotation'])))
         return boxes
 
     def toggle_run(self):
@@ -158,434 +140,402 @@ class App:
         self.thread.start()
 
     def print_to_text_box(self, text):
-        # Print text to GUI
-        self.text_box.insert(tk.END, text + '\n')
-        self.text_box.see(tk.END)  # Auto-scroll to the bottom
+        # Print text to GUI, can be called from any thread. Tk widgets are only touched by update_text_box
+        self.text_queue.append(text)
+
+    def update_text_box(self):
+        # Runs in the Tk thread: shows the queued lines at once
+        if self.text_queue:
+            lines = []
+            while self.text_queue:
+                lines.append(self.text_queue.popleft())
+            self.text_box.insert(tk.END, '\n'.join(lines) + '\n')
+            self.text_box.see(tk.END)  # Auto-scroll to the bottom
+        self.master.after(TEXT_BOX_INTERVAL, self.update_text_box)
+
+    def collect_metrics(self):
+        # Gauges of the connection, the checkpoint writer and the layer tracker, read on every export
+        gauges = {}
+        if self.connection is not None:
+            health = self.connection.health()
+            gauges['connection_up'] = int(self.connection.connected)
+            gauges['connection_generation'] = health['generation']
+            gauges['connection_failures'] = health['failures']
+        if self.checkpoint_writer is not None:
+            for key, value in self.checkpoint_writer.metrics().items():
+                gauges[f'checkpoints_{key}'] = value
+        if self.tracker is not None:
+            gauges['tracker_reused_boxes'] = self.tracker.reused
+            gauges['tracker_refitted_boxes'] = self.tracker.refitted
+        return gauges
 
     def connect(self, ip):
-        # Make a connection to PALLOC via network socket
-        my_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        my_socket.settimeout(TIME_OUT)
-        self.print_to_text_box("")  # Blank row
-        self.print_to_text_box("Attempting to establish connection...")
-        my_socket.connect((ip, PORT))
-        self.print_to_text_box("Connection established.")
-        return my_socket
-
-    def disconnect(self, my_socket):
-        # Disconnect the network socket
-        if my_socket:
-            my_socket.close()
+        # Managed connection to PALLOC, established and kept alive in the background
+        if self.connection is None or self.connection.host != ip or self.connection.state == CLOSED:
+            self.disconnect()
+            self.print_to_text_box("")  # Blank row
+            self.print_to_text_box("Attempting to establish connection...")
+            self.connection = PallocConnection(ip, PORT, CONNECT_TIME_OUT, READ_TIME_OUT,
+                                               buffer_size=RECEIVE_BUFFER_SIZE,
+                                               listener=self.connection_changed).start()
+        return self.connection
+
+    def connection_changed(self, state, error):
+        # Called by the connection whenever its state changes
+        if state == BACKOFF:
+            health = self.connection.health() if self.connection is not None else {}
+            self.print_to_text_box(f"Connection failed ({error}). Retrying in {health.get('retry_in') or 0:.1f} s...")
+        elif state == CONNECTING and error is not None:
+            self.print_to_text_box(f"Connection lost ({error}). Reconnecting...")
+        elif state == CONNECTED:
+            self.print_to_text_box("Connection established.")
+        elif state == CLOSED:
             self.print_to_text_box("Connection closed.")
-            my_socket = None
-
-    def setup_palloc(self, my_socket):
-        # Perform any setup needed for PALLOC
-        self.print_to_text_box("Fist image acquisition, do setup..")
-        self.send_and_receive(my_socket, DISABLE_CHECK_WITHIN_TOP_LAYER_MESSAGE)
-        self.send_and_receive(my_socket, DISABLE_CHECK_COMMON_BOX_DIMENSIONS_MESSAGE)
-        self.send_and_receive(my_socket, DISABLE_CHECK_OVERLAP_MESSAGE)
-        self.send_and_receive(my_socket, DISABLE_GENERAL_ROTATION_MESSAGE)
+
+    def disconnect(self):
+        # Close the connection to PALLOC
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+            self.reader = None
+
+    def setup_palloc(self, my_socket, generation):
+        # Perform any setup needed for PALLOC: read the job configuration at once and only write what differs
+        self.print_to_text_box("New connection, verify the job setup..")
+        replies = [reply for _, reply in self.send_pipelined(my_socket, self.job_properties.read_messages())]
+        changes = self.job_properties.changes(replies)
+        if changes:
+            for _ in self.send_pipelined(my_socket, self.job_properties.write_messages(changes)):
+                pass
+            # A rejected write leaves the old value, the setup is verified again in the next cycle
+            replies = [reply for _, reply in self.send_pipelined(my_socket, self.job_properties.read_messages(changes))]
+            rejected = self.job_properties.changes(replies, changes)
+            if rejected:
+                self.print_to_text_box(f"Job setup failed, PALLOC did not accept {', '.join(rejected)}")
+                logger.warning("Job properties not accepted by PALLOC: %s", rejected)
+                return
+        self.job_properties.mark_synced(generation, changes)
+        self.print_to_text_box(f"Job setup verified, {len(changes)} properties changed")
         self.print_to_text_box("")  # Blank row
 
     def run_loop(self, ip, run_once=False):
         # Thread running as long as the Run toggle is set.
+        # The connection stays open between runs, it is only closed with the App
+        connection = self.connect(ip)
         my_socket = None
         try:
             # Continuously sending messages to PALLOC
             while self.run.get() and current_thread() == self.thread or run_once:
                 self.run_once_button.config(state=tk.DISABLED)
-                try:
-                    if my_socket is None:
-                        my_socket = self.connect(ip)
-
-                    self.print_to_text_box("")  # Blank row
-                    if self.first_run:
-                        self.setup_palloc(my_socket)
-                        self.first_run = False
-                    self.print_to_text_box("Acquiring image and fetching data...")
-                    if ADJUST_EXPOSURE_ON:
-                        self.send_and_receive(my_socket, ADJUST_EXPOSURE_MESSAGE)
-                    self.fetch_palloc_data(my_socket)
-                except socket.timeout:
-                    self.print_to_text_box("Connection attempt abandoned due to timeout")
-                    self.disconnect(my_socket)
-                except (ConnectionRefusedError, ConnectionError):
-                    self.print_to_text_box("Connection failed. Retrying...")
-                    self.disconnect(my_socket)
-                    time.sleep(1)
-                else:
+                # Never block longer than the connect deadline, reconnecting continues in the background
+                if not connection.wait_connected(CONNECT_TIME_OUT):
+                    if connection.state == CLOSED:
+                        break  # Closed with the App, the next run connects again
+                    continue
+                # The replies are read in the order of the requests, so only one thread at a time may use the
+                # connection: a second run (Run toggled again, Run Once during a loop) waits for this cycle
+                done = False
+                with self.exchange_lock:
+                    try:
+                        generation = connection.generation  # read first, a newer socket only causes another check
+                        my_socket = connection.socket
+                        self.reader = connection.reader
+
+                        self.print_to_text_box("")  # Blank row
+                        if SKIP_UNCHANGED_LOCATE and self.tracker is not None and not self.tracker.needs_relocate():
+                            # Nothing was moved since the last cycle, its result is still valid
+                            self.tracker.reuse_last()
+                            self.print_to_text_box("Layer unchanged, skipped locating")
+                        else:
+                            if self.job_properties.needs_sync(generation):
+                                self.setup_palloc(my_socket, generation)
+                            self.print_to_text_box("Acquiring image and fetching data...")
+                            if ADJUST_EXPOSURE_ON:
+                                with METRICS.time('acquire'):
+                                    self.send_and_receive(my_socket, ADJUST_EXPOSURE_MESSAGE)
+                            self.fetch_palloc_data(my_socket)
+                    except socket.timeout as e:
+                        self.print_to_text_box(f"No reply within {READ_TIME_OUT} s")
+                        connection.reconnect(e, my_socket)
+                    except (ConnectionRefusedError, ConnectionError) as e:
+                        connection.reconnect(e, my_socket)
+                    except MalformedReply as e:
+                        # The replies of the requests still in flight would be read as answers to the next
+                        # requests, only a new socket is in sync again
+                        self.print_to_text_box(f"Failed to fetch data from PALLOC")
+                        logger.warning("%s", e)
+                        METRICS.inc('fetch_errors')
+                        connection.reconnect(e, my_socket)
+                    else:
+                        done = True
+                if done:
                     if run_once:
                         break
                     time.sleep(max(100, DELAY) / 1000)  # converting delay to seconds
-            else:
-                self.disconnect(my_socket)
         except (RuntimeError):
             # This exception might come after the window is closed...
-            # Cleanup and exit
-            if my_socket:
-                my_socket.close()
+            # Cleanup and exit, the next run connects again
+            if self.connection is connection:
+                self.disconnect()
+            else:
+                connection.close()
                 
         self.run_once_button.config(state=tk.NORMAL)
 
     def receive_data(self, my_socket):
-        data = b''
-        while True:
-            # Use select to check if data is available to read
-            ready = select.select([my_socket], [], [], 0.05)
-            if ready[0] or not data:
-                chunk = my_socket.recv(BUFFER_SIZE)
-                if not chunk:
-                    break
-                data += chunk
-            else:
-                break  # No data available, exit the loop
-        return data
-
-    def send_and_receive(self, my_socket, message, truncate_length=65):
-        self.print_to_text_box(f'Sending: {message}')
-        my_socket.sendall(message.encode())
+        # Read exactly one JSON document, returns as soon as its last byte arrived
+        if self.reader is None or self.reader.socket is not my_socket:
+            self.reader = JsonSocketReader(my_socket, RECEIVE_BUFFER_SIZE)
+        return self.reader.read_message()
+
+    def send_messages(self, my_socket, messages):
+        # Write several requests at once without waiting for the replies
+        if logger.isEnabledFor(logging.DEBUG):
+            for message in messages:
+                logger.debug("Sending: %s", message)
+        my_socket.sendall(''.join(messages).encode())
+
+    def receive_message(self, my_socket, truncate_length=65):
         feedback = self.receive_data(my_socket)
         feedback_str = feedback.decode('latin-1')  # Using 'latin-1' to avoid UnicodeDecodeError
         truncated_feedback = feedback_str if len(feedback_str) <= truncate_length else feedback_str[:truncate_length] + '...'
-        self.print_to_text_box(f"Received: {truncated_feedback}")
-        feedback_dict = json.loads(feedback_str)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Received: %s", truncated_feedback)
+        try:
+            feedback_dict = json.loads(feedback_str)
+        except json.JSONDecodeError as e:
+            raise MalformedReply(f"Malformed reply from PALLOC: {e}") from e
+        if not isinstance(feedback_dict, dict):
+            raise MalformedReply(f"Unexpected reply from PALLOC: {truncated_feedback}")
         return feedback_dict
-    
-    def draw_rotated_rectangle(self, draw, x, y, width, height, rotation, outline="red", width_line=3):
-        # Calculate the coordinates of the corners based on the center point
-        corners = [
-            (x - width / 2, y - height / 2),  # Top-left corner
-            (x + width / 2, y - height / 2),  # Top-right corner
-            (x + width / 2, y + height / 2),  # Bottom-right corner
-            (x - width / 2, y + height / 2)   # Bottom-left corner
-        ]
-        
-        # Apply rotation to each corner
-        rotated_corners = []
-        for corner in corners:
-            dx = corner[0] - x
-            dy = corner[1] - y
-            new_x = x + (dx * math.cos(rotation) - dy * math.sin(rotation))
-            new_y = y + (dx * math.sin(rotation) + dy * math.cos(rotation))
-            rotated_corners.append((new_x, new_y))
-
-        # Draw the rotated rectangle as a polygon without filling
-        draw.polygon(rotated_corners, outline=outline, width=width_line)
-
-    def show_image(self, match_data, base64_image_data):
-        # Decode the base64 image data
-        image_data = base64.b64decode(base64_image_data)
-        
-        # Create a PhotoImage object
-        photo = PhotoImage(data=base64_image_data)
 
+    def send_and_receive(self, my_socket, message, truncate_length=65):
+        self.send_messages(my_socket, [message])
+        return self.receive_message(my_socket, truncate_length)
+
+    def send_pipelined(self, my_socket, messages, depth=PIPELINE_DEPTH):
+        """
+        sends the messages while keeping up to `depth` requests in flight and yields the replies in request order
+        :param my_socket: connected PALLOC socket
+        :param messages: iterable of the messages to send
+        :param depth: maximum number of requests sent without having received their reply
+        :return: generator of (message, reply) tuples
+        """
+        messages = iter(messages)
+        in_flight = deque()
+        try:
+            while True:
+                batch = []
+                while len(in_flight) + len(batch) < depth:
+                    message = next(messages, None)
+                    if message is None:
+                        break
+                    batch.append(message)
+                if batch:
+                    self.send_messages(my_socket, batch)
+                    in_flight.extend(batch)
+                if not in_flight:
+                    return
+                message = in_flight[0]
+                reply = self.receive_message(my_socket)
+                in_flight.popleft()
+                yield message, reply
+        except GeneratorExit:
+            # The caller stopped early, consume the outstanding replies to keep the socket in sync
+            try:
+                while in_flight:
+                    self.receive_data(my_socket)
+                    in_flight.popleft()
+            except OSError:
+                pass  # the socket is broken anyway, the caller reconnects
+            raise
+    
+    def show_image(self, result: FrameResult, color_frame):
+        size = color_frame.size
         if self.image_window is None or not self.image_window.winfo_exists():
             # Create a new window if it doesn't exist
             self.image_window = Toplevel(self.master)
             self.image_window.title("PALLOC Image")
 
-            # Create a Canvas to display the image and draw rectangles
-            self.canvas = Canvas(self.image_window, width=photo.width(), height=photo.height())
+            # Create a Canvas to display the image and draw rectangles, the images are reused for every frame
+            self.photo = None
+            self.overlay_photo = None
+            self.canvas = Canvas(self.image_window, width=size[0], height=size[1])
             self.canvas.pack()
+            self.image_item = self.canvas.create_image(0, 0, anchor=tk.NW)
+            self.overlay_item = self.canvas.create_image(0, 0, anchor=tk.NW)
 
-        # Display the image on the Canvas
-        self.canvas.create_image(0, 0, anchor=tk.NW, image=photo)
-        self.canvas.image = photo  # Keep a reference to avoid garbage collection
+        # Display the already decoded frame, the PhotoImage is only recreated if the frame size changed
+        if self.photo is None or (self.photo.width(), self.photo.height()) != size:
+            self.photo = ImageTk.PhotoImage(color_frame.image)
+            self.canvas.itemconfig(self.image_item, image=self.photo)
+            self.canvas.config(width=size[0], height=size[1])
+        else:
+            self.photo.paste(color_frame.image)
 
         # Define a list of colors to cycle through
         colors = ["red", "green", "blue", "orange", "purple", "cyan", "magenta", "yellow", "brown", "pink"]
-        
-        # Create a new image with the same size as the canvas
-        canvas_image = Image.new("RGBA", (photo.width(), photo.height()), (0, 0, 0, 0))
 
-        # Draw rectangles and regions for each match
-        for match_id, match_info in match_data.items():
-            # Create a temporary image for blending each region
-            match_id = int(match_id)  # somehow the json dumping and loading screws up on this key
-            temp_image = Image.new("RGBA", (photo.width(), photo.height()), (0, 0, 0, 0))
-            temp_draw = ImageDraw.Draw(temp_image, "RGBA")
+        # Draw all matches onto one transparent overlay
+        overlay = Image.new("RGBA", size, (0, 0, 0, 0))
+        draw = ImageDraw.Draw(overlay, "RGBA")
+
+        # Calculate the corners of all rotated rectangles at once
+        polygons = rectangle_corners(result.centres, result.widths, result.heights, result.rotations)
 
+        # Draw rectangles and corners for each match
+        for match_id, polygon, coordinates in zip(result.match_ids, polygons.tolist(), result.corners.tolist()):
             # Select a color based on the match_id
             color = colors[(match_id - 1) % len(colors)]
-            rgba_color = ImageColor.getrgb(color) + (100,)  # Convert to RGBA with alpha
-
-            bbox = match_info["bbox"]["rectangle"]
-            x = bbox["x"]
-            y = bbox["y"]
-            # TODO: maybe delete the following line
-            bbox = self.calculated_boxes[match_id]
-            width = bbox["width"]
-            height = bbox["height"]
-            rotation = bbox["rotation"]
-            self.draw_rotated_rectangle(temp_draw, x, y, width, height, rotation, outline=color)
-            # Draw regions for each match
-            region = match_info["bbox"]["region"]
-            coordinates = self.pre_processed_corners[match_id]
-            temp_draw.circle(coordinates[0], radius=3, fill='black', width=3) 
-            temp_draw.circle(coordinates[1], radius=3, fill='red', width=3)
-            temp_draw.circle(coordinates[2], radius=3, fill='blue', width=3)
-            temp_draw.circle(coordinates[3], radius=3, fill='yellow', width=3)
-
-            canvas_image = Image.alpha_composite(canvas_image, temp_image)
-
-        # Convert the canvas image to PhotoImage and display it
-        overlay_image = ImageTk.PhotoImage(canvas_image)
-        self.canvas.create_image(0, 0, anchor=tk.NW, image=overlay_image)
-        self.canvas.overlay_image = overlay_image  # Keep a reference to avoid garbage collection
+
+            # Draw the rotated rectangle as a polygon without filling
+            draw.polygon([tuple(corner) for corner in polygon], outline=color, width=3)
+            draw.circle(coordinates[0], radius=3, fill='black', width=3)
+            draw.circle(coordinates[1], radius=3, fill='red', width=3)
+            draw.circle(coordinates[2], radius=3, fill='blue', width=3)
+            draw.circle(coordinates[3], radius=3, fill='yellow', width=3)
+
+        # Show the overlay, the PhotoImage is only recreated if the frame size changed
+        if self.overlay_photo is None or (self.overlay_photo.width(), self.overlay_photo.height()) != size:
+            self.overlay_photo = ImageTk.PhotoImage(overlay)
+            self.canvas.itemconfig(self.overlay_item, image=self.overlay_photo)
+        else:
+            self.overlay_photo.paste(overlay)
 
     def fetch_palloc_data(self, my_socket):
         # Fetch data from PALLOC
-        first = True
         match_data = dict()
+        depth_frame = None
 
-        while True:
-            try:
-                if first:
-                    locate_message = LOCATE_FIRST_MESSAGE
-                else:
-                    locate_message = LOCATE_NEXT_MESSAGE
-
-                # Fetch data from PALLOC
-                locate_response = self.send_and_receive(my_socket, locate_message)
-                replay = locate_response["name"]
+        replies = None
+        try:
+            with METRICS.time('locate'):
+                locate_response = self.send_and_receive(my_socket, LOCATE_FIRST_MESSAGE)
+            if locate_response["name"] == LOCATE_ERROR:
+                self.print_to_text_box(f"Could not locate any objects in the image!")
+                return
 
-                if replay == "Run.Locate.Error":
-                    self.print_to_text_box(f"Could not locate any objects in the image!")
-                    return
+            match = locate_response["match"]
+            matches = locate_response["matches"]
 
-                match = locate_response["match"]
-                matches = locate_response["matches"]
+            # The number of matches is known now, so the remaining locate/get pairs can be sent ahead
+            messages = [GET_COLOR_IMAGE_MESSAGE] + ([GET_DEPTH_IMAGE_MESSAGE] if FETCH_DEPTH else []) + [GET_MATCH_DATA_MESSAGE]
+            messages += [LOCATE_NEXT_MESSAGE, GET_MATCH_DATA_MESSAGE] * (matches - match)
 
-                if first:
-                    first = False
-                    color_image_response = self.send_and_receive(my_socket, GET_COLOR_IMAGE_MESSAGE)
-                    color_image = color_image_response.get("value", None)
+            fetch_start = time.perf_counter()
+            replies = self.send_pipelined(my_socket, messages)
+            for message, reply in replies:
+                if message == GET_COLOR_IMAGE_MESSAGE:
+                    color_image = reply.get("value", None)
                     if color_image is None or color_image == "":
                         self.print_to_text_box(f"Failed to fetch color image from PALLOC")
+                        replies.close()
                         return
-
-                feedback_dict = self.send_and_receive(my_socket, GET_MATCH_DATA_MESSAGE)
-                match_data[match] = feedback_dict.get("value", None)
-
-                if match == matches:
-                    break
-
-            except json.JSONDecodeError:
-                self.print_to_text_box(f"Failed to fetch data from PALLOC")
-                return
+                    color_frame = ColorFrame.from_base64(color_image)
+                elif message == GET_DEPTH_IMAGE_MESSAGE:
+                    depth_image = reply.get("value", None)
+                    if not depth_image:
+                        self.print_to_text_box(f"Failed to fetch depth image from PALLOC, heights are not measured")
+                    depth_frame = DepthFrame.from_base64(depth_image, DEPTH_SCALE) if depth_image else None
+                elif message == LOCATE_NEXT_MESSAGE:
+                    if reply["name"] == LOCATE_ERROR:
+                        self.print_to_text_box(f"Could not locate any objects in the image!")
+                        replies.close()
+                        return
+                    match = reply["match"]
+                else:
+                    match_data[match] = reply.get("value", None)
+        except (KeyError, TypeError, AttributeError, ValueError) as e:
+            if replies is not None:
+                replies.close()
+            raise MalformedReply(f"Unexpected reply from PALLOC: {e!r}") from e
+        METRICS.observe('fetch', time.perf_counter() - fetch_start)
 
         self.print_to_text_box(f"Image and match data fetched!")
 
         # Process the match data
-        self.process_match_data(match_data, color_image)
-
-    def process_match_data(self, match_data, color_image):
-        def find_intersects(match_data):
-            box_len = len(match_data)
-            print(f"Boxes: {box_len}")
-            print(match_data)
-            for i in range(1, box_len):
-                bbox_1 = match_data[i]['bbox']['rectangle']
-                x1 = bbox_1['x']
-                y1 = bbox_1['y']
-                width1 = bbox_1['width']
-                height1 = bbox_1['height']
-                for j in range(i+1, box_len+1):
-                    bbox_2 = match_data[j]['bbox']['rectangle']
-                    x2 = bbox_2['x']
-                    y2 = bbox_2['y']
-                    width2 = bbox_2['width']
-                    height2 = bbox_2['height']
-
-                    if (abs(x1 - x2) < (width1+width2) / 2
-                        and abs(y1 - y2) < (height1 + height2) / 2):
-                        self.bbox_overlaps[frozenset({i, j})] = True
-
-                    else:
-                        self.bbox_overlaps[frozenset({i,j})] = False
-
-            print(self.bbox_overlaps)
-
-        def find_corners(match_data):
-            updated_data = {}
-            for i, match in match_data.items():
-                bbox = match['bbox']['rectangle']
-                height = bbox['height']
-                width = bbox['width']
-                bbox_x = bbox['x']
-                bbox_y = bbox['y']
-
-                region = match['bbox']['region']
-
-                segments_y = region['segmentsY']
-                segments_x_start = region['segmentsXStart']
-                segments_x_stop = region['segmentsXStop']
-
-                max_y = segments_y[-1]
-                min_y = segments_y[0]
-                max_x = segments_x_stop[-1]
-                min_x = segments_x_start[-1]
-
-                # Left, Right, Top, Bottom
-                coordinates = [[min_x, max_y],
-                               [(max_x + min_x) / 2, max_y],
-                               [max_x, max_y],
-                               [(segments_x_stop[0] + segments_x_start[0]) / 2, min_y]]
-                for start, stop, y in zip(segments_x_start, segments_x_stop, segments_y):
-                    significance = stop - start
-                    # Significance: Is it only one rouge pixel or is it a "real" connected pixel?
-                    if (start < coordinates[0][0] and significance > 3):
-                        coordinates[0] = [start, y]
-                        print(f"Smallest x: {[start, y]}")
-
-                    if (stop > coordinates[1][0] and significance > 3):
-                        coordinates[1] = [stop, y]
-                        print(f"Biggest x: {[stop, y]}")
-                self.pre_processed_corners[i] = coordinates
-
-                for j in range(1, len(match_data) + 1):
-                    # If a corner is overlapping with another box, recreate it using trigonometry
-                    if (i == j):
-                        continue
-
-                    if (self.bbox_overlaps[frozenset({i, j})]):
-                        other_bbox = match_data[j]['bbox']['rectangle']
-                        other_x = other_bbox['x']
-                        other_y = other_bbox['y']
-                        other_width = other_bbox['width']
-                        other_height = other_bbox['height']
-
-                        delta_top = (coordinates[2][1] - (bbox_y + (height / 2)))
-                        delta_bot = (coordinates[3][1] - (bbox_y - (height / 2)))
-
-                        if (delta_top < delta_bot):
-                            pref_tb = coordinates[2]
-                            bad_tb = coordinates[3]
-                        else:
-                            pref_tb = coordinates[3]
-                            bad_tb = coordinates[2]
-
-                        delta_left = (coordinates[0][0] - (bbox_x - (width / 2)))
-                        delta_right = (coordinates[1][0] - (bbox_x + (width / 2)))
-
-                        if (delta_left < delta_right): # Left corner closer to bbox than right corner
-                            pref_lr = coordinates[0]
-                            bad_lr = coordinates[1]
-                        else:
-                            pref_lr = coordinates[1]
-                            bad_lr = coordinates[0]
-
-                        pref_lr_x = pref_lr[0]
-                        pref_lr_y = pref_lr[1]
-                        bad_lr_x = bad_lr[0]
-                        bad_lr_y = bad_lr[1]
-
-                        # If the good corner is in a different region, recreate it using the worse corner
-                        if (abs(pref_lr_x - other_x) < other_width
-                            and abs(pref_lr_y - other_y) < other_height):
-                            delta_x = bad_lr_x-bbox_x
-                            pref_lr[0] = bbox_x - delta_x
-                            delta_y = bad_lr_y-bbox_y
-                            pref_lr[1] = bbox_y - delta_y
-
-                        # Recreate right corner from left. Not necessarily necessary, so it might cause problems.
-                        elif(abs(bad_lr_x - other_x) < other_width
-                             and abs(bad_lr_y - other_y) < other_height):
-                            delta_x = pref_lr_x-bbox_x
-                            bad_lr[0] = bbox_x - delta_x
-                            delta_y = pref_lr_y-bbox_y
-                            bad_lr[1] = bbox_y - delta_y
-
-                        pref_tb_x = pref_tb[0]
-                        pref_tb_y = pref_tb[1]
-                        bad_tb_x = bad_tb[0]
-                        bad_tb_y = bad_tb[1]
-
-                        if (abs(pref_tb_x - other_x) < other_width
-                            and abs(pref_tb_y - other_y) < other_height):
-                            delta_x = bad_tb_x - bbox_x
-                            pref_tb[0] = bbox_x - delta_x
-                            delta_y = bad_tb_y-bbox_y
-                            pref_tb[1] = bbox_y - delta_y
-                        elif(abs(bad_tb_x - other_x) < other_width 
-                            and abs(bad_tb_y - other_y) < other_height):
-                            delta_x = pref_tb_x-bbox_x
-                            bad_tb[0] = bbox_x - delta_x
-                            delta_y = pref_tb_y-bbox_y
-                            bad_tb[1] = bbox_y - delta_y
-
-                # Calculate the minimum bounding rectangle
-                bounding_rectangle = minimum_bounding_rectangle(coordinates)
-                bounding_rectangle_center = calculate_centroid(bounding_rectangle)
-                bounding_rectangle_rotation = angle_from_centroid(
-                    bounding_rectangle[0],
-                    bounding_rectangle_center)
-                bounding_rectangle_width, \
-                    bounding_rectangle_height, \
-                    bounding_rectangle_rotation = calculate_true_dimensions(coordinates)
-
-                # Expose the data
-                updated_data[i] = {}
-                updated_data[i]['height'] = bounding_rectangle_height
-                updated_data[i]['width'] = bounding_rectangle_width
-                updated_data[i]['rotation'] = bounding_rectangle_rotation
-
-            for i in range(1, len(match_data) + 1):
-                match_data[i]['bbox']['rectangle']['height'] = updated_data[i]['height']
-                match_data[i]['bbox']['rectangle']['width'] = updated_data[i]['width']
-                match_data[i]['bbox']['rectangle']['rotation'] = updated_data[i]['rotation']
-
-            self.calculated_boxes = updated_data
-
-        find_intersects(match_data)
-        find_corners(match_data)
+        self.process_match_data(match_data, color_frame, depth_frame)
+
+    def process_match_data(self, match_data, color_frame, depth_frame=None):
+        # The pipeline keeps no state between frames and leaves match_data untouched
+        if self.pipeline is None:
+            if FIT_WORKERS:
+                self.fit_executor = ProcessPoolExecutor(FIT_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+            self.pipeline = FramePipeline(FIT_REGION_PIXELS, self.fit_executor, FIT_WORKERS, GROUND_DEPTH)
+            if TRACK_LAYER:
+                self.tracker = LayerTracker(self.pipeline)
+
+        logger.info("Boxes: %d", len(match_data))
+        logger.debug("Match data: %s", match_data)
+        with METRICS.time('fit'):
+            depth = depth_frame.array if depth_frame is not None else None  # decoded once per frame
+            if self.tracker is not None and not self.loading:
+                result = self.tracker.process(match_data, depth)
+                self.print_to_text_box(f"Fitted {self.tracker.refitted} boxes, reused {self.tracker.reused}")
+            else:
+                result = self.pipeline.process(match_data, depth)
+        if result.z is not None:
+            self.print_to_text_box("Heights: " + ", ".join(f"{i}: {z:.1f}" for i, z in zip(result.match_ids, result.z.tolist())))
+        logger.debug("Overlaps: %s", result.overlaps)
+        METRICS.inc('frames')
+        METRICS.inc('boxes', len(result))
+        self.result = result
 
         if not self.loading:
-            self.save_checkpoint(match_data, color_image, f"{os.getcwd()}/checkpoints")
-        self.show_image(match_data, color_image)
+            self.save_checkpoint(match_data, color_frame, f"{os.getcwd()}/checkpoints", depth_frame)
+        with METRICS.time('render'):
+            self.show_image(result, color_frame)
 
-    def save_checkpoint(self, match_data: dict, color_image: Image, path: str) -> None:
+    def save_checkpoint(self, match_data: dict, color_frame: ColorFrame, path: str, depth_frame: DepthFrame = None) -> None:
         """
-        take the current taken match data and image and save it to a file to speed-up processing tests
+        take the current taken match data and image and save it to a file to speed-up processing tests,
+        the files are written in the background by the checkpoint writer
         :param match_data: the dict contaning the bounding boxes and pixel data for each match
-        :param color_image: the raw image in color
+        :param color_frame: the image in color, stored as received from the camera
         :param path: folder to path to store the images to
+        :param depth_frame: the depth image if fetched, stored as received
         :return:
         """
-        self.print_to_text_box(f"Saving checkpoints to {path}")
-        timestamp = datetime.datetime.now()
-        dict_filename = f"{path}/{timestamp:%Y-%m-%d_%H:%M}-match.json"
-        img_filename = f"{path}/{timestamp:%Y-%m-%d_%H:%M}-match.png"
-
-        if not os.path.isdir(path):
-            os.mkdir(path)
-            print(f"creating 'checkpoints' directory at {path}")
-
-        with open(dict_filename, "w") as f:
-            json.dump(match_data, f)
-
-        image_data = base64.b64decode(color_image)
-        # Create a PhotoImage object
-        photo = PhotoImage(data=image_data)
-        photo.write(img_filename, format='png')
+        if self.checkpoint_writer is None or self.checkpoint_writer.path != path:
+            if self.checkpoint_writer is not None:
+                self.checkpoint_writer.close()
+            self.checkpoint_writer = CheckpointWriter(path, CHECKPOINT_QUEUE_SIZE, CHECKPOINT_POLICY)
+        # Written in the background, the frame is not modified anymore after this point
+        self.checkpoint_writer.submit(match_data, color_frame, depth_frame)
+        metrics = self.checkpoint_writer.metrics()
+        logger.info("Saving checkpoints to %s (%d queued, %d written, %d dropped, %d failed)", path,
+                    metrics['queued'], metrics['written'], metrics['dropped'], metrics['failed'])
+
+    def close(self):
+        # Close the connection, write the outstanding checkpoints and stop the workers
+        self.disconnect()
+        if self.checkpoint_writer is not None:
+            self.checkpoint_writer.close()
+        if self.fit_executor is not None:
+            self.fit_executor.shutdown()
+        METRICS.close()
 
     def load_from_file(self):
         self.loading = True
-        # load canvas image from file
-        base_path = self.file_path.get().split('.')[0]
-        with open(f'{base_path}.png', 'rb') as f:
-            b64val = base64.b64encode(f.read())
-        with open(f"{base_path}.json", 'r') as f:
-            match_data = json.load(f)
-        
-        for i in range(1, len(match_data)+1):
-            match_data[i] = match_data.pop(str(i))
-
-        self.process_match_data(match_data, b64val)
+        # load match data and canvas image from a binary or a JSON checkpoint
+        filename = self.file_path.get()
+        if not filename.endswith('.bin'):
+            filename = f"{filename.split('.')[0]}.json"
+        match_data, color_frame = load_match_data(filename)
+        if color_frame is None:
+            self.print_to_text_box(f"No image found for {filename}")
+            return
+
+        self.process_match_data(match_data, color_frame, load_depth_frame(filename))
 
 if __name__ == '__main__':
     # Construct GUI and run
+    configure_logging(LOG_LEVEL)
+    if METRICS_FILE:
+        METRICS.write_periodically(METRICS_FILE)
+    if METRICS_PORT:
+        METRICS.serve(METRICS_PORT)
     root = tk.Tk()
     app = App(root)
     root.mainloop()
+    app.close()
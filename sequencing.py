@@ -0,0 +1,289 @@
+"""
+order in which the robot moves the boxes. The motion follows RobotInteractor.move_box_to_target:
+down to the box, up to SAFETY_HEIGHT, base joint by LOCATION_ANGLE, over to the target, down, up and back.
+Only the way from one drop-off back to the next box depends on the order, so the sequence is an
+asymmetric travelling salesman path: nearest neighbour, improved by 2-opt and Or-opt moves.
+
+Precedence constraints keep the order physically possible: a box lying on another one in the pickup
+layer is taken first, a box planned on top of another one is put down later.
+
+    precedence = pickup_precedence(boxes) + placement_precedence(plan.placements)
+    result = sequence_boxes(boxes, [p.top_center for p in plan.placements], precedence)
+    for i in result.order:
+        robot.move_box_to_target(boxes[i], targets[i])
+"""
+import math
+from dataclasses import dataclass
+from typing import Iterable, List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+
+from box import Box
+from robot_interaction import ANG_SPEED, LIN_SPEED, LOCATION_ANGLE, SAFETY_HEIGHT
+from util import Vec2, Vec3
+
+HOME: Vec2 = Vec2(250, 40)  # position of the gripper after RobotInteractor.go_to_home_position
+MAX_PASSES: int = 50  # improvement passes of the local search at most
+ROTATE_TIME: float = 90 / ANG_SPEED  # s, turning the gripper for a box placed with BoxAction.ROTATE_90
+
+Target = Union[Vec2, Vec3]
+
+
+def rotate(point: Tuple[float, float], degrees: float) -> Tuple[float, float]:
+    """
+    position of the gripper after the base joint turned
+    :param point: x, y in the base frame of the robot
+    :param degrees: turn of the base joint, counter-clockwise
+    :return: x, y in the base frame
+    """
+    angle = math.radians(degrees)
+    return (point[0] * math.cos(angle) - point[1] * math.sin(angle),
+            point[0] * math.sin(angle) + point[1] * math.cos(angle))
+
+
+def footprint(box: Box) -> Tuple[float, float, float, float]:
+    """
+    axis aligned bounding box of a (rotated) box in the pickup layer
+    :param box: the box
+    :return: (x_min, y_min, x_max, y_max)
+    """
+    angle = math.radians(box.rotation)
+    half_x = (abs(box.width * math.cos(angle)) + abs(box.height * math.sin(angle))) / 2
+    half_y = (abs(box.width * math.sin(angle)) + abs(box.height * math.cos(angle))) / 2
+    return box.center.x - half_x, box.center.y - half_y, box.center.x + half_x, box.center.y + half_y
+
+
+def _overlap(a: Tuple[float, float, float, float], b: Tuple[float, float, float, float]) -> bool:
+    return a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]
+
+
+def pickup_precedence(boxes: Sequence[Box], tolerance: float = 5) -> List[Tuple[int, int]]:
+    """
+    a box overlapping a lower one in the pickup layer lies on it and has to be taken first
+    :param boxes: the boxes with their centre, rotation and surface height in the pickup layer
+    :param tolerance: mm, surfaces differing less than this are in the same layer
+    :return: (before, after) pairs of box indices
+    """
+    footprints = [footprint(box) for box in boxes]
+    pairs = []
+    for i in range(len(boxes)):
+        for j in range(len(boxes)):
+            if boxes[i].z_height > boxes[j].z_height + tolerance and _overlap(footprints[i], footprints[j]):
+                pairs.append((i, j))
+    return pairs
+
+
+def placement_precedence(placements: Sequence, tolerance: float = 1e-6) -> List[Tuple[int, int]]:
+    """
+    a box planned on top of (or above) another one has to be put down after it
+    :param placements: Placement3D of every box (see pallet3d), None for boxes which are not placed
+    :param tolerance: mm
+    :return: (before, after) pairs of box indices
+    """
+    pairs = []
+    for i, a in enumerate(placements):
+        for j, b in enumerate(placements):
+            if a is None or b is None or i == j:
+                continue
+            if b.z >= a.z + a.z_height - tolerance and \
+                    _overlap((a.x, a.y, a.x + a.width, a.y + a.height), (b.x, b.y, b.x + b.width, b.y + b.height)):
+                pairs.append((i, j))
+    return pairs
+
+
+def _linear(a: Tuple[float, float, float], b: Tuple[float, float, float]) -> float:
+    return math.dist(a, b) / LIN_SPEED
+
+
+@dataclass(frozen=True)
+class PickSequence:
+    """
+    result of `sequence_boxes`
+    """
+    order: Tuple[int, ...]  # indices of the boxes in the order they are moved
+    cycle_time: float  # s, expected time to move all boxes
+    travel_time: float  # s, part of the cycle time between a drop-off and the next pickup
+    box_times: Tuple[float, ...]  # s, time of each move (approach, pick, turn, place, turn back) in `order`
+
+
+class PickSequencer:
+    """
+    cost model of the robot moves and the search for the visit order
+    """
+    def __init__(self,
+                 boxes: Sequence[Box],
+                 targets: Sequence[Target],
+                 rotated: Optional[Sequence[bool]] = None,
+                 start: Vec2 = HOME) -> None:
+        """
+        :param boxes: the boxes, picked at their centre and surface height
+        :param targets: drop-off position of each box in the base frame, Vec3 with the height of the
+            surface to release it at or Vec2 to release it at its own height
+        :param rotated: whether each box is placed with BoxAction.ROTATE_90
+        :param start: position of the gripper before the first box, at SAFETY_HEIGHT
+        """
+        n = len(boxes)
+        picks = np.array([(b.center.x, b.center.y, b.z_height) for b in boxes], dtype=float).reshape(-1, 3)
+        drops = np.array([(t.x, t.y, t.z if isinstance(t, Vec3) else b.z_height) for t, b in zip(targets, boxes)],
+                         dtype=float).reshape(-1, 3)
+        self.n = n
+
+        # Fixed part of every box: pick, turn, over to the target, place, turn back
+        self.box_times = np.zeros(n)
+        for k in range(n):
+            above_pick = (picks[k, 0], picks[k, 1], SAFETY_HEIGHT)
+            turned = rotate(above_pick[:2], LOCATION_ANGLE) + (SAFETY_HEIGHT,)
+            above_drop = (drops[k, 0], drops[k, 1], SAFETY_HEIGHT)
+            self.box_times[k] = (_linear(above_pick, tuple(picks[k])) + 2 * abs(LOCATION_ANGLE) / ANG_SPEED
+                                 + _linear(turned, above_drop) + 2 * (SAFETY_HEIGHT - drops[k, 2]) / LIN_SPEED)
+            if rotated is not None and rotated[k]:
+                self.box_times[k] += ROTATE_TIME
+
+        # Way to the next box (linear from above the turned back drop-off down to the box), by order
+        back = np.array([rotate((x, y), -LOCATION_ANGLE) for x, y in drops[:, :2]]).reshape(-1, 2)
+        self.start_cost = np.hypot(np.hypot(picks[:, 0] - start.x, picks[:, 1] - start.y),
+                                   SAFETY_HEIGHT - picks[:, 2]) / LIN_SPEED
+        self.cost = np.hypot(np.hypot(picks[np.newaxis, :, 0] - back[:, np.newaxis, 0],
+                                      picks[np.newaxis, :, 1] - back[:, np.newaxis, 1]),
+                             SAFETY_HEIGHT - picks[np.newaxis, :, 2]) / LIN_SPEED  # cost[i, j]: after i, pick j
+        # With a virtual box n in front of the first (the start) and behind the last one (free)
+        self._padded = np.zeros((n + 1, n + 1))
+        self._padded[:n, :n] = self.cost
+        self._padded[n, :n] = self.start_cost
+        self.before: List[List[int]] = [[] for _ in range(n)]  # boxes which have to be moved before each box
+        self.edges: List[Tuple[int, int]] = []
+
+    def add_precedence(self, pairs: Iterable[Tuple[int, int]]) -> None:
+        """
+        :param pairs: (before, after) pairs of box indices
+        :return:
+        """
+        for a, b in pairs:
+            if a != b and (a, b) not in self.edges:
+                self.edges.append((a, b))
+                self.before[b].append(a)
+
+    def travel(self, order: Sequence[int]) -> float:
+        """
+        time between the drop-offs and the next pickups of an order
+        :param order: indices of the boxes
+        :return: s
+        """
+        if not len(order):
+            return 0.0
+        order = np.asarray(order)
+        return float(self.start_cost[order[0]] + self.cost[order[:-1], order[1:]].sum())
+
+    def feasible(self, order: Sequence[int]) -> bool:
+        position = np.empty(self.n, dtype=int)
+        position[np.asarray(order, dtype=int)] = np.arange(len(order))
+        return all(position[a] < position[b] for a, b in self.edges)
+
+    def nearest_neighbour(self) -> List[int]:
+        """
+        greedy order: always the closest box whose predecessors were moved
+        :return: indices of the boxes
+        """
+        waiting = [len(before) for before in self.before]
+        after: List[List[int]] = [[] for _ in range(self.n)]
+        for a, b in self.edges:
+            after[a].append(b)
+        done = np.zeros(self.n, dtype=bool)
+        order = []
+        costs = self.start_cost
+        for _ in range(self.n):
+            available = np.flatnonzero(~done & (np.array(waiting) == 0))
+            if not len(available):
+                raise ValueError("The precedence constraints contain a cycle")
+            k = int(available[np.argmin(costs[available])])
+            order.append(k)
+            done[k] = True
+            for b in after[k]:
+                waiting[b] -= 1
+            costs = self.cost[k]
+        return order
+
+    def _moves(self, path: np.ndarray) -> List[Tuple[float, List[int]]]:
+        """
+        all 2-opt and Or-opt moves which shorten the travel time
+        :param path: order padded with the start (n) in front and the end (n) behind
+        :return: (change of the travel time, new order), best first
+        """
+        m = self._padded
+        n = len(path) - 2
+        forward = np.concatenate([[0.0], np.cumsum(m[path[:-1], path[1:]])])
+        backward = np.concatenate([[0.0], np.cumsum(m[path[1:], path[:-1]])])
+        moves = []
+
+        # 2-opt: the boxes at positions i..j in reverse order
+        i = np.arange(1, n + 1)[:, np.newaxis]
+        j = np.arange(1, n + 1)[np.newaxis, :]
+        delta = (m[path[i - 1], path[j]] + m[path[i], path[j + 1]] - m[path[i - 1], path[i]] - m[path[j], path[j + 1]]
+                 + backward[j] - backward[i] - forward[j] + forward[i])
+        for a, b in np.argwhere((delta < -1e-9) & (j > i)).tolist():
+            order = path[1:-1].tolist()
+            order[a:b + 1] = order[a:b + 1][::-1]
+            moves.append((float(delta[a, b]), order))
+
+        # Or-opt: one to three boxes at positions i.. moved to another gap
+        for length in (1, 2, 3):
+            for i in range(1, n - length + 2):
+                first, last = path[i], path[i + length - 1]
+                gain = m[path[i - 1], first] + m[last, path[i + length]] - m[path[i - 1], path[i + length]]
+                rest = np.concatenate([path[:i], path[i + length:]])
+                delta = m[rest[:-1], first] + m[last, rest[1:]] - m[rest[:-1], rest[1:]] - gain
+                delta[i - 1] = 0.0  # the gap it was taken from
+                for g in np.flatnonzero(delta < -1e-9).tolist():
+                    order = rest[1:g + 1].tolist() + path[i:i + length].tolist() + rest[g + 1:-1].tolist()
+                    moves.append((float(delta[g]), order))
+        moves.sort(key=lambda move: move[0])
+        return moves
+
+    def improve(self, order: List[int], max_passes: int = MAX_PASSES) -> List[int]:
+        """
+        2-opt (reversing a part of the order) and Or-opt (moving one to three boxes elsewhere) until no move
+        shortens the travel time. In every pass the best move which keeps the precedence constraints is made
+        :param order: a feasible order
+        :param max_passes: passes over all moves at most
+        :return: the improved order
+        """
+        for _ in range(max_passes):
+            path = np.array([self.n] + list(order) + [self.n])
+            for _, candidate in self._moves(path):
+                if self.feasible(candidate):
+                    order = candidate
+                    break
+            else:
+                break
+        return order
+
+    def solve(self, max_passes: int = MAX_PASSES) -> PickSequence:
+        """
+        :param max_passes: improvement passes at most
+        :return: the best order found and its expected times
+        """
+        order = self.improve(self.nearest_neighbour(), max_passes)
+        travel = self.travel(order)
+        box_times = tuple(float(self.box_times[i]) for i in order)
+        return PickSequence(tuple(order), travel + sum(box_times), travel, box_times)
+
+
+def sequence_boxes(boxes: Sequence[Box],
+                   targets: Sequence[Target],
+                   precedence: Iterable[Tuple[int, int]] = (),
+                   rotated: Optional[Sequence[bool]] = None,
+                   start: Vec2 = HOME,
+                   max_passes: int = MAX_PASSES) -> PickSequence:
+    """
+    order in which the boxes are moved to their targets with the shortest expected cycle time
+    :param boxes: the boxes in the pickup layer
+    :param targets: drop-off position of each box, see PickSequencer
+    :param precedence: (before, after) pairs of box indices, see pickup_precedence and placement_precedence
+    :param rotated: whether each box is placed with BoxAction.ROTATE_90
+    :param start: position of the gripper before the first box
+    :param max_passes: improvement passes at most
+    :return: the order and its expected times
+    """
+    sequencer = PickSequencer(boxes, targets, rotated, start)
+    sequencer.add_precedence(precedence)
+    return sequencer.solve(max_passes)
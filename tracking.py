@@ -0,0 +1,187 @@
+"""
+frame to frame tracking of the boxes of a layer. In continuous mode usually only the
+picked box disappears between two cycles, the fits of all untouched boxes are reused
+"""
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from region import RleRegion
+from vision import FramePipeline, FrameResult, find_overlaps
+
+MIN_IOU: float = 0.9  # PALLOC rectangles overlapping less than this are different boxes
+CENTRE_TOLERANCE: float = 3.0  # pixels the centre of an unchanged box may move between frames
+MIN_REGION_IOU: float = 0.95  # pixel IoU of the regions of an unchanged box in two frames
+MAX_REUSE: int = 10  # frames after which a fit is computed again, even if the box did not change
+
+
+def rectangle_array(match_data: Dict[int, dict], match_ids: List[int]) -> np.ndarray:
+    """
+    PALLOC rectangles of the matches as array
+    :param match_data: PALLOC match data by match number
+    :param match_ids: the matches in the order of the rows
+    :return: (N, 4) x, y, width, height (x, y being the centre)
+    """
+    rectangles = [match_data[i]['bbox']['rectangle'] for i in match_ids]
+    return np.array([[r['x'], r['y'], r['width'], r['height']] for r in rectangles], dtype=float).reshape(-1, 4)
+
+
+def rectangle_iou(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    """
+    intersection over union of all pairs of axis aligned rectangles
+    :param a: (N, 4) x, y, width, height
+    :param b: (M, 4) x, y, width, height
+    :return: (N, M) intersection over union
+    """
+    a = a[:, np.newaxis, :]
+    b = b[np.newaxis, :, :]
+    overlap_x = np.minimum(a[..., 0] + a[..., 2] / 2, b[..., 0] + b[..., 2] / 2) - \
+        np.maximum(a[..., 0] - a[..., 2] / 2, b[..., 0] - b[..., 2] / 2)
+    overlap_y = np.minimum(a[..., 1] + a[..., 3] / 2, b[..., 1] + b[..., 3] / 2) - \
+        np.maximum(a[..., 1] - a[..., 3] / 2, b[..., 1] - b[..., 3] / 2)
+    intersection = np.clip(overlap_x, 0, None) * np.clip(overlap_y, 0, None)
+    union = a[..., 2] * a[..., 3] + b[..., 2] * b[..., 3] - intersection
+    return np.divide(intersection, union, out=np.zeros_like(intersection), where=union > 0)
+
+
+def match_rectangles(current: np.ndarray,
+                     previous: np.ndarray,
+                     min_iou: float = MIN_IOU,
+                     centre_tolerance: float = CENTRE_TOLERANCE) -> np.ndarray:
+    """
+    assigns the rectangles of the current frame to those of the previous one, greedily by descending IoU
+    :param current: (N, 4) x, y, width, height
+    :param previous: (M, 4) x, y, width, height
+    :param min_iou: minimum intersection over union of a pair
+    :param centre_tolerance: maximum distance of the centres of a pair
+    :return: (N,) row in `previous` for every current rectangle, -1 if it is new
+    """
+    assignment = np.full(len(current), -1)
+    if not len(current) or not len(previous):
+        return assignment
+    iou = rectangle_iou(current, previous)
+    distance = np.hypot(current[:, np.newaxis, 0] - previous[np.newaxis, :, 0],
+                        current[:, np.newaxis, 1] - previous[np.newaxis, :, 1])
+    candidates = np.argwhere((iou >= min_iou) & (distance <= centre_tolerance))
+    order = np.argsort(-iou[candidates[:, 0], candidates[:, 1]], kind='stable')
+    taken = np.zeros(len(previous), dtype=bool)
+    for k, j in candidates[order].tolist():
+        if assignment[k] < 0 and not taken[j]:
+            assignment[k] = j
+            taken[j] = True
+    return assignment
+
+
+class LayerTracker:
+    """
+    processes the frames of a layer like `FramePipeline.process`, but reuses the fit of every box which
+    is still at the same place with the same region and the same (unchanged) neighbours as in the
+    previous frame. Only new or disturbed boxes are fitted again.
+
+    The robot reports the boxes it moved with `invalidate`, as long as nothing was reported and
+    `max_reuse` is not exceeded `needs_relocate` tells that the last result is still valid
+    """
+    def __init__(self,
+                 pipeline: Optional[FramePipeline] = None,
+                 min_iou: float = MIN_IOU,
+                 centre_tolerance: float = CENTRE_TOLERANCE,
+                 min_region_iou: float = MIN_REGION_IOU,
+                 max_reuse: int = MAX_REUSE) -> None:
+        """
+        :param pipeline: fits the rectangles, a default FramePipeline if not given
+        :param min_iou: minimum IoU of the PALLOC rectangles of a box in two frames
+        :param centre_tolerance: pixels the centre of an unchanged box may move
+        :param min_region_iou: minimum pixel IoU of the regions of an unchanged box
+        :param max_reuse: frames a fit (or a result without locating) is reused at most
+        """
+        self.pipeline = pipeline if pipeline is not None else FramePipeline()
+        self.min_iou = min_iou
+        self.centre_tolerance = centre_tolerance
+        self.min_region_iou = min_region_iou
+        self.max_reuse = max_reuse
+
+        self.result: Optional[FrameResult] = None
+        self.reused = 0  # boxes of the last frame whose fit was reused
+        self.refitted = 0  # boxes of the last frame which were fitted
+        self._rectangles = np.empty((0, 4))
+        self._regions: List[RleRegion] = []
+        self._ages = np.empty(0, dtype=int)  # frames the fit of each box has been reused
+        self._valid = np.empty(0, dtype=bool)
+        self._skipped = 0  # cycles served from the last result without locating
+
+    def invalidate(self, match_id: Optional[int] = None) -> None:
+        """
+        marks a box of the last result as moved (e.g. picked), its fit and those of its neighbours
+        are not reused. Without a match number the whole layer is fitted again
+        :param match_id: match number in the last result
+        :return:
+        """
+        if match_id is None or self.result is None:
+            self._valid[:] = False
+        else:
+            self._valid[self.result.index(match_id)] = False
+
+    def needs_relocate(self) -> bool:
+        """
+        whether the layer has to be located again or the last result is still valid
+        :return:
+        """
+        return self.result is None or not self._valid.all() or self._skipped >= self.max_reuse
+
+    def reuse_last(self) -> FrameResult:
+        """
+        returns the last result for a cycle without locating, see `needs_relocate`
+        :return:
+        """
+        self._skipped += 1
+        return self.result
+
+    def process(self, match_data: Dict[int, dict], depth: Optional[np.ndarray] = None) -> FrameResult:
+        """
+        detects the boxes of a frame, reusing the fits of unchanged boxes. The heights are measured on every frame
+        :param match_data: PALLOC match data by match number
+        :param depth: (height, width) depth image in mm to measure the surface heights, optional
+        :return: the boxes of the frame
+        """
+        match_ids = sorted(match_data)
+        rectangles = rectangle_array(match_data, match_ids)
+        regions = [RleRegion.from_region(match_data[i]['bbox']['region']) for i in match_ids]
+        overlaps = find_overlaps({i: match_data[i]['bbox']['rectangle'] for i in match_ids})
+
+        # A box is unchanged if it matches a valid box of the last frame covering (almost) the same pixels
+        previous = match_rectangles(rectangles, self._rectangles, self.min_iou, self.centre_tolerance)
+        matched = previous >= 0
+        unchanged = matched.copy()
+        unchanged[matched] = self._valid[previous[matched]] & (self._ages[previous[matched]] < self.max_reuse)
+        for k in np.flatnonzero(unchanged):
+            unchanged[k] = regions[k].iou(self._regions[previous[k]]) >= self.min_region_iou
+
+        # ... and its neighbours are the same unchanged boxes as before, a moved neighbour changes the fit
+        position = {i: k for k, i in enumerate(match_ids)}
+        reusable = unchanged.copy()
+        if self.result is not None:
+            previous_ids = self.result.match_ids
+            for k, i in enumerate(match_ids):
+                if not unchanged[k]:
+                    continue
+                neighbours = [position[j] for j in overlaps[i]]
+                before = {previous_ids.index(j) for j in self.result.overlaps[previous_ids[previous[k]]]}
+                reusable[k] = all(unchanged[n] for n in neighbours) and {previous[n] for n in neighbours} == before
+
+        refit = [i for k, i in enumerate(match_ids) if not reusable[k]]
+        fitted = self.pipeline.fit(match_data, overlaps, refit)
+        for k, i in enumerate(match_ids):
+            if reusable[k]:
+                j = previous[k]
+                fitted[i] = (self.result.corners[j].tolist(), [tuple(corner) for corner in self.result.rectangles[j].tolist()])
+
+        result = FrameResult.from_fits(overlaps, fitted, self.pipeline.surface_heights(match_data, depth))
+        self._ages = np.where(reusable, self._ages[previous] + 1 if len(self._ages) else 0, 0)
+        self._rectangles = rectangles
+        self._regions = regions
+        self._valid = np.ones(len(match_ids), dtype=bool)
+        self._skipped = 0
+        self.reused = int(reusable.sum())
+        self.refitted = len(refit)
+        self.result = result
+        return result
@@ -0,0 +1,612 @@
+"""
+vectorised building blocks of the box detection working on the
+run-length encoded regions delivered by PALLOC
+"""
+import sys
+from concurrent.futures import Executor
+from dataclasses import dataclass
+from multiprocessing import shared_memory
+from types import MappingProxyType
+from typing import Dict, Iterable, List, Mapping, Optional, Tuple
+
+import numpy as np
+
+SIGNIFICANCE: int = 3  # segments must be longer than this to count as "real" connected pixels and not as rogue ones
+PARALLEL_MIN_MATCHES: int = 8  # smaller frames are fitted serially even if an executor is given
+
+
+def _convex_chain(points: Iterable[List[float]]) -> List[List[float]]:
+    # Every point is pushed once and popped at most once, vertices not turning left are popped
+    chain = []
+    for x, y in points:
+        while len(chain) > 1:
+            (ax, ay), (bx, by) = chain[-2], chain[-1]
+            if (bx - ax) * (y - ay) - (by - ay) * (x - ax) > 0:
+                break
+            chain.pop()
+        chain.append([x, y])
+    return chain
+
+
+def convex_hull(points) -> np.ndarray:
+    """
+    calculates the convex hull of the given points in O(n log n) using Andrew's monotone chain:
+    the sorting is vectorised, the two chains are built in linear time
+    :param points: (n, 2) points
+    :return: (h, 2) array of the hull points in counter-clockwise order (for a y-axis pointing up)
+    """
+    points = np.asarray(points, dtype=float).reshape(-1, 2)
+    points = points[np.lexsort((points[:, 1], points[:, 0]))]
+    distinct = np.ones(len(points), dtype=bool)
+    distinct[1:] = np.any(points[1:] != points[:-1], axis=1)
+    points = points[distinct]
+    if len(points) < 3:
+        return points
+
+    ordered = points.tolist()
+    lower = _convex_chain(ordered)
+    upper = _convex_chain(reversed(ordered))
+    return np.array(lower[:-1] + upper[:-1])
+
+
+def minimum_bounding_rectangle(points):
+    """
+    finds the (rotated) rectangle with minimal area containing all points.
+    One side of the minimal rectangle is flush with an edge of the convex hull (rotating calipers),
+    so the hull is projected onto the directions of all of its edges in one vectorised step
+    :param points: (n, 2) points, e.g. the corners of a box or the outline of its region
+    :return: the four corners of the rectangle, the first side points in the direction of the rotation
+    """
+    hull = convex_hull(points)
+    if len(hull) == 1:
+        return [(float(hull[0, 0]), float(hull[0, 1]))] * 4
+    if len(hull) == 2:
+        # Collinear points (a single row or column of pixels): a rectangle without height along the segment,
+        # its first side points right (or down if vertical) so the rotation stays within (-90, 90] degrees
+        start, end = sorted(map(tuple, hull.tolist()))
+        return [start, end, end, start]
+
+    edges = np.roll(hull, -1, axis=0) - hull
+    angles = np.unique(np.mod(np.arctan2(edges[:, 1], edges[:, 0]), np.pi / 2))
+    cos = np.cos(angles)[:, np.newaxis]
+    sin = np.sin(angles)[:, np.newaxis]
+
+    # coordinates of the hull in the frame of each candidate rectangle
+    u = cos * hull[:, 0] + sin * hull[:, 1]
+    v = cos * hull[:, 1] - sin * hull[:, 0]
+    u_min, u_max = u.min(axis=1), u.max(axis=1)
+    v_min, v_max = v.min(axis=1), v.max(axis=1)
+    best = np.argmin((u_max - u_min) * (v_max - v_min))
+
+    c, s = cos[best, 0], sin[best, 0]
+    rectangle = [(u_min[best], v_min[best]), (u_max[best], v_min[best]),
+                 (u_max[best], v_max[best]), (u_min[best], v_max[best])]
+    return [(float(pu * c - pv * s), float(pu * s + pv * c)) for pu, pv in rectangle]
+
+
+def box_geometry(rectangles) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    calculates centre, width, height and rotation of all boxes of a frame in one vectorised pass:
+    the mean of the corners, the direction of the first side and the extent of the corners along and across it
+    :param rectangles: (N, 4, 2) corners of the boxes, the first side points in the direction of the rotation
+    :return: (centres (N, 2), widths (N,), heights (N,), rotations (N,)), rotations in radians
+    """
+    rectangles = np.asarray(rectangles, dtype=float).reshape(-1, 4, 2)
+    centres = rectangles.mean(axis=1)
+
+    side = rectangles[:, 1] - rectangles[:, 0]
+    rotations = np.arctan2(side[:, 1], side[:, 0])
+
+    # rotate all corners back to align with the coordinate axes
+    cos = np.cos(rotations)[:, np.newaxis]
+    sin = np.sin(rotations)[:, np.newaxis]
+    offsets = rectangles - centres[:, np.newaxis, :]
+    u = cos * offsets[:, :, 0] + sin * offsets[:, :, 1]
+    v = cos * offsets[:, :, 1] - sin * offsets[:, :, 0]
+
+    widths = u.max(axis=1) - u.min(axis=1)
+    heights = v.max(axis=1) - v.min(axis=1)
+    return centres, widths, heights, rotations
+
+
+def rectangle_corners(centres, widths, heights, rotations) -> np.ndarray:
+    """
+    inverse of `box_geometry`, calculates the corners of all (rotated) boxes at once
+    :param centres: (N, 2) centres of the boxes
+    :param widths: (N,) widths of the boxes
+    :param heights: (N,) heights of the boxes
+    :param rotations: (N,) rotations in radians
+    :return: (N, 4, 2) corners: top-left, top-right, bottom-right, bottom-left before the rotation
+    """
+    centres = np.asarray(centres, dtype=float).reshape(-1, 2)
+    half_widths = np.asarray(widths, dtype=float)[:, np.newaxis] / 2
+    half_heights = np.asarray(heights, dtype=float)[:, np.newaxis] / 2
+    u = np.hstack((-half_widths, half_widths, half_widths, -half_widths))
+    v = np.hstack((-half_heights, -half_heights, half_heights, half_heights))
+
+    cos = np.cos(rotations)[:, np.newaxis]
+    sin = np.sin(rotations)[:, np.newaxis]
+    x = centres[:, 0:1] + cos * u - sin * v
+    y = centres[:, 1:2] + sin * u + cos * v
+    return np.stack((x, y), axis=-1)
+
+
+def region_arrays(region: dict) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    converts the segments of a PALLOC region into NumPy arrays, arrays (e.g. of a checkpoint) are not copied
+    :param region: dict with the lists segmentsY, segmentsXStart and segmentsXStop
+    :return: (segments_y, segments_x_start, segments_x_stop)
+    """
+    return (np.asarray(region['segmentsY']),
+            np.asarray(region['segmentsXStart']),
+            np.asarray(region['segmentsXStop']))
+
+
+def initial_corners(segments_y: np.ndarray,
+                    segments_x_start: np.ndarray,
+                    segments_x_stop: np.ndarray) -> List[List[float]]:
+    """
+    finds the first guess of the four corners of a box from its region segments.
+    Left and right corner are the left-/right-most pixels of significant segments,
+    top and bottom corner are the middle of the last and the first segment
+    :param segments_y: y coordinate of each segment
+    :param segments_x_start: first x coordinate of each segment
+    :param segments_x_stop: last x coordinate of each segment
+    :return: [left, right, top, bottom] corners as [x, y] lists
+    """
+    max_y = segments_y[-1].item()
+    min_y = segments_y[0].item()
+    max_x = segments_x_stop[-1].item()
+    min_x = segments_x_start[-1].item()
+
+    # Left, Right, Top, Bottom
+    coordinates = [[min_x, max_y],
+                   [(max_x + min_x) / 2, max_y],
+                   [max_x, max_y],
+                   [(segments_x_stop[0].item() + segments_x_start[0].item()) / 2, min_y]]
+
+    significant = np.flatnonzero((segments_x_stop - segments_x_start) > SIGNIFICANCE)
+    if significant.size == 0:
+        return coordinates
+
+    # argmin/argmax return the first extreme segment, like a scan with strict comparisons would
+    left = significant[np.argmin(segments_x_start[significant])]
+    if segments_x_start[left] < coordinates[0][0]:
+        coordinates[0] = [segments_x_start[left].item(), segments_y[left].item()]
+
+    right = significant[np.argmax(segments_x_stop[significant])]
+    if segments_x_stop[right] > coordinates[1][0]:
+        coordinates[1] = [segments_x_stop[right].item(), segments_y[right].item()]
+
+    return coordinates
+
+
+def region_points(segments_y: np.ndarray,
+                  segments_x_start: np.ndarray,
+                  segments_x_stop: np.ndarray) -> np.ndarray:
+    """
+    returns the left- and right-most pixel of every row of a region,
+    the convex hull of all pixels of the region only depends on these
+    :param segments_y: y coordinate of each segment
+    :param segments_x_start: first x coordinate of each segment
+    :param segments_x_stop: last x coordinate of each segment
+    :return: (n, 2) array of x, y coordinates
+    """
+    if np.any(segments_y[1:] < segments_y[:-1]):
+        order = np.argsort(segments_y, kind='stable')
+        segments_y = segments_y[order]
+        segments_x_start = segments_x_start[order]
+        segments_x_stop = segments_x_stop[order]
+
+    rows = np.flatnonzero(np.diff(segments_y, prepend=segments_y[0] - 1))
+    y = segments_y[rows]
+    left = np.minimum.reduceat(segments_x_start, rows)
+    right = np.maximum.reduceat(segments_x_stop, rows)
+    return np.concatenate((np.column_stack((left, y)), np.column_stack((right, y))))
+
+
+def region_pixels(segments_y: np.ndarray,
+                  segments_x_start: np.ndarray,
+                  segments_x_stop: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    expands the segments of a region into the coordinates of all of its pixels
+    :param segments_y: y coordinate of each segment
+    :param segments_x_start: first x coordinate of each segment
+    :param segments_x_stop: last x coordinate of each segment
+    :return: (rows, columns) of the pixels
+    """
+    lengths = np.maximum(np.asarray(segments_x_stop) - segments_x_start + 1, 0)
+    starts = np.cumsum(lengths) - lengths
+    rows = np.repeat(segments_y, lengths)
+    columns = np.repeat(segments_x_start, lengths) + (np.arange(lengths.sum()) - np.repeat(starts, lengths))
+    return rows, columns
+
+
+def region_depths(depth: np.ndarray, regions: List[Tuple[np.ndarray, np.ndarray, np.ndarray]]) -> np.ndarray:
+    """
+    median depth of every region, pixels without a measurement (NaN) and outside of the image are ignored.
+    All regions are masked and reduced at once: the pixels are sorted by region and depth,
+    the median is picked from the middle of every group
+    :param depth: (height, width) depth image
+    :param regions: (segments_y, segments_x_start, segments_x_stop) of each region
+    :return: (N,) median depths, NaN for regions without valid pixels
+    """
+    if not regions:
+        return np.empty(0)
+    segments = [np.concatenate(column) for column in zip(*regions)]
+    rows, columns = region_pixels(*segments)
+    groups = np.repeat(np.repeat(np.arange(len(regions)), [len(region[0]) for region in regions]),
+                       np.maximum(segments[2] - segments[1] + 1, 0))
+
+    inside = (rows >= 0) & (rows < depth.shape[0]) & (columns >= 0) & (columns < depth.shape[1])
+    values = depth[rows[inside], columns[inside]].astype(float)
+    groups = groups[inside]
+    valid = np.isfinite(values)
+    values = values[valid]
+    groups = groups[valid]
+
+    # One sort of a combined key groups the values by region and orders them by depth within each region
+    medians = np.full(len(regions), np.nan)
+    if values.size == 0:
+        return medians
+    low = values.min()
+    span = values.max() - low + 1
+    values = np.sort(groups * span + (values - low)) - np.sort(groups) * span + low
+    counts = np.bincount(groups, minlength=len(regions))
+    starts = np.cumsum(counts) - counts
+    measured = counts > 0
+    lower = values[starts[measured] + (counts[measured] - 1) // 2]
+    upper = values[starts[measured] + counts[measured] // 2]
+    medians[measured] = (lower + upper) / 2
+    return medians
+
+
+def fit_match(rectangle: dict,
+              segments: Tuple[np.ndarray, np.ndarray, np.ndarray],
+              neighbours: List[dict],
+              fit_region_pixels: bool = True) -> Tuple[List[List[float]], List[Tuple[float, float]]]:
+    """
+    finds the corners of one box and fits the rectangle with minimal area around it
+    :param rectangle: PALLOC rectangle (x, y, width, height) of the match
+    :param segments: (segments_y, segments_x_start, segments_x_stop) of its region
+    :param neighbours: PALLOC rectangles of the matches overlapping with this one
+    :param fit_region_pixels: fit the rectangle around all region pixels if there are no neighbours
+    :return: ([left, right, top, bottom] corners, the four corners of the fitted rectangle)
+    """
+    height = rectangle['height']
+    width = rectangle['width']
+    bbox_x = rectangle['x']
+    bbox_y = rectangle['y']
+
+    # Left, Right, Top, Bottom
+    coordinates = initial_corners(*segments)
+
+    for other_bbox in neighbours:
+        # If a corner is overlapping with another box, recreate it using trigonometry
+        other_x = other_bbox['x']
+        other_y = other_bbox['y']
+        other_width = other_bbox['width']
+        other_height = other_bbox['height']
+
+        delta_top = (coordinates[2][1] - (bbox_y + (height / 2)))
+        delta_bot = (coordinates[3][1] - (bbox_y - (height / 2)))
+
+        if (delta_top < delta_bot):
+            pref_tb = coordinates[2]
+            bad_tb = coordinates[3]
+        else:
+            pref_tb = coordinates[3]
+            bad_tb = coordinates[2]
+
+        delta_left = (coordinates[0][0] - (bbox_x - (width / 2)))
+        delta_right = (coordinates[1][0] - (bbox_x + (width / 2)))
+
+        if (delta_left < delta_right): # Left corner closer to bbox than right corner
+            pref_lr = coordinates[0]
+            bad_lr = coordinates[1]
+        else:
+            pref_lr = coordinates[1]
+            bad_lr = coordinates[0]
+
+        pref_lr_x = pref_lr[0]
+        pref_lr_y = pref_lr[1]
+        bad_lr_x = bad_lr[0]
+        bad_lr_y = bad_lr[1]
+
+        # If the good corner is in a different region, recreate it using the worse corner
+        if (abs(pref_lr_x - other_x) < other_width
+            and abs(pref_lr_y - other_y) < other_height):
+            delta_x = bad_lr_x-bbox_x
+            pref_lr[0] = bbox_x - delta_x
+            delta_y = bad_lr_y-bbox_y
+            pref_lr[1] = bbox_y - delta_y
+
+        # Recreate right corner from left. Not necessarily necessary, so it might cause problems.
+        elif(abs(bad_lr_x - other_x) < other_width
+             and abs(bad_lr_y - other_y) < other_height):
+            delta_x = pref_lr_x-bbox_x
+            bad_lr[0] = bbox_x - delta_x
+            delta_y = pref_lr_y-bbox_y
+            bad_lr[1] = bbox_y - delta_y
+
+        pref_tb_x = pref_tb[0]
+        pref_tb_y = pref_tb[1]
+        bad_tb_x = bad_tb[0]
+        bad_tb_y = bad_tb[1]
+
+        if (abs(pref_tb_x - other_x) < other_width
+            and abs(pref_tb_y - other_y) < other_height):
+            delta_x = bad_tb_x - bbox_x
+            pref_tb[0] = bbox_x - delta_x
+            delta_y = bad_tb_y-bbox_y
+            pref_tb[1] = bbox_y - delta_y
+        elif(abs(bad_tb_x - other_x) < other_width 
+            and abs(bad_tb_y - other_y) < other_height):
+            delta_x = pref_tb_x-bbox_x
+            bad_tb[0] = bbox_x - delta_x
+            delta_y = pref_tb_y-bbox_y
+            bad_tb[1] = bbox_y - delta_y
+
+    # Calculate the minimum bounding rectangle. Without overlaps every pixel of the region belongs
+    # to the box, otherwise only the (reconstructed) corners can be trusted
+    if fit_region_pixels and not neighbours:
+        bounding_rectangle = minimum_bounding_rectangle(region_points(*segments))
+    else:
+        bounding_rectangle = minimum_bounding_rectangle(coordinates)
+    return coordinates, bounding_rectangle
+
+
+def fit_matches(match_data: Dict[int, dict],
+                overlaps: Dict[int, List[int]],
+                fit_region_pixels: bool = True,
+                executor: Optional[Executor] = None,
+                chunks: int = 1,
+                match_ids: Optional[Iterable[int]] = None) -> Dict[int, Tuple[List[List[float]], List[Tuple[float, float]]]]:
+    """
+    runs `fit_match` for all matches of a frame. If a (process pool) executor is given, the matches are
+    split into chunks fitted in parallel, the region segments of the frame are handed to the workers in
+    one shared memory block instead of pickling them
+    :param match_data: PALLOC match data by match number
+    :param overlaps: numbers of the overlapping matches by match number, see `find_overlaps`
+    :param fit_region_pixels: fit boxes without overlaps around all region pixels
+    :param executor: executor to fit the matches in parallel, None to fit them in this thread
+    :param chunks: number of tasks to split the matches into, usually the number of workers
+    :param match_ids: only fit these matches, by default all
+    :return: (corners, fitted rectangle) by match number
+    """
+    rectangles = {i: match['bbox']['rectangle'] for i, match in match_data.items()}
+    ids = list(match_data) if match_ids is None else list(match_ids)
+    if executor is None or len(ids) < PARALLEL_MIN_MATCHES:
+        return {i: fit_match(rectangles[i],
+                             region_arrays(match_data[i]['bbox']['region']),
+                             [rectangles[j] for j in overlaps[i]],
+                             fit_region_pixels)
+                for i in ids}
+
+    offsets = np.cumsum([0] + [len(match_data[i]['bbox']['region']['segmentsY']) for i in ids])
+    total = int(offsets[-1])
+    memory = shared_memory.SharedMemory(create=True, size=max(1, 3 * total * np.dtype(np.int64).itemsize))
+    try:
+        block = np.ndarray((3, total), dtype=np.int64, buffer=memory.buf)
+        for k, i in enumerate(ids):
+            region = match_data[i]['bbox']['region']
+            block[0, offsets[k]:offsets[k + 1]] = region['segmentsY']
+            block[1, offsets[k]:offsets[k + 1]] = region['segmentsXStart']
+            block[2, offsets[k]:offsets[k + 1]] = region['segmentsXStop']
+        del block
+
+        jobs = [(i, int(offsets[k]), int(offsets[k + 1]), rectangles[i], [rectangles[j] for j in overlaps[i]])
+                for k, i in enumerate(ids)]
+        futures = [executor.submit(_fit_shared_matches, memory.name, total, jobs[start::chunks], fit_region_pixels)
+                   for start in range(min(chunks, len(jobs)))]
+        results = {}
+        for future in futures:
+            results.update(future.result())
+    finally:
+        memory.close()
+        memory.unlink()
+    return {i: results[i] for i in ids}
+
+
+def _fit_shared_matches(name: str, total: int, jobs: list, fit_region_pixels: bool) -> dict:
+    # Runs in a worker process: fits the given matches reading their segments from the shared memory block
+    # The block is unlinked by the creating process. Before python 3.13 attaching registers it again,
+    # which is harmless because the workers share the resource tracker of their parent
+    if sys.version_info >= (3, 13):
+        memory = shared_memory.SharedMemory(name=name, track=False)
+    else:
+        memory = shared_memory.SharedMemory(name=name)
+    results = {}
+    segments = None
+    block = np.ndarray((3, total), dtype=np.int64, buffer=memory.buf)
+    for i, start, stop, rectangle, neighbours in jobs:
+        segments = (block[0, start:stop], block[1, start:stop], block[2, start:stop])
+        results[i] = fit_match(rectangle, segments, neighbours, fit_region_pixels)
+    del block, segments
+    memory.close()
+    return results
+
+
+def find_overlaps(rectangles: Dict[int, dict]) -> Dict[int, List[int]]:
+    """
+    finds the overlapping (axis aligned) PALLOC rectangles with a sort and sweep along the x-axis,
+    so only rectangles which overlap in x are compared
+    :param rectangles: dicts with x, y, width, height (x, y being the center) by match number
+    :return: ascending numbers of the overlapping rectangles by match number
+    """
+    neighbours = {i: [] for i in rectangles}
+    order = sorted(rectangles, key=lambda i: rectangles[i]['x'] - rectangles[i]['width'] / 2)
+    active = []  # rectangles whose x-interval may still reach the current one
+    for i in order:
+        rectangle = rectangles[i]
+        x = rectangle['x']
+        y = rectangle['y']
+        width = rectangle['width']
+        height = rectangle['height']
+
+        left = x - width / 2
+        active = [j for j in active if rectangles[j]['x'] + rectangles[j]['width'] / 2 >= left]
+        for j in active:
+            other = rectangles[j]
+            if (abs(x - other['x']) < (width + other['width']) / 2
+                    and abs(y - other['y']) < (height + other['height']) / 2):
+                neighbours[i].append(j)
+                neighbours[j].append(i)
+        active.append(i)
+
+    for overlapping in neighbours.values():
+        overlapping.sort()
+    return neighbours
+
+
+def _read_only(array) -> np.ndarray:
+    array = np.array(array, dtype=float)
+    array.flags.writeable = False
+    return array
+
+
+@dataclass(frozen=True)
+class FrameResult:
+    """
+    result of `FramePipeline.process` for one frame. All arrays are read-only and ordered like `match_ids`,
+    so a result can be handed to other threads (GUI, planner) without copying or locking
+    """
+    match_ids: Tuple[int, ...]
+    overlaps: Mapping[int, Tuple[int, ...]]  # numbers of the overlapping matches by match number
+    corners: np.ndarray  # (N, 4, 2) [left, right, top, bottom] corners found in the regions
+    rectangles: np.ndarray  # (N, 4, 2) corners of the fitted rectangles
+    centres: np.ndarray  # (N, 2)
+    widths: np.ndarray  # (N,)
+    heights: np.ndarray  # (N,)
+    rotations: np.ndarray  # (N,) radians
+    z: Optional[np.ndarray] = None  # (N,) surface heights from the depth image, NaN if not measured
+
+    @classmethod
+    def from_fits(cls,
+                  overlaps: Dict[int, List[int]],
+                  fitted: Dict[int, Tuple[List[List[float]], List[Tuple[float, float]]]],
+                  z: Optional[np.ndarray] = None) -> "FrameResult":
+        """
+        measures the fitted rectangles of a frame
+        :param overlaps: numbers of the overlapping matches by match number, see `find_overlaps`
+        :param fitted: (corners, fitted rectangle) by match number, see `fit_matches`
+        :param z: surface heights in the order of the sorted match numbers, see `FramePipeline.surface_heights`
+        :return:
+        """
+        match_ids = tuple(sorted(fitted))
+        corners = [fitted[i][0] for i in match_ids]
+        rectangles = [fitted[i][1] for i in match_ids]
+        centres, widths, heights, rotations = box_geometry(rectangles)
+        return cls(match_ids=match_ids,
+                   overlaps=MappingProxyType({i: tuple(overlaps[i]) for i in match_ids}),
+                   corners=_read_only(np.reshape(corners, (-1, 4, 2))),
+                   rectangles=_read_only(np.reshape(rectangles, (-1, 4, 2))),
+                   centres=_read_only(centres),
+                   widths=_read_only(widths),
+                   heights=_read_only(heights),
+                   rotations=_read_only(rotations),
+                   z=_read_only(z) if z is not None else None)
+
+    def __len__(self) -> int:
+        return len(self.match_ids)
+
+    def index(self, match_id: int) -> int:
+        """
+        position of a match in the arrays
+        :param match_id: match number
+        :return:
+        """
+        return self.match_ids.index(match_id)
+
+    def box(self, match_id: int) -> Dict[str, float]:
+        """
+        the fitted box of a match
+        :param match_id: match number
+        :return: dict with x, y, width, height, rotation (radians) and z (None without depth)
+        """
+        k = self.index(match_id)
+        return {'x': self.centres[k, 0].item(),
+                'y': self.centres[k, 1].item(),
+                'width': self.widths[k].item(),
+                'height': self.heights[k].item(),
+                'rotation': self.rotations[k].item(),
+                'z': self.z[k].item() if self.z is not None else None}
+
+    def boxes(self) -> Dict[int, Dict[str, float]]:
+        """
+        the fitted boxes of all matches
+        :return: dicts with x, y, width, height, rotation (radians) and z by match number
+        """
+        return {i: self.box(i) for i in self.match_ids}
+
+
+class FramePipeline:
+    """
+    box detection of one frame: overlaps, corner extraction, rectangle fitting and measurement.
+    Keeps no state between frames and never modifies the match data, so one pipeline can process
+    several frames (or cameras) in parallel threads
+    """
+    def __init__(self,
+                 fit_region_pixels: bool = True,
+                 executor: Optional[Executor] = None,
+                 chunks: int = 1,
+                 ground_depth: Optional[float] = None) -> None:
+        """
+        :param fit_region_pixels: fit boxes without overlaps around all region pixels
+        :param executor: executor to fit the matches of large frames in parallel, see `fit_matches`
+        :param chunks: number of tasks to split the matches into, usually the number of workers
+        :param ground_depth: depth of the ground (empty pallet) in mm, z is measured upwards from it.
+                             None keeps z as depth (distance from the camera)
+        """
+        self.fit_region_pixels = fit_region_pixels
+        self.executor = executor
+        self.chunks = chunks
+        self.ground_depth = ground_depth
+
+    def process(self, match_data: Dict[int, dict], depth: Optional[np.ndarray] = None) -> FrameResult:
+        """
+        detects the boxes of a frame
+        :param match_data: PALLOC match data by match number
+        :param depth: (height, width) depth image in mm to measure the surface heights, optional
+        :return: the boxes of the frame
+        """
+        overlaps = find_overlaps({i: match['bbox']['rectangle'] for i, match in match_data.items()})
+        return FrameResult.from_fits(overlaps, self.fit(match_data, overlaps), self.surface_heights(match_data, depth))
+
+    def surface_heights(self, match_data: Dict[int, dict], depth: Optional[np.ndarray]) -> Optional[np.ndarray]:
+        """
+        robust height of the top surface of every box: the median depth of its region
+        :param match_data: PALLOC match data by match number
+        :param depth: (height, width) depth image in mm, None skips the measurement
+        :return: (N,) heights in the order of the sorted match numbers, None without depth image
+        """
+        if depth is None:
+            return None
+        depths = region_depths(depth, [region_arrays(match_data[i]['bbox']['region']) for i in sorted(match_data)])
+        return self.ground_depth - depths if self.ground_depth is not None else depths
+
+    def fit(self,
+            match_data: Dict[int, dict],
+            overlaps: Dict[int, List[int]],
+            match_ids: Optional[Iterable[int]] = None) -> Dict[int, Tuple[List[List[float]], List[Tuple[float, float]]]]:
+        """
+        fits the rectangles of (some of) the matches of a frame
+        :param match_data: PALLOC match data by match number
+        :param overlaps: numbers of the overlapping matches by match number, see `find_overlaps`
+        :param match_ids: only fit these matches, by default all
+        :return: (corners, fitted rectangle) by match number
+        """
+        return fit_matches(match_data, overlaps, self.fit_region_pixels, self.executor, self.chunks, match_ids)
+
+
+if __name__ == '__main__':
+    # Regions of a single row, column or diagonal of pixels: the rectangle has no height, but a length and direction
+    rows = np.arange(10)
+    for name, segments, length, angle in (('row', (np.zeros(1), np.zeros(1), np.full(1, 9)), 9, 0),
+                                          ('column', (rows, np.full(10, 5), np.full(10, 5)), 9, 90),
+                                          ('diagonal', (rows, rows, rows), 9 * np.sqrt(2), 45),
+                                          ('anti-diagonal', (rows, 9 - rows, 9 - rows), 9 * np.sqrt(2), -45)):
+        _, widths, heights, rotations = box_geometry([minimum_bounding_rectangle(region_points(*segments))])
+        assert np.allclose((widths[0], heights[0], np.degrees(rotations[0])), (length, 0, angle)), \
+            (name, widths, heights, np.degrees(rotations))
+        print(f"{name}: width {widths[0]:.1f}, height {heights[0]:.1f}, rotation {np.degrees(rotations[0]):.1f} deg")